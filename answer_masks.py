@@ -0,0 +1,31 @@
+import numpy as np
+
+# One byte per answered question, shared by results_store.py and scoring.py: the
+# five options as bits, A as the most significant like inject.encode_question, and
+# the written answer mark 'x' above them. 'BDx' is 0b101010.
+
+OPTIONS = 'ABCDE'
+WRITTEN_BIT = 1 << len(OPTIONS) # 'x'
+OPTION_BITS = {option: 1 << (len(OPTIONS) - 1 - i) for i, option in enumerate(OPTIONS)}
+OPTION_BITS['x'] = WRITTEN_BIT
+
+# region functions
+def encode_answer(answer):
+    # 'BDx' -> 0b101010
+    mask = 0
+    for option in answer:
+        if option not in OPTION_BITS:
+            raise ValueError(f"Unknown answer option '{option}' in '{answer}'.")
+        mask |= OPTION_BITS[option]
+    return mask
+
+def decode_answer(mask):
+    return ''.join(option for option in OPTIONS + 'x' if mask & OPTION_BITS[option])
+
+def encode_answers(answers):
+    # list of answer strings -> uint8 array, one mask per question
+    return np.array([encode_answer(answer) for answer in answers], dtype=np.uint8)
+
+def decode_answers(masks):
+    return [decode_answer(int(mask)) for mask in masks]
+# endregion functions
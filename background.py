@@ -0,0 +1,54 @@
+import atexit
+import queue
+import sys
+import threading
+import traceback
+
+# Background writer for annotated images. Drawing and JPEG encoding run on one
+# worker thread per process, so a pipeline returns as soon as its answers are
+# written. The queue is bounded: every job holds a full page image, and when
+# encoding falls behind, submit() blocks instead of piling them up.
+#
+# Jobs still queued at exit are finished by an atexit hook. Worker processes of
+# a ProcessPoolExecutor skip atexit, so their initializer has to call
+# flush_on_exit() (see batch.init_worker).
+
+MAX_PENDING = 4
+
+jobs = queue.Queue(MAX_PENDING)
+thread = None
+lock = threading.Lock()
+
+# region functions
+def work():
+    while True:
+        function, args = jobs.get()
+        try:
+            function(*args)
+        except Exception:
+            print("Failed to write annotated image:", file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            jobs.task_done()
+
+def submit(function, *args):
+    # run function(*args) on the writer thread, started on first use
+    global thread
+    with lock:
+        if thread is None:
+            thread = threading.Thread(target=work, name='background-writer', daemon=True)
+            thread.start()
+    jobs.put((function, args))
+
+def flush():
+    # wait until every submitted job has finished
+    if thread is not None:
+        jobs.join()
+
+def flush_on_exit():
+    # for multiprocessing workers, whose exit runs finalizers instead of atexit hooks
+    from multiprocessing import util
+    util.Finalize(None, flush, exitpriority=10)
+# endregion functions
+
+atexit.register(flush)
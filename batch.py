@@ -0,0 +1,222 @@
+import argparse
+import contextlib
+import csv
+import glob
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import background
+import geometry
+import instrumentation
+import loader
+import thresholding
+from utils import read_answer_strings
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+PIPELINES = ('grade', 'grade1', 'cascade')
+
+# region functions
+def find_sheets(inputs):
+    # each input is a directory, a glob pattern or a single image path
+    sheets = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+            paths = [path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS)]
+        else:
+            paths = glob.glob(pattern)
+        sheets.extend(sorted(paths))
+    return list(dict.fromkeys(sheets)) # drop duplicates, keep order
+
+def answers_path(sheet, output_dir, name=None):
+    # name: the answer file's name without extension, the scan's file name by default
+    if name is None:
+        name = os.path.splitext(os.path.basename(sheet))[0]
+    return os.path.join(output_dir, name + '.txt')
+
+def relative_name(sheet, root):
+    # room1/a-3.jpg below root -> room1_a-3
+    return os.path.splitext(os.path.relpath(os.path.abspath(sheet), root))[0].replace(os.sep, '_')
+
+def answer_names(sheets):
+    # answer file name per sheet: the scan's file name, or where scans in different
+    # directories share it, their paths below the directory they have in common
+    # (room1/a-3.jpg, room2/a-3.jpg -> room1_a-3, room2_a-3). Scans that only differ in
+    # their extension keep it, a-3_jpg and a-3_png
+    groups = {}
+    for sheet in sheets:
+        groups.setdefault(os.path.splitext(os.path.basename(sheet))[0], []).append(sheet)
+    names = {}
+    for name, group in groups.items():
+        if len(group) == 1:
+            names[group[0]] = name
+            continue
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(sheet)) for sheet in group])
+        relative = {sheet: relative_name(sheet, root) for sheet in group}
+        for sheet in group:
+            if list(relative.values()).count(relative[sheet]) > 1:
+                names[sheet] = relative[sheet] + '_' + os.path.splitext(sheet)[1][1:].lower()
+            else:
+                names[sheet] = relative[sheet]
+    return names
+
+def is_up_to_date(sheet, output):
+    return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(sheet)
+
+def output_paths(sheet, output):
+    # answer files a scan is graded into, one per page of a multi-page TIFF
+    try:
+        pages = loader.page_count(sheet)
+    except Exception: # unreadable, the worker reports why
+        pages = 1
+    return [output] if pages == 1 else [loader.page_path(output, index) for index in range(pages)]
+
+def page_records(sheet, answers):
+    # (sheet, answers) per page, pages of a multi-page scan are named sheet:index
+    if isinstance(answers, dict):
+        return [(f"{sheet}:{index}", page_answers) for index, page_answers in answers.items()]
+    return [(sheet, answers)]
+
+def load_pipeline(method):
+    # imported once per worker process, not once per sheet
+    if method == 'grade':
+        import grade
+        return grade
+    if method == 'grade1':
+        import grade1
+        return grade1
+    if method == 'cascade':
+        import cascade
+        return cascade
+    raise ValueError(f"Unknown pipeline '{method}', expected one of {PIPELINES}.")
+
+def init_worker(method, metrics=False, annotate=False):
+    load_pipeline(method)
+    if metrics:
+        instrumentation.enable()
+    if annotate:
+        background.flush_on_exit() # finish the queued images before the worker exits
+
+def grade_sheet(job):
+    # runs in a worker process, returns (sheet, output, answers, error, metrics record or None)
+    method, sheet, output, options = job
+    instrumentation.reset()
+    start = time.perf_counter()
+    try:
+        pipeline = load_pipeline(method)
+        pages = loader.page_count(sheet) > 1 # {page index: answers} of a multi-page scan
+        with contextlib.redirect_stdout(io.StringIO()): # the pipelines print every step
+            if method == 'grade' and pages:
+                answers = {index: pipeline.format_answers(page) for index, page in pipeline.process_pages(sheet, output, **options).items()}
+            elif method == 'grade':
+                answers = pipeline.format_answers(pipeline.process_test(sheet, output, **options))
+            else:
+                answers = (pipeline.run_pages if pages else pipeline.run)(sheet, output, **options)
+        error = None
+    except Exception as e:
+        answers, error = None, f"{type(e).__name__}: {e}"
+    record = None
+    if instrumentation.enabled:
+        instrumentation.add_time(f"{method}.total", time.perf_counter() - start)
+        record = instrumentation.snapshot(sheet=sheet, pipeline=method, error=error)
+    return sheet, output, answers, error, record
+
+def write_combined(records, path):
+    # records: (sheet, answers) pairs, written as CSV or JSON lines depending on the extension
+    if path.endswith('.jsonl'):
+        with open(path, 'w') as f:
+            for sheet, answers in records:
+                f.write(json.dumps({'sheet': sheet, 'answers': answers}) + '\n')
+        return
+
+    num_questions = max((len(answers) for _, answers in records), default=0)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['sheet'] + [str(i) for i in range(1, num_questions + 1)])
+        for sheet, answers in records:
+            writer.writerow([sheet] + answers + [''] * (num_questions - len(answers)))
+
+def run(inputs, output_dir, method='grade', workers=None, chunksize=1, combined=None, force=False, form_id=None, metrics=None, annotate=False, threshold=None, reduce=1, cache_dir=None):
+    sheets = find_sheets(inputs)
+    if not sheets:
+        raise FileNotFoundError(f"No scans found for {inputs}.")
+    os.makedirs(output_dir, exist_ok=True)
+
+    options = {'annotate': annotate}
+    if method == 'grade' and form_id is not None:
+        options['form_id'] = form_id
+    if threshold is not None:
+        options['threshold'] = threshold
+    if reduce != 1:
+        options['reduce'] = reduce
+    if cache_dir is not None:
+        options['cache_dir'] = cache_dir
+    jobs = []
+    records = {}
+    names = answer_names(sheets)
+    for sheet in sheets:
+        output = answers_path(sheet, output_dir, names[sheet])
+        outputs = output_paths(sheet, output)
+        if not force and all(is_up_to_date(sheet, path) for path in outputs):
+            if len(outputs) == 1:
+                records[sheet] = read_answer_strings(output)
+            else:
+                records[sheet] = {index: read_answer_strings(path) for index, path in enumerate(outputs)}
+        else:
+            jobs.append((method, sheet, output, options))
+    print(f"Found {len(sheets)} scans, {len(sheets) - len(jobs)} already graded, grading {len(jobs)} with {method}.py")
+
+    failed = []
+    metric_records = []
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(method, metrics is not None, annotate)) as executor:
+            for sheet, output, answers, error, record in executor.map(grade_sheet, jobs, chunksize=chunksize):
+                if record is not None:
+                    metric_records.append(record)
+                if error is not None:
+                    failed.append(sheet)
+                    print(f"Failed {sheet}: {error}")
+                    continue
+                records[sheet] = answers
+                print(f"Graded {sheet} -> {output}")
+
+    if combined is not None:
+        write_combined([record for sheet in sheets if sheet in records for record in page_records(sheet, records[sheet])], combined)
+        print(f"Successfully saved combined results at: {combined}")
+    if metrics is not None:
+        instrumentation.write_metrics(metric_records, metrics)
+        print(f"Successfully saved metrics at: {metrics}")
+    return records, failed
+# endregion functions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade a directory or glob of scanned answer sheets in parallel.")
+    parser.add_argument('inputs', nargs='+', help="directories, glob patterns or image paths, e.g. 'test-images/*-*.jpg'")
+    parser.add_argument('-o', '--output-dir', required=True, help="directory for the per-sheet answer files")
+    parser.add_argument('-m', '--method', choices=PIPELINES, default='grade', help="recogniser to use (default: grade)")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="worker processes (default: number of CPUs)")
+    parser.add_argument('-c', '--chunksize', type=int, default=1, help="sheets sent to a worker at a time")
+    parser.add_argument('--combined', help="combined output file, .csv or .jsonl")
+    parser.add_argument('--form-id', help="reuse the box grid detected on the first sheet of this form (grade only)")
+    parser.add_argument('--metrics', help="per-sheet stage timings and counters, .jsonl or Prometheus .prom")
+    parser.add_argument('--annotate', action='store_true', help="also write a <sheet>_scored.jpg with the recognised answers marked")
+    parser.add_argument('--threshold', type=thresholding.setting, default=None,
+                        help=f"one of {thresholding.METHODS} ('local' for unevenly lit scans) adapts each recogniser's own level to the scan. "
+                             "A grey level means something different per method: grade binarizes the scan at it before finding the boxes, "
+                             "grade1 uses it instead of its fixed level 150 for the box borders and fills, cascade does not take one")
+    parser.add_argument('--reduce', type=int, choices=geometry.REDUCTIONS, default=1,
+                        help="decode the scans at up to 1/reduce of their size, faster for JPEG scans above 200 dpi. "
+                             "Each scan is only reduced as far as the recogniser can read it: 100 dpi for grade, 200 dpi for grade1")
+    parser.add_argument('--cache', help="result cache directory: identical scans graded before with the same settings are not recognised again")
+    parser.add_argument('-f', '--force', action='store_true', help="re-grade sheets whose answer file is up to date")
+    args = parser.parse_args()
+    if args.method == 'cascade' and isinstance(args.threshold, (int, float)):
+        parser.error("-m cascade takes a threshold method, a grey level only fits one recogniser")
+    if args.method == 'cascade' and args.annotate:
+        parser.error("-m cascade does not write annotated sheets, use -m grade or -m grade1 with --annotate")
+
+    _, failed = run(args.inputs, args.output_dir, args.method, args.workers, args.chunksize, args.combined, args.force, args.form_id, args.metrics, args.annotate, args.threshold, args.reduce, args.cache)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,284 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import instrumentation
+from utils import read_answer_strings
+
+# functions timed as stages of each pipeline, stage name -> function names in the module.
+# Stage times are exclusive: a stage called from another one is not counted twice.
+# Whatever the pipeline spends outside these functions is reported as 'other'
+STAGES = {
+    'grade': {
+        'sobel': ['sobel'],
+        'threshold': ['threshold_image'],
+        'line detection': ['get_vertical_lines', 'get_horizontal_lines', 'get_questions'],
+        'box detection': ['get_question_boxes'],
+        'answer extraction': ['score_answer_choices'],
+        'output': ['write_answers_to_file'],
+    },
+    'grade1': {
+        'blur': ['blur'],
+        'threshold': ['binarize'],
+        'opening': ['opening'],
+        'box detection': ['box_responses'],
+        'answer scan': ['scan_boxes'],
+        'output': ['write_answers'],
+    },
+    'inject': {
+        'barcode rendering': ['embed_barcode'],
+    },
+    'extract': {
+        'band decoding': ['load_barcode_band'],
+        'alignment bars': ['find_alignment_bars'],
+        'barcode decoding': ['decode_barcode'],
+    },
+}
+PIPELINES = tuple(STAGES)
+# seconds a scanning script may spend importing a pipeline before it starts working.
+# Each takes 0.2 to 0.25 s on an idle machine here, half of it numpy, and about twice
+# that under load; importing matplotlib.pyplot alone takes 0.85 s
+STARTUP_BUDGET = 0.75
+
+# region functions
+@contextlib.contextmanager
+def timed_stages(module, stages, timings):
+    # temporarily wrap the stage functions of module so their wall time is added to timings
+    stack = [] # [stage, time spent in nested stages]
+    originals = {}
+
+    def wrap(stage, function):
+        def timed(*args, **kwargs):
+            stack.append([stage, 0.0])
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                _, nested = stack.pop()
+                timings[stage] = timings.get(stage, 0.0) + elapsed - nested
+                if stack:
+                    stack[-1][1] += elapsed
+        return timed
+
+    for stage, names in stages.items():
+        for name in names:
+            originals[name] = getattr(module, name)
+            setattr(module, name, wrap(stage, originals[name]))
+    try:
+        yield timings
+    finally:
+        for name, function in originals.items():
+            setattr(module, name, function)
+
+def startup_time(module, repeat=3):
+    # best time to import module in a fresh interpreter, less the interpreter's own start up
+    def best(code):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+            times.append(time.perf_counter() - start)
+        return min(times)
+    return max(best(f"import {module}") - best('pass'), 0.0)
+
+def check_startup(pipelines, budget=STARTUP_BUDGET):
+    # returns ({pipeline: seconds}, list of pipelines over budget)
+    startup = {pipeline: startup_time(pipeline) for pipeline in pipelines}
+    for pipeline, seconds in startup.items():
+        print(f"{pipeline:>7} import: {seconds*1000:8.1f} ms (budget {budget*1000:.0f} ms)")
+    return startup, [pipeline for pipeline, seconds in startup.items() if seconds > budget]
+
+def groundtruth_path(sheet):
+    return os.path.splitext(sheet)[0] + '_groundtruth.txt'
+
+def answer_key(sheet, work_dir):
+    # the ground truth without the 'x' (written answer) marks, which the barcode cannot encode
+    name = os.path.splitext(os.path.basename(sheet))[0]
+    path = os.path.join(work_dir, f"{name}_key.txt")
+    if not os.path.exists(path):
+        with open(path, 'w') as f:
+            for i, answer in enumerate(read_answer_strings(groundtruth_path(sheet)), start=1):
+                f.write(f"{i} {answer.replace('x', '')}\n")
+    return path
+
+def run_pipeline(pipeline, sheet, work_dir):
+    # returns the recognised answers (or None when there is nothing to score)
+    name = os.path.splitext(os.path.basename(sheet))[0]
+    output = os.path.join(work_dir, f"{name}_{pipeline}.txt")
+    if pipeline == 'grade':
+        import grade
+        return grade.format_answers(grade.process_test(sheet, output, annotate=False))
+    if pipeline == 'grade1':
+        import grade1
+        return grade1.run(sheet, output, annotate=False)
+    if pipeline == 'inject':
+        import inject
+        inject.run(sheet, answer_key(sheet, work_dir), os.path.join(work_dir, f"{name}_injected.png"))
+        return None
+    if pipeline == 'extract':
+        import extract
+        extract.run(os.path.join(work_dir, f"{name}_injected.png"), output) # written by the inject pipeline
+        return read_answer_strings(output)
+    raise ValueError(f"Unknown pipeline '{pipeline}', expected one of {PIPELINES}.")
+
+def score(answers, sheet, pipeline, work_dir):
+    path = groundtruth_path(sheet)
+    if answers is None or not os.path.exists(path):
+        return None
+    expected = read_answer_strings(answer_key(sheet, work_dir) if pipeline == 'extract' else path)
+    correct = sum(a == b for a, b in zip(answers, expected))
+    return {'correct': correct, 'total': len(expected)}
+
+def benchmark_sheet(pipeline, sheet, work_dir, repeat=1):
+    module = __import__(pipeline)
+    if pipeline == 'extract': # extract decodes what inject embedded, prepared outside the timing
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_pipeline('inject', sheet, work_dir)
+    times, runs, counters = [], [], []
+    for _ in range(repeat):
+        timings = {}
+        instrumentation.reset()
+        with timed_stages(module, STAGES[pipeline], timings), contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            answers = run_pipeline(pipeline, sheet, work_dir)
+            times.append(time.perf_counter() - start)
+        timings['other'] = times[-1] - sum(timings.values())
+        runs.append(timings)
+        counters.append(instrumentation.snapshot()['counters'])
+
+    # peak memory from a separate traced run, tracing slows numpy down
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_pipeline(pipeline, sheet, work_dir)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    best = int(np.argmin(times))
+    return {
+        'pipeline': pipeline,
+        'sheet': os.path.basename(sheet),
+        'wall_time': times[best],
+        'wall_times': times,
+        'stages': runs[best],
+        'counters': counters[best],
+        'peak_memory': peak_memory,
+        'accuracy': score(answers, sheet, pipeline, work_dir),
+    }
+
+def summarize(results):
+    summary = {}
+    for pipeline in dict.fromkeys(r['pipeline'] for r in results):
+        runs = [r for r in results if r['pipeline'] == pipeline]
+        stages = {}
+        for r in runs:
+            for stage, seconds in r['stages'].items():
+                stages[stage] = stages.get(stage, 0.0) + seconds / len(runs)
+        scored = [r['accuracy'] for r in runs if r['accuracy'] is not None]
+        summary[pipeline] = {
+            'sheets': len(runs),
+            'mean_wall_time': float(np.mean([r['wall_time'] for r in runs])),
+            'max_wall_time': float(np.max([r['wall_time'] for r in runs])),
+            'mean_stage_times': stages,
+            'max_peak_memory': int(max(r['peak_memory'] for r in runs)),
+            'accuracy': sum(a['correct'] for a in scored) / sum(a['total'] for a in scored) if scored else None,
+        }
+    return summary
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(summary, baseline, tolerance=0.1):
+    # print changes against a previous results file, returns the list of regressions
+    regressions = []
+    for pipeline, current in summary.items():
+        previous = baseline['summary'].get(pipeline)
+        if previous is None:
+            continue
+        change = current['mean_wall_time'] / previous['mean_wall_time'] - 1
+        print(f"{pipeline}: {previous['mean_wall_time']*1000:.1f} ms -> {current['mean_wall_time']*1000:.1f} ms ({change:+.1%})")
+        if change > tolerance:
+            regressions.append(f"{pipeline} wall time {change:+.1%}")
+        for stage, seconds in current['mean_stage_times'].items():
+            before = previous['mean_stage_times'].get(stage)
+            if before:
+                print(f"    {stage}: {before*1000:.1f} ms -> {seconds*1000:.1f} ms ({seconds / before - 1:+.1%})")
+        if previous['accuracy'] is not None and current['accuracy'] is not None and current['accuracy'] < previous['accuracy']:
+            regressions.append(f"{pipeline} accuracy {previous['accuracy']:.4f} -> {current['accuracy']:.4f}")
+    return regressions
+
+def run(images, pipelines=PIPELINES, repeat=1):
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for pipeline in pipelines:
+            for sheet in images:
+                result = benchmark_sheet(pipeline, sheet, work_dir, repeat)
+                accuracy = result['accuracy']
+                accuracy = f"{accuracy['correct']}/{accuracy['total']}" if accuracy else '-'
+                print(f"{pipeline:>7} {result['sheet']:>12}: {result['wall_time']*1000:8.1f} ms, "
+                      f"peak {result['peak_memory'] / 2**20:6.1f} MiB, correct {accuracy}")
+                results.append(result)
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'repeat': repeat,
+        'results': results,
+        'summary': summarize(results),
+    }
+# endregion functions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the grading, injection and extraction pipelines on the test images.")
+    parser.add_argument('images', nargs='*', help="scans to benchmark (default: test-images/*-*.jpg with a ground truth)")
+    parser.add_argument('-p', '--pipelines', nargs='+', choices=PIPELINES, default=list(PIPELINES))
+    parser.add_argument('-r', '--repeat', type=int, default=1, help="timed runs per sheet, the fastest is reported")
+    parser.add_argument('-o', '--output', help="save the results as JSON")
+    parser.add_argument('--compare', help="results JSON of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed slowdown before --compare fails (default: 0.1)")
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET,
+                        help=f"seconds each pipeline module may take to import, the command fails above it (default: {STARTUP_BUDGET})")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    images = args.images or [path for path in sorted(glob.glob(os.path.join(here, 'test-images', '*-*.jpg')))
+                             if os.path.exists(groundtruth_path(path))]
+    images = [os.path.abspath(path) for path in images]
+
+    startup, slow_imports = check_startup(args.pipelines, args.startup_budget)
+    instrumentation.enable() # pipeline counters such as threshold retries and rows scanned
+    report = run(images, args.pipelines, args.repeat)
+    report['startup'] = startup
+    for pipeline, summary in report['summary'].items():
+        accuracy = '-' if summary['accuracy'] is None else f"{summary['accuracy']:.2%}"
+        print(f"{pipeline}: mean {summary['mean_wall_time']*1000:.1f} ms, max {summary['max_wall_time']*1000:.1f} ms, accuracy {accuracy}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Successfully saved benchmark results at: {args.output}")
+
+    regressions = [f"{pipeline} import takes {startup[pipeline]*1000:.0f} ms, over the {args.startup_budget*1000:.0f} ms budget"
+                   for pipeline in slow_imports]
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions += compare(report['summary'], json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    sys.exit(1 if regressions else 0)
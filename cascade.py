@@ -0,0 +1,235 @@
+import argparse
+import bisect
+import contextlib
+import io
+import os
+import grade
+import grade1
+import instrumentation
+import loader
+import result_cache
+
+# Grades with one recogniser and passes the sheets it is unsure about to the other
+# one. On the test sheets here grade.py reads a sheet in about half the time of
+# grade1.py, and grade1.py gets more answers right.
+#
+# Both report a confidence margin per question: how far the closest decision
+# (a box fill, an answer section, a written answer) was from its threshold, see
+# grade.score_answer_choices and grade1.scan_answers. The margins of the two are
+# on different scales, so each is turned into the share of answers found wrong at
+# that margin, ERROR_RATES, measured on the 8 test sheets and 56 degraded copies of
+# them (noise, shading, a dim scan, low contrast, blur, a shift, a slight rotation;
+# 5440 answers). A sheet with a question above max_error is read again by the second
+# recogniser, which needs the whole sheet to find the box grid; an unsure question
+# takes the second answer when that one is less likely wrong (whole_sheet takes all
+# of them). A sheet the first one cannot read at all, or reads a different number of
+# questions on, goes to the second one completely, and one the second cannot read
+# keeps the first reading with its unsure questions reported.
+#
+# A sheet read twice costs both recognisers, and grade.py only gets some of the
+# questions grade1.py is unsure about right, so no setting is cheaper than grade1
+# alone at its accuracy. Measured in
+# one run, on the 8 test sheets (680 answers):
+#
+#   grade alone                          663 right   90 ms/sheet
+#   grade1 alone                         676 right  160 ms/sheet
+#   default (grade1, grade if it fails)  676 right  165 ms/sheet
+#   grade -> grade1, max_error 0.05      673 right  250 ms/sheet   8 of 8 re-read
+#   grade1 -> grade, max_error 0.2       678 right  195 ms/sheet   4 of 8 re-read
+#
+# and on the degraded copies (4760 answers), where grade1's fixed level fails on the
+# dim and shaded ones (--threshold local is meant for those), and on all blurred and
+# rotated ones, where grade fails on half of them:
+#
+#   grade alone                          3514 right   85 ms/sheet
+#   grade1 alone                         2276 right  150 ms/sheet
+#   default (grade1, grade if it fails)  2936 right  180 ms/sheet
+#   grade -> grade1, max_error 0.5       3711 right  120 ms/sheet   failed sheets only
+#   grade -> grade1, max_error 0.05      3788 right  250 ms/sheet
+#   grade1 -> grade, max_error 0.2       3769 right  225 ms/sheet
+#
+# So by default a sheet is only read by grade1, the better recogniser on the test
+# sheets, and by grade when grade1 cannot read it at all. Re-reading the unsure
+# questions buys accuracy at a higher cost per sheet and is opt-in with max_error.
+
+VERSION = 3 # of the combined answers, bump when a change can alter them (see result_cache.py)
+PIPELINES = {'grade': grade, 'grade1': grade1}
+FIRST, SECOND = 'grade1', 'grade'
+# (margin, share of the answers read at that margin or above, up to the next one, that were wrong)
+ERROR_RATES = {
+    'grade': ((0.0, 0.45), (0.01, 0.26), (0.02, 0.11), (0.03, 0.053), (0.05, 0.021), (0.1, 0.012), (0.15, 0.0)),
+    'grade1': ((0.0, 0.97), (0.05, 0.95), (0.1, 0.85), (0.125, 0.56), (0.15, 0.11), (0.175, 0.023), (0.2, 0.004)),
+}
+
+# region functions
+def read_answers(method, image, threshold=None, reduce=1, pages=False):
+    # (answer strings, margins), or {page index: (answer strings, margins)} with pages
+    options = {'reduce': reduce}
+    if threshold is not None:
+        options['threshold'] = threshold
+    pipeline = PIPELINES[method]
+    with contextlib.redirect_stdout(io.StringIO()): # the pipelines print every step
+        return (pipeline.pages_and_margins if pages else pipeline.answers_and_margins)(image, **options)
+
+def error_rates(method, margins):
+    # estimated share of wrong answers per question, from the recogniser's margins
+    edges, rates = zip(*ERROR_RATES[method])
+    return [rates[max(bisect.bisect_right(edges, margin) - 1, 0)] for margin in margins]
+
+def unsure_questions(errors, max_error):
+    # questions more likely wrong than max_error, none without one
+    if max_error is None:
+        return []
+    return [q for q, error in enumerate(errors) if error > max_error]
+
+def combine(first, second, max_error, whole_sheet=False):
+    # answer strings of a page from two readings, each (answer strings, error rates). The
+    # questions above max_error take the second answer when it is less likely wrong (all of
+    # them with whole_sheet). Returns (answers, questions taken from the second, questions still unsure)
+    answers, errors = first
+    second_answers, second_errors = second
+    if len(second_answers) != len(answers):
+        # grade.py returns a question per box row it found, grade1.py always 85: the
+        # questions cannot be matched up, the first reading is taken to have failed
+        return list(second_answers), list(range(len(second_answers))), unsure_questions(second_errors, max_error)
+    unsure = unsure_questions(errors, max_error)
+    if whole_sheet and unsure:
+        return list(second_answers), list(range(len(answers))), unsure_questions(second_errors, max_error)
+    answers, errors, taken = list(answers), list(errors), []
+    for q in unsure:
+        if second_errors[q] < errors[q]:
+            answers[q], errors[q] = second_answers[q], second_errors[q]
+            taken.append(q)
+    return answers, taken, [q for q in unsure if errors[q] > max_error]
+
+def read_errors(read, method):
+    # {page index: (answer strings, error rates)}
+    return {index: (answers, error_rates(method, margins)) for index, (answers, margins) in read(method).items()}
+
+def cascade_pages(read, first, second, max_error, whole_sheet):
+    # {page index: (answer strings, questions taken from the second recogniser, questions still
+    # unsure)}, read(method) returns {page index: (answer strings, margins)} of the scan
+    instrumentation.count('cascade.sheets')
+    try:
+        first_pages = read_errors(read, first)
+    except Exception: # e.g. the box grid was not found
+        instrumentation.count('cascade.first_failures')
+        first_pages = None
+
+    if first_pages is not None and not any(unsure_questions(errors, max_error) for _, errors in first_pages.values()):
+        return {index: (answers, [], []) for index, (answers, _) in first_pages.items()}
+    instrumentation.count('cascade.second_reads')
+    try:
+        second_pages = read_errors(read, second)
+    except Exception:
+        if first_pages is None:
+            raise
+        # the first reading stands, with the questions it is unsure about reported
+        instrumentation.count('cascade.second_failures')
+        return {index: (answers, [], unsure_questions(errors, max_error)) for index, (answers, errors) in first_pages.items()}
+    if first_pages is None:
+        combined = {index: (answers, list(range(len(answers))), unsure_questions(errors, max_error))
+                    for index, (answers, errors) in second_pages.items()}
+    else:
+        combined = {index: combine(first_pages[index], second_pages[index], max_error, whole_sheet) for index in first_pages}
+    instrumentation.count('cascade.questions_reread', sum(len(taken) for _, taken, _ in combined.values()))
+    return combined
+
+def read_once(image, threshold):
+    # the scan's bytes, read once for both recognisers
+    if isinstance(threshold, (int, float)):
+        raise ValueError("A cascade takes a threshold method, a grey level only fits one recogniser.")
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            return f.read()
+    return image
+
+def grade_cascade(image, first=FIRST, second=SECOND, max_error=None, whole_sheet=False, threshold=None, reduce=1):
+    # (answer strings, 0-based questions taken from the second recogniser, 0-based questions
+    # still unsure) of a single page sheet in memory or a path, grade_pages for a multi-page
+    # TIFF. threshold, when given, is one of thresholding.METHODS: a grey level is specific
+    # to one recogniser
+    image = read_once(image, threshold)
+    loader.single_page(image, 'cascade.grade_pages')
+    return cascade_pages(lambda method: {0: read_answers(method, image, threshold, reduce)},
+                         first, second, max_error, whole_sheet)[0]
+
+def grade_pages(image, first=FIRST, second=SECOND, max_error=None, whole_sheet=False, threshold=None, reduce=1):
+    # ({page index: answer strings}, {page index: questions taken from the second recogniser},
+    # {page index: questions still unsure})
+    image = read_once(image, threshold)
+    combined = cascade_pages(lambda method: read_answers(method, image, threshold, reduce, pages=True),
+                             first, second, max_error, whole_sheet)
+    return tuple({index: page[part] for index, page in combined.items()} for part in range(3))
+
+def answers_from_image(image, first=FIRST, second=SECOND, max_error=None, whole_sheet=False, threshold=None, reduce=1):
+    # answer strings of a sheet in memory like grade.answers_from_image, for server.py
+    return grade_cascade(image, first, second, max_error, whole_sheet, threshold, reduce)[0]
+
+def answers_from_pages(image, first=FIRST, second=SECOND, max_error=None, whole_sheet=False, threshold=None, reduce=1):
+    # {page index: answer strings} like grade.answers_from_pages
+    return grade_pages(image, first, second, max_error, whole_sheet, threshold, reduce)[0]
+
+def write_page(answers, taken, unsure, path, second):
+    grade1.write_answers(answers, path)
+    if taken:
+        print(f"Questions {', '.join(str(q + 1) for q in taken)} read by {second}.py")
+    if unsure:
+        print(f"Questions {', '.join(str(q + 1) for q in unsure)} may be misread")
+    print(f"Successfully saved output at: {path}")
+
+def run(image_path, output_path, annotate=False, threshold=None, reduce=1, cache_dir=None,
+        first=FIRST, second=SECOND, max_error=None, whole_sheet=False):
+    # writes the answer file like grade1.run, for batch.py and watch.py; run_pages for a multi-page TIFF
+    if annotate:
+        raise ValueError("Annotated images are not drawn in a cascade, grade with grade or grade1 for them.")
+    if cache_dir is not None:
+        # answers of an identical scan graded before with the same settings, see result_cache.py
+        params = {'first': first, 'second': second, 'max_error': max_error, 'whole_sheet': whole_sheet,
+                  'threshold': threshold, 'reduce': reduce}
+        return result_cache.cached_run(image_path, output_path, 'cascade', [VERSION, grade.VERSION, grade1.VERSION], params,
+                                       lambda: run(image_path, output_path, annotate, threshold, reduce, None,
+                                                   first, second, max_error, whole_sheet),
+                                       grade1.write_answers, cache_dir)
+    loader.single_page(image_path, 'cascade.run_pages')
+    answers, taken, unsure = grade_cascade(image_path, first, second, max_error, whole_sheet, threshold, reduce)
+    write_page(answers, taken, unsure, output_path, second)
+    return answers
+
+def run_pages(image_path, output_path, annotate=False, threshold=None, reduce=1, cache_dir=None,
+              first=FIRST, second=SECOND, max_error=None, whole_sheet=False):
+    # multi-page scan (TIFF): {page index: answers}, every page written to its own answer file
+    if annotate:
+        raise ValueError("Annotated images are not drawn in a cascade, grade with grade or grade1 for them.")
+    if cache_dir is not None:
+        params = {'first': first, 'second': second, 'max_error': max_error, 'whole_sheet': whole_sheet,
+                  'threshold': threshold, 'reduce': reduce, 'pages': True}
+        return result_cache.cached_run(image_path, output_path, 'cascade', [VERSION, grade.VERSION, grade1.VERSION], params,
+                                       lambda: run_pages(image_path, output_path, annotate, threshold, reduce, None,
+                                                         first, second, max_error, whole_sheet),
+                                       grade1.write_answers, cache_dir)
+    answers, taken, unsure = grade_pages(image_path, first, second, max_error, whole_sheet, threshold, reduce)
+    for index in answers:
+        write_page(answers[index], taken[index], unsure[index], loader.page_path(output_path, index), second)
+    return answers
+# endregion functions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade a scan with one recogniser, and the questions it is unsure about with the other one.")
+    parser.add_argument('input', help="scanned answer sheet")
+    parser.add_argument('output', help="answer file, N ABC per line")
+    parser.add_argument('--first', choices=PIPELINES, default=FIRST, help=f"recogniser that reads every sheet (default: {FIRST})")
+    parser.add_argument('--second', choices=PIPELINES, default=SECOND,
+                        help=f"recogniser for the unsure questions and the sheets the first cannot read (default: {SECOND})")
+    parser.add_argument('--max-error', type=float, default=None,
+                        help="estimated share of wrong answers above which a question is read again, e.g. 0.2 "
+                             "(default: none, only sheets the first recogniser cannot read go to the second)")
+    parser.add_argument('--whole-sheet', action='store_true', help="take all answers of a re-read sheet from the second recogniser")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        parser.error(f"{args.input} - path does not exist")
+    if args.first == args.second:
+        parser.error("--first and --second must be different recognisers")
+    grade_scan = run_pages if loader.page_count(args.input) > 1 else run
+    grade_scan(args.input, args.output, first=args.first, second=args.second, max_error=args.max_error, whole_sheet=args.whole_sheet)
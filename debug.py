@@ -0,0 +1,52 @@
+import matplotlib.pyplot as plt
+from matplotlib.patches import Rectangle
+import cv2
+
+# Visual debugging helpers for grade.py. They open windows (cv2.imshow, plt.show)
+# and pull in matplotlib, so grade.py only imports this module when one of them
+# is used, e.g. grade.draw_lines_and_boxes(img, vertical_lines, question_boxes).
+
+# region functions
+def draw_boxes_on_image(image, boxes):
+    fig, ax = plt.subplots(figsize=(10, 15))
+    ax.imshow(image, cmap='gray')
+    for box in boxes:
+        y_start, y_end, x_start, x_end = box
+        # draw lines
+        ax.add_patch(Rectangle((x_start, y_start), x_end - x_start, y_end - y_start, fill=None, edgecolor='red'))
+    plt.show()
+
+def draw_vertical_lines(img, lines):
+    for line in lines:
+        cv2.line(img, (line, 0), (line, img.shape[0]), (0, 255, 0), 2)
+    cv2.imshow("Vertical Lines", img)
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
+
+def draw_boxes_sequence(img, boxes):
+    # draw boxes one by one, wait for user input to continue
+    for box in boxes:
+        y_start, y_end, x_start, x_end = box
+        cv2.rectangle(img, (x_start, y_start), (x_end, y_end), (0, 255, 0), 2)
+        cv2.imshow("Boxes", img)
+        cv2.waitKey(0)
+    cv2.destroyAllWindows()
+
+def draw_lines_and_boxes(img, vertical_lines, question_boxes):
+    # draw boxes and lines
+    for line in vertical_lines:
+        cv2.line(img, (line, 0), (line, img.shape[0]), (0, 255, 0), 2)
+    for box in question_boxes:
+        y_start, y_end, x_start, x_end = box
+        cv2.rectangle(img, (x_start, y_start), (x_end, y_end), (0, 255, 0), 2)
+    cv2.imshow("Lines and Boxes", img)
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
+
+def draw_horizontal_lines(img, lines):
+    for line in lines:
+        cv2.line(img, (0, line), (img.shape[1], line), (0, 255, 0), 2)
+    cv2.imshow("Horizontal Lines", img)
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
+# endregion functions
@@ -2,32 +2,51 @@ import numpy as np
 import os, sys
 from PIL import Image
 from utils import get_question_ordering
+import instrumentation
+import loader
+import result_cache
+import thresholding
 
-# region functions
-def find_alignment_bars(image, start_row):
-    for row in range(start_row, 0, -1):  # scan upwards from start_row
-        line = image[row, :image.shape[1]//2] # just consider the first half of the row
-        transitions = np.where(np.diff(line == 0))[0]  # transitions from white to black or black to white, this is basically taking first order image derivative and getting locations where it is not 0
+VERSION = 1 # of the decoded answers, bump when a change can alter them (see result_cache.py)
 
-        if len(transitions) >= 6:  # 6 transitions
+# region functions
+def find_alignment_bars(image, start_row, block_rows=256):
+    # scan upwards from start_row for the first row that starts with the three
+    # alignment bars. Rows are classified a block at a time: the positions of the
+    # first six white/black transitions of every row come from one cumulative sum.
+    # Returns (w, g, row, scan_start) or None if no row matches
+    half = image.shape[1]//2 # just consider the first half of the row
+    top = start_row
+    while top > 0:
+        bottom = max(top - block_rows + 1, 1) # row 0 is never considered
+        block = image[bottom:top + 1, :half] == 0
+        instrumentation.count('extract.rows_scanned', top + 1 - bottom)
+        # transitions from white to black or black to white, this is basically taking first order image derivative and getting locations where it is not 0
+        transitions = np.cumsum(block[:, 1:] != block[:, :-1], axis=1, dtype=np.int32)
+        candidates = np.flatnonzero(transitions[:, -1] >= 6) # 6 transitions
+        if len(candidates):
+            transitions = transitions[candidates]
+            # column of the k-th transition is the number of columns with fewer than k transitions
+            first_six = np.stack([np.count_nonzero(transitions < k, axis=1) for k in range(1, 7)], axis=1)
 
             # bar width - w
-            b1_width = transitions[1] - transitions[0]
-            b2_width = transitions[3] - transitions[2]
-            b3_width = transitions[5] - transitions[4]
-            
+            bar_widths = first_six[:, 1::2] - first_six[:, ::2]
             # reduce the effect of noise by ensuring the bar widths are relatively consistent
-            if np.any(abs(np.diff([b1_width, b2_width, b3_width])) > 1.5): continue
-            
-            detected_w = int(round(np.mean([b1_width, b2_width, b3_width])))
-            
-            # inter-question gap - g
-            g1 = transitions[2] - transitions[1]
-            g2 = transitions[4] - transitions[3]
-            detected_g = int(np.mean([g1, g2]))
-            
-            return detected_w, detected_g, row, transitions[5] + detected_g
-        
+            consistent = np.all(abs(np.diff(bar_widths, axis=1)) <= 1.5, axis=1)
+            if consistent.any():
+                match = np.flatnonzero(consistent)[-1] # closest to start_row
+                b1_width, b2_width, b3_width = bar_widths[match]
+                detected_w = int(round(np.mean([b1_width, b2_width, b3_width])))
+
+                # inter-question gap - g
+                g1 = first_six[match, 2] - first_six[match, 1]
+                g2 = first_six[match, 4] - first_six[match, 3]
+                detected_g = int(np.mean([g1, g2]))
+
+                return detected_w, detected_g, bottom + int(candidates[match]), int(first_six[match, 5]) + detected_g
+        top = bottom - 1
+    return None
+
 def decode_row(row_pixels, w, g, scan_start):
     decoded_answers = []
     ind = scan_start
@@ -57,9 +76,10 @@ def decode_barcode(image, question_ordering):
     row = image.shape[0] - 1  # start from the bottom row and go up
     
     while len(shuffled_answers) < 85:
-        detected_w, detected_g, row, scan_start = find_alignment_bars(image, row)
-        if detected_w is None:
+        alignment = find_alignment_bars(image, row)
+        if alignment is None:
             break  # no more alignment bars found, stop decoding
+        detected_w, detected_g, row, scan_start = alignment
         
         # decode answers from the current row starting at scan_start
         row_answers = decode_row(image[row-2:row, :], detected_w, detected_g, scan_start)
@@ -81,19 +101,36 @@ def decode_barcode(image, question_ordering):
         if idx < len(shuffled_answers): ordered_answers[original_idx] = shuffled_answers[idx]
     
     return ordered_answers
-# endregion functions
 
-def run(source, output_file):
-    print(f"Source Image: {source}")
-    print(f"Output File: {output_file}")
+def load_barcode_band(image, band_height, threshold=100):
+    # the barcode is embedded at the bottom of the page (see inject.embed_barcode),
+    # so only the bottom rows are converted and thresholded
+    top = max(image.height - band_height, 0)
+    band = image.crop((0, top, image.width, image.height)).convert('L')
+    return thresholding.binarize(np.asarray(band), threshold, reference=100)
+# endregion functions
 
-    image = Image.open(source).convert('L')
-    if image is not None: print(f"Successfully opened {source}, processing further . . .")
-    image = np.array(image)
-    # threshold the image
-    image = np.where(image > 100, 255, 0)
+def decode_image(image, timer, band_height=300, threshold=100):
+    # answers (lists of options) of a PIL image of the sheet
+    band = load_barcode_band(image, band_height, threshold)
+    if find_alignment_bars(band, band.shape[0] - 1) is not None:
+        image = band
+    else:
+        print(f"No alignment bars in the bottom {band_height} rows, scanning the full page")
+        instrumentation.count('extract.full_page_fallbacks')
+        image = thresholding.binarize(np.asarray(image.convert('L')), threshold, reference=100)
+    timer.lap('load')
 
     answers = decode_barcode(image, get_question_ordering())
+    timer.lap('decode')
+    return answers
+
+def extract_image(image, output_file, timer, band_height=300, threshold=100):
+    answers = decode_image(image, timer, band_height, threshold)
+    write_answers(answers, output_file)
+    return answers
+
+def write_answers(answers, output_file):
     with open(output_file, 'w') as f:
         for i, ans in enumerate(answers, start = 1):
             f.write(f"{i} {''.join(ans)}")
@@ -102,6 +139,49 @@ def run(source, output_file):
 
     print(f"Output successfully saved to: {output_file}")
 
+def answers_from_image(image, band_height=300, threshold=100):
+    # answer strings ('A', 'BD', ...) of a sheet in memory: a uint8 array (grayscale, or
+    # BGR) or the encoded image in a bytes/memoryview buffer. Nothing is read from or
+    # written to disk; answers_from_pages for a multi-page TIFF buffer
+    loader.single_page(image, 'extract.answers_from_pages')
+    image = loader.open_image(image)
+    image.draft('L', image.size) # JPEGs decode straight to grayscale, no-op for other formats
+    return [''.join(answer) for answer in decode_image(image, instrumentation.laps('extract'), band_height, threshold)]
+
+def answers_from_pages(image, band_height=300, threshold=100):
+    # {page index: answer strings} of a scan in memory or a path, a multi-page TIFF page by page
+    return {index: [''.join(answer) for answer in decode_image(page, instrumentation.laps('extract'), band_height, threshold)]
+            for index, page in loader.iter_pages(image)}
+
+def run(source, output_file, band_height=300, threshold=100, cache_dir=None):
+    # answers of a single page scan, run_pages for a multi-page TIFF
+    if cache_dir is not None:
+        # answers of an identical scan decoded before with the same settings, see result_cache.py
+        return result_cache.cached_run(source, output_file, 'extract', VERSION, {'band_height': band_height, 'threshold': threshold},
+                                       lambda: run(source, output_file, band_height, threshold), write_answers, cache_dir)
+    print(f"Source Image: {source}")
+    print(f"Output File: {output_file}")
+    loader.single_page(source, 'extract.run_pages')
+
+    timer = instrumentation.laps('extract')
+    image = Image.open(source)
+    if image is not None: print(f"Successfully opened {source}, processing further . . .")
+    image.draft('L', image.size) # JPEGs decode straight to grayscale, no-op for other formats
+    return extract_image(image, output_file, timer, band_height, threshold)
+
+def run_pages(source, output_file, band_height=300, threshold=100, cache_dir=None):
+    # multi-page scan (TIFF): {page index: answers}, one page decoded at a time and
+    # written to its own answer file, see loader.page_path
+    if cache_dir is not None:
+        return result_cache.cached_run(source, output_file, 'extract', VERSION, {'band_height': band_height, 'threshold': threshold, 'pages': True},
+                                       lambda: run_pages(source, output_file, band_height, threshold), write_answers, cache_dir)
+    results = {}
+    for index, page in loader.iter_pages(source):
+        print(f"Decoding page {index} of {source}")
+        timer = instrumentation.laps('extract')
+        results[index] = extract_image(page, loader.page_path(output_file, index), timer, band_height, threshold)
+    return results
+
 if __name__ == "__main__":
     if len(sys.argv) != 3:
         print("Usage: python extract.py <path/to/source_image.jpg> <path/to/output_file.txt>")
@@ -110,4 +190,5 @@ if __name__ == "__main__":
     if not os.path.exists(sys.argv[1]):
         raise FileExistsError(f"{sys.argv[1]} - path does not exist.")
 
-    run(sys.argv[1], sys.argv[2])
\ No newline at end of file
+    extract_scan = run_pages if loader.page_count(sys.argv[1]) > 1 else run
+    extract_scan(sys.argv[1], sys.argv[2])
\ No newline at end of file
@@ -0,0 +1,59 @@
+# Sheet geometry in form units. The pixel constants of grade.py and grade1.py were
+# tuned on letter pages scanned at 200 dpi, 1700 pixels wide: the form resolution.
+# A sheet's scale is its resolution relative to that, estimated from the width of
+# the decoded page (the scale is needed before the answer grid can be found, grade.py
+# checks it against the grid and reads a padded page again). Lengths and pixel
+# counts tuned at the form resolution are converted with length() and area().
+#
+# Scans within SNAP of the form resolution, or of one of the REDUCTIONS of it, are
+# taken to be exactly at it: the constants have that much slack, and full
+# resolution scans keep the results they always had. JPEGs can be decoded at
+# those reductions straight from the DCT coefficients (cv2 IMREAD_REDUCED_*, PIL
+# draft), which is much faster than decoding every pixel, see loader.py. Below
+# MIN_SCALE (100 dpi) the answer boxes are too small to be told apart from the
+# letters printed in them; a recogniser can ask for more (grade1.MIN_SCALE), and
+# a scan is only decoded at the reductions that keep it above its minimum
+# (max_reduce), so --reduce 4 decodes a 200 dpi scan at 1/2.
+
+FORM_WIDTH = 1700   # pixels
+FORM_DPI = 200
+SNAP = 0.05
+REDUCTIONS = (1, 2, 4, 8)
+MIN_SCALE = 0.5
+
+# region functions
+def sheet_dpi(width, reduce=1):
+    # resolution the sheet was scanned at, from its width decoded at 1/reduce of its size
+    return FORM_DPI * width * reduce / FORM_WIDTH
+
+def snapped_scale(width):
+    # decoded page width in pixels -> pixels per form pixel, see SNAP
+    scale = width / FORM_WIDTH
+    for reduce in REDUCTIONS:
+        if abs(scale * reduce - 1) <= SNAP:
+            return 1 / reduce
+    return scale
+
+def sheet_scale(width, min_scale=MIN_SCALE):
+    scale = snapped_scale(width)
+    if scale < min_scale:
+        raise ValueError(f"The sheet is {FORM_DPI * scale:.0f} dpi as decoded, recognition needs at least "
+                         f"{FORM_DPI * min_scale:.0f} dpi.")
+    return scale
+
+def max_reduce(width, reduce, min_scale=MIN_SCALE):
+    # the largest of REDUCTIONS up to reduce a sheet width pixels wide (at full size) can
+    # be decoded at without going below min_scale, 1 when none can
+    for candidate in sorted(REDUCTIONS, reverse=True):
+        if candidate <= reduce and snapped_scale(width / candidate) >= min_scale:
+            return candidate
+    return 1
+
+def length(pixels, scale, minimum=0):
+    # a length at the form resolution in pixels of the sheet
+    return max(int(round(pixels * scale)), minimum)
+
+def area(count, scale):
+    # a pixel count at the form resolution, counts grow with the square of the scale
+    return count * scale * scale
+# endregion functions
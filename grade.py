@@ -1,18 +1,37 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
 import cv2
-from PIL import Image
-from PIL import ImageFilter
+import os
 import sys
+import background
+import geometry
+from gradient import gradient_magnitude
+from integral import rect_sum
+import instrumentation
+import layout
+import loader
+import result_cache
+import thresholding
+
+# visual debugging helpers, see debug.py. Imported on first use, matplotlib alone
+# takes longer to import than grading a sheet
+DEBUG_HELPERS = ('draw_boxes_on_image', 'draw_vertical_lines', 'draw_horizontal_lines',
+                 'draw_boxes_sequence', 'draw_lines_and_boxes')
+
+def __getattr__(name):
+    if name in DEBUG_HELPERS:
+        import debug
+        return getattr(debug, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+HEADER_HEIGHT = 660 # rows above the answer area, in form pixels (see geometry.py)
+EXTRA_INK = 400      # written answers: form pixels' worth of black left of the boxes
+LINE_SPAN = 1136     # form pixels from the first to the last vertical line of the answer boxes
+VERSION = 2          # of the recognised answers, bump when a change can alter them (see result_cache.py)
 
 def threshold_image(img, threshold='mean'):
-    if threshold == 'mean':
-        thresh_value = np.mean(img)
-    else:
-        thresh_value = threshold
-    binary_img = img > thresh_value
-    return binary_img.astype(int)
+    # threshold is a number or one of thresholding.METHODS
+    binary_img = img > thresholding.level(img, threshold)
+    return binary_img.astype(np.uint8)
 
 def get_questions(img, lines):
     new_lines = []
@@ -45,32 +64,14 @@ def get_questions(img, lines):
     return combine_lines(new_lines)
 
 
-def sobel(img):
-    if len(img.shape) == 3:
-        img = np.mean(img, axis=-1)
-
-    sobel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
-    sobel_y = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
-
-    gradient_x = np.zeros_like(img, dtype=float)
-    gradient_y = np.zeros_like(img, dtype=float)
-
-    for i in range(1, img.shape[0]-1):
-        for j in range(1, img.shape[1]-1):
-            gradient_x[i, j] = np.sum(sobel_x * img[i-1:i+2, j-1:j+2])
-            gradient_y[i, j] = np.sum(sobel_y * img[i-1:i+2, j-1:j+2])
-
+def sobel(img, backend='numpy'):
+    # see gradient.py, 'numpy' (vectorized) or 'cv2'
+    return gradient_magnitude(img, backend=backend)
 
-    gradient_magnitude = np.sqrt(gradient_x**2 + gradient_y**2)
-
-    gradient_magnitude *= 255.0 / gradient_magnitude.max()
-
-    return gradient_magnitude
-
-def combine_lines(lines):
+def combine_lines(lines, gap=10):
     combined_lines = [lines[0]]
     for i in range(1, len(lines)):
-        if lines[i] - lines[i-1] > 10:
+        if lines[i] - lines[i-1] > gap:
             combined_lines.append(lines[i])
     return combined_lines
 
@@ -80,6 +81,7 @@ def is_white_row(img,y):
 
 def adjust_line(y, img, direction='up'):
     max_y = img.shape[0]
+    start = y
 
     if direction == 'up':
         # Move the line up until a non-white row is found
@@ -91,6 +93,7 @@ def adjust_line(y, img, direction='up'):
             y += 1
     else:
         raise ValueError("Direction must be 'up' or 'down'.")
+    instrumentation.count('grade.adjust_line_steps', abs(y - start))
 
     # Additional check to prevent getting stuck on the edge
     if (direction == 'up' and y == 0) or (direction == 'down' and y == max_y - 1):
@@ -98,7 +101,9 @@ def adjust_line(y, img, direction='up'):
     
     return y
 
-def get_question_boxes(img, lines):
+def get_question_boxes(img, lines, scale=1):
+    # the offsets are in form pixels, see geometry.py
+    offset = lambda pixels: geometry.length(pixels, scale)
     question_boxes = []
     # Assuming there are equal columns and the boxes are centered
     width = img.shape[1]
@@ -110,14 +115,14 @@ def get_question_boxes(img, lines):
         
         for j in range(3):  # Three columns
             x_left = j * col_width
-            x_right = (j + 1) * col_width if j < 2 else width - 20  # Adjust for the last column
+            x_right = (j + 1) * col_width if j < 2 else width - offset(20)  # Adjust for the last column
             if j == 0:
-                x_left += 100
+                x_left += offset(100)
             if j == 1:
-                x_right += -130
+                x_right += -offset(130)
             if j ==2:
-                x_left += -125
-                x_right += -200
+                x_left += -offset(125)
+                x_right += -offset(200)
             question_boxes.append((y_top, y_bottom, x_left, x_right))
     qbs = sort_boxes(question_boxes)
     return qbs
@@ -141,15 +146,6 @@ def sort_boxes(boxes):
     column2.append(boxes[i+7])
     return column1 + column2 + column3
 
-def draw_boxes_on_image(image, boxes):
-    fig, ax = plt.subplots(figsize=(10, 15))
-    ax.imshow(image, cmap='gray')
-    for box in boxes:
-        y_start, y_end, x_start, x_end = box
-        # draw lines
-        ax.add_patch(Rectangle((x_start, y_start), x_end - x_start, y_end - y_start, fill=None, edgecolor='red'))
-    plt.show()
-
 def find_answer(img, boxes):
     section_width = img.shape[1] // 5
     max_avg_intensity = 0
@@ -164,28 +160,86 @@ def find_answer(img, boxes):
 
     return max_avg_section + 1
 
-def get_vertical_lines(img):
+def line_levels(start=0.85, stop=0.0, step=0.01):
+    # fractions of the largest column sum tried for the vertical lines, highest first,
+    # down to 0 like the retry loop (every level below keeps all columns with any edge)
+    levels = []
+    level = start
+    while level > stop - step / 2:
+        levels.append(level)
+        level -= step # repeated subtraction, the same floats the retry loop used
+    return np.array(levels)
+
+VERTICAL_LINE_LEVELS = line_levels()
+
+def line_starts(columns, gap):
+    # per row of a boolean (levels, width) array: columns set that are more than gap
+    # past the previous set column of their row (the first one always counts)
+    index = np.arange(columns.shape[1])
+    previous = np.where(columns, index, -gap - 1)
+    previous = np.maximum.accumulate(previous, axis=1)
+    previous = np.concatenate([np.full((columns.shape[0], 1), -gap - 1), previous[:, :-1]], axis=1)
+    return columns & (index - previous > gap)
+
+def get_vertical_lines(img, num_lines=30, levels=VERTICAL_LINE_LEVELS, scale=1):
+    # columns close to the largest column sum are lines, merged when within 10 form
+    # pixels and dropped when within 15 of the previous one (filter_lines). Every
+    # level is tried at once, the highest giving exactly num_lines lines is used.
+    # No single level fits every sheet (0.68-0.73 of the largest sum on a-27,
+    # 0.77-0.85 on c-18), and Otsu's level of the column sums (about 0.3) merges
+    # the lines of each box into 18
     vertical_sum = np.sum(img, axis=0)
-    vertical_lines = []
-    threshold = 0.85
-    while len(vertical_lines) != 30:
-        vertical_threshold = threshold * np.max(vertical_sum)
-        vertical_lines = np.where(vertical_sum > vertical_threshold)[0]
-        vertical_lines = np.unique(vertical_lines)
-        vertical_lines = [vertical_lines[0]] + [vertical_lines[i] for i in range(1, len(vertical_lines)) if vertical_lines[i] - vertical_lines[i-1] > 10]
-        vertical_lines = filter_lines(vertical_lines)
-        threshold -= 0.01
-    return vertical_lines
-
-def get_horizontal_lines(img):
+    columns = vertical_sum > levels[:, None] * np.max(vertical_sum)
+    lines = line_starts(line_starts(columns, geometry.length(10, scale)), geometry.length(15, scale))
+    found = np.flatnonzero(np.count_nonzero(lines, axis=1) == num_lines)
+    if not len(found):
+        raise ValueError(f"Could not find the {num_lines} vertical lines of the answer boxes.")
+    instrumentation.count('grade.vertical_line_thresholds', int(found[0]) + 1)
+    return list(np.flatnonzero(lines[found[0]]))
+
+def vertical_edges(img, scale=1):
+    # on a resampled sheet the letters printed in the boxes blur into as many edge
+    # pixels per column as the box sides, only vertical runs longer than the letters
+    # are kept for the vertical lines
+    run = geometry.length(24, scale)
+    return cv2.morphologyEx(img, cv2.MORPH_OPEN, np.ones((run, 1), np.uint8))
+
+def get_horizontal_lines(img, scale=1):
+    gap = geometry.length(10, scale)
     horizontal_sum = np.sum(img, axis=1)
     horizontal_sum = np.sum(img, axis=1)
     horizontal_threshold = 0.87 * np.max(horizontal_sum)
     horizontal_lines = np.where(horizontal_sum > horizontal_threshold)[0]
     horizontal_lines = np.unique(horizontal_lines)
-    horizontal_lines = [horizontal_lines[0]] + [horizontal_lines[i] for i in range(1, len(horizontal_lines)) if horizontal_lines[i] - horizontal_lines[i-1] > 10]
+    horizontal_lines = [horizontal_lines[0]] + [horizontal_lines[i] for i in range(1, len(horizontal_lines)) if horizontal_lines[i] - horizontal_lines[i-1] > gap]
     return horizontal_lines
 
+def row_pitch(img, scale=1):
+    # rows from one question to the next: the strongest period of the row sums,
+    # looked for between 35 and 65 form pixels (the form has 47)
+    profile = np.sum(img, axis=1, dtype=np.float64)
+    profile -= profile.mean()
+    shortest, longest = geometry.length(35, scale), geometry.length(65, scale)
+    correlation = [np.dot(profile[:-lag], profile[lag:]) for lag in range(shortest, longest + 1)]
+    return shortest + int(np.argmax(correlation))
+
+def question_rows(img, top, height, scale=1):
+    # get_questions for resampled sheets: each line a row pitch below the previous one,
+    # moved to the emptiest row of the binary edge image (the gap between two
+    # questions) within 8 form pixels of it
+    profile = np.sum(img, axis=1)
+    window = geometry.length(8, scale)
+    lines = [top]
+    for i in range(0, 29):
+        line = lines[-1] + height
+        low, high = max(line - window, 0), min(line + window + 1, len(profile))
+        if low >= high:
+            break
+        lines.append(low + int(np.argmin(profile[low:high])))
+    for i in range(1, 5):
+        lines.append(lines[-1] + height)
+    return combine_lines(lines, geometry.length(10, scale))
+
 def filter_lines(lines):
     # remove lines that are too close to each other
     filtered_lines = [lines[0]]
@@ -194,89 +248,94 @@ def filter_lines(lines):
             filtered_lines.append(lines[i])
     return filtered_lines
 
-def draw_vertical_lines(img, lines):
-    for line in lines:
-        cv2.line(img, (line, 0), (line, img.shape[0]), (0, 255, 0), 2)
-    cv2.imshow("Vertical Lines", img)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
-
 def get_answer_choices(img, boxes, vertical_lines):
+    answer_choices, answer_boxes, _ = score_answer_choices(img, boxes, vertical_lines)
+    draw_answers(img, answer_boxes)
+    return answer_choices
+
+def dark_pixel_table(img, dark_threshold=100):
+    # summed-area table of the pixels darker than dark_threshold (a number or one of
+    # thresholding.METHODS), every dark pixel count below is an O(1) lookup in it.
+    # Colour images count every channel, like np.sum(section < 100) on a BGR slice
+    dark = (img < thresholding.level(img, dark_threshold, reference=100)).view(np.uint8)
+    if dark.ndim == 3:
+        dark = dark.sum(axis=2, dtype=np.uint8)
+    # same table as integral.integral_image, cv2 builds it several times faster than np.cumsum
+    return cv2.integral(dark, sdepth=cv2.CV_32S)
+
+def ink_table(img):
+    # summed-area table of the darkness (255 - grey level) of a grayscale image. Unlike
+    # a dark pixel count, the ink of an area stays the same when the image is reduced
+    return cv2.integral(255 - img, sdepth=cv2.CV_64F)
+
+def score_answer_choices(img, boxes, vertical_lines, dark_threshold=100, scale=1, resampled=False):
+    # returns (answer choices per question, (y_start, y_end, x1, x2) of every marked section,
+    # confidence margin per question). On a resampled sheet pixels are averages of form pixels
+    # and pencil marks turn grey, so sections are compared by their ink instead of dark pixel counts
+    sat = ink_table(img) if resampled else dark_pixel_table(img, dark_threshold)
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    y_start, y_end, x_start, x_end = (boxes[:, i:i+1] for i in range(4))
+    lines = np.asarray(vertical_lines)
+    x1, x2 = lines[0:len(lines)-1:2], lines[1:len(lines):2] # answer sections between line pairs
+
+    # black pixels of every (box, section), sections outside a box are not considered
+    inside = (x1 >= x_start) & (x2 <= x_end)
+    black_pixels = rect_sum(sat, y_start, y_end, x1, x2)
+    num_sections = inside.sum(axis=1, keepdims=True)
+    total = np.where(inside, black_pixels, 0).sum(axis=1, keepdims=True)
+    # above the average of the box: black_pixels > total / num_sections, without rounding
+    marked = inside & (black_pixels * num_sections > total)
+    answer_nums = np.cumsum(inside, axis=1) # answer choices are numbered from 1 within the box
+
+    # check if question has written answer next to it, left of the box in the first
+    # column and between the line pairs before the boxes in the other two
+    extra_x = np.zeros((len(boxes), 2), dtype=int)
+    extra_x[:, 1] = lines[0]
+    line_gap = geometry.length(5, scale)
+    if len(boxes) >= 30:
+        extra_x[29:59] = lines[9], lines[10] - line_gap
+    if len(boxes) >= 60:
+        extra_x[59:] = lines[19], lines[20] - line_gap
+    extra_pixels = rect_sum(sat, y_start[:, 0], y_end[:, 0], extra_x[:, 0], extra_x[:, 1])
+    if not resampled and img.ndim == 2:
+        extra_pixels = extra_pixels * 3 # see check_for_extra
+    extra = extra_pixels > (geometry.area(EXTRA_INK * 255, scale) if resampled else 880)
+
+    # margins: how far the closest section is from the box average, as a share of the
+    # most it can hold (all pixels dark, every channel counted; all black on a resampled
+    # sheet), and how far the written answer area is from its threshold, relative to it
+    full = 255 if resampled else (img.shape[2] if img.ndim == 3 else 1)
+    capacity = num_sections * (y_end - y_start) * (x2 - x1) * full
+    # a box without sections has nothing to divide by, those entries stay inf
+    section_margins = np.divide(np.abs(black_pixels * num_sections - total), capacity,
+                                out=np.full(black_pixels.shape, np.inf), where=inside & (capacity > 0))
+    extra_threshold = geometry.area(EXTRA_INK * 255, scale) if resampled else 880
+    extra_margins = np.abs(extra_pixels - extra_threshold) / extra_threshold
+    margins = np.minimum(section_margins.min(axis=1, initial=np.inf), extra_margins)
+
     answer_choices = []
-    answer_boxes = []
-    num = 1
-    for box in boxes:
-        y_start, y_end, x_start, x_end = box
-        curr_answers = []
-        black_pixels_list = []
-        sections = []
-        # Calculate black pixels for each section within the box
-        for i in range(0, len(vertical_lines) - 1, 2):
-            # Check if these vertical lines are within the box
-            if vertical_lines[i] < x_start or vertical_lines[i + 1] > x_end:
-                continue
-            x1 = vertical_lines[i]
-            x2 = vertical_lines[i + 1]
-            section = img[y_start:y_end, x1:x2]
-            black_pixels = np.sum(section < 100)
-            black_pixels_list.append(black_pixels)
-            sections.append((y_start, y_end, x1, x2))
-
-        # Calculate average black pixels if there are any sections to analyze
-        if black_pixels_list:
-            average_black_pixels = np.mean(black_pixels_list)
-            # Determine which sections are above average and should be considered an answer choice
-            answer_num = 1  # Start numbering answer choices from 1
-            for i in range(len(black_pixels_list)):
-                if black_pixels_list[i] > average_black_pixels:
-                    curr_answers.append(answer_num)
-                    answer_boxes.append(sections[i])
-                    
-                answer_num += 1
-        # check if question has written answer next to it
-        curr_lines = []
-        if num < 30:
-            curr_lines = [vertical_lines[0]]
-        elif num < 60:
-            curr_lines = [vertical_lines[9], vertical_lines[10]]
-        else:
-            curr_lines = [vertical_lines[19], vertical_lines[20]]
-        if check_for_extra(img, box, curr_lines):
+    for q in range(len(boxes)):
+        curr_answers = [int(n) for n in answer_nums[q, marked[q]]]
+        if extra[q]:
             curr_answers.append('x')
-
         answer_choices.append(curr_answers)
-        num += 1
-    draw_answers(img, answer_boxes)
-    return answer_choices
+    answer_boxes = [(int(boxes[q, 0]), int(boxes[q, 1]), int(x1[i]), int(x2[i])) for q, i in zip(*np.nonzero(marked))]
+    return answer_choices, answer_boxes, margins.tolist()
 
-def draw_answers(img, answers):
+def draw_answers(img, answers, path="scored.jpg"):
     # draw filled in rectangles for each answer
     # save the image to a file using imwrite
     for box in answers:
         y_start, y_end, x_start, x_end = box
         cv2.rectangle(img, (x_start, y_start), (x_end, y_end), (0, 255, 0), -1)
-    cv2.imwrite("scored.jpg", img)
+    cv2.imwrite(path, img)
 
-def draw_boxes_sequence(img, boxes):
-    # draw boxes one by one, wait for user input to continue
-    for box in boxes:
-        y_start, y_end, x_start, x_end = box
-        cv2.rectangle(img, (x_start, y_start), (x_end, y_end), (0, 255, 0), 2)
-        cv2.imshow("Boxes", img)
-        cv2.waitKey(0)
-    cv2.destroyAllWindows()
-        
+def write_scored_image(file_name_input, answer_boxes, path, y_offset=HEADER_HEIGHT, reduce=1):
+    # runs on the background writer, the colour image is only decoded here
+    draw_answers(loader.load_color(file_name_input, y_offset=y_offset, reduce=reduce), answer_boxes, path)
 
-def draw_lines_and_boxes(img, vertical_lines, question_boxes):
-    # draw boxes and lines
-    for line in vertical_lines:
-        cv2.line(img, (line, 0), (line, img.shape[0]), (0, 255, 0), 2)
-    for box in question_boxes:
-        y_start, y_end, x_start, x_end = box
-        cv2.rectangle(img, (x_start, y_start), (x_end, y_end), (0, 255, 0), 2)
-    cv2.imshow("Lines and Boxes", img)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
+def scored_image_path(file_name_output):
+    return os.path.splitext(file_name_output)[0] + '_scored.jpg'
 
 def print_answers(answers):
     answer_map = { 1: 'A', 2: 'B', 3: 'C', 4: 'D', 5: 'E', 'x': 'x' }
@@ -292,16 +351,16 @@ def check_for_extra(img, box, lines):
         section = img[y_start:y_end, lines[0]:lines[1]-5]
     # count number of black pixels, if it is high, return true
     black_pixels = np.sum(section < 100)
+    if img.ndim == 2:
+        black_pixels *= 3 # the threshold was tuned on BGR images, every pixel counted once per channel
     # print(black_pixels)
     return black_pixels > 880
 
 
-def draw_horizontal_lines(img, lines):
-    for line in lines:
-        cv2.line(img, (0, line), (img.shape[1], line), (0, 255, 0), 2)
-    cv2.imshow("Horizontal Lines", img)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
+def format_answers(answers):
+    answer_map = { 1: 'A', 2: 'B', 3: 'C', 4: 'D', 5: 'E', 'x': 'x' }
+    # one string per question, e.g. [[1, 2], [4, 'x']] -> ['AB', 'Dx']
+    return [''.join([answer_map[ans] for ans in answer]) for answer in answers]
 
 def write_answers_to_file(answers, filename):
     answer_map = { 1: 'A', 2: 'B', 3: 'C', 4: 'D', 5: 'E', 'x': 'x' }
@@ -311,40 +370,177 @@ def write_answers_to_file(answers, filename):
             f.write(f"{i + 1} {''.join([answer_map[ans] for ans in answer])}\n")
 
 def check_answers(answers, filename):
-    answer_map = { 1: 'A', 2: 'B', 3: 'C', 4: 'D', 5: 'E', 'x': 'x' }
-    # read the correct answers from the file
-    # per line, format: question number answer (if multiple answers, do not separate) for example: 1 AB
-    with open(filename, 'r') as f:
-        correct_answers = f.readlines()
-    correct_answers = [line.strip().split() for line in correct_answers]
-    correct_answers = { int(answer[0]): answer[1] for answer in correct_answers }
-    # compare the answers
-    correct = 0
-    for i, answer in enumerate(answers):
-        curr_answer = ''.join([answer_map[ans] for ans in answer])
-        # add question number to front of curr_answer, i+1 is the question number
-        if curr_answer == correct_answers[i + 1]:
-            correct += 1
+    # compare the answered questions against the answer key in filename (per line: question number answer,
+    # for example: 1 AB), returns the sheet's entry of scoring.cohort_report and prints the mismatches
+    import scoring # only needed when checking against a key
+    key = scoring.load_key(filename)
+    if len(key) < len(answers):
+        raise ValueError(f"The answer key has {len(key)} questions, the sheet {len(answers)}.")
+    key = key[:len(answers)]
+    masks = scoring.encode_cohort([format_answers(answers)], len(key))
+    result = scoring.cohort_report([filename], masks, key)['sheets'][0]
+    for question in result['incorrect']:
+        print(f"Question {question['question']} was incorrect. Answer was {question['answer']}, correct answer was {question['key']}")
+    print(f"Correct answers: {result['correct']}/{len(answers)}")
+    return result
+
+def answer_area(img, scale, reduce=1):
+    # (view of the answer area, resampled) of a whole grayscale sheet decoded at 1/reduce of
+    # its size, see geometry.py. Sheets scanned at the form resolution and decoded as they
+    # are go through the rules tuned on them unchanged, resampled ones (any other
+    # resolution, or reduced) through the ones that hold at every scale
+    return loader.crop(img, geometry.length(HEADER_HEIGHT, scale)), scale != 1 or reduce != 1
+
+def grid_scale(vertical_lines, scale):
+    # the scale measured on the box grid found at scale, snapped like geometry.sheet_scale.
+    # The width estimate only holds for a whole page
+    measured = (vertical_lines[-1] - vertical_lines[0]) / LINE_SPAN
+    if abs(measured / scale - 1) <= geometry.SNAP:
+        return scale
+    return geometry.sheet_scale(measured * geometry.FORM_WIDTH)
+
+def detect_layout(img, gradient_backend='numpy', scale=1, resampled=False):
+    # full box grid detection: (vertical_lines, question_boxes)
+    timer = instrumentation.laps('grade.layout')
+    edge_detected_img = sobel(img, backend=gradient_backend)
+    timer.lap('sobel')
+    binary_img = threshold_image(edge_detected_img, 'mean')
+    timer.lap('threshold')
+    vertical_lines = get_vertical_lines(vertical_edges(binary_img, scale) if resampled else binary_img, scale=scale)
+    timer.lap('vertical_lines')
+    if resampled:
+        # the line pairs of a row merge on a resampled sheet, the rows are spaced by their
+        # period instead. The crop can cut through the header's bottom line, which would
+        # outweigh the box lines, the first rows are left out
+        header_rows = geometry.length(8, scale)
+        top = header_rows + get_horizontal_lines(binary_img[header_rows:], scale)[0]
+        horizontal_lines = question_rows(binary_img, top, row_pitch(binary_img, scale), scale)
+    else:
+        horizontal_lines = get_horizontal_lines(binary_img)
+        horizontal_lines = get_questions(edge_detected_img, horizontal_lines)
+    timer.lap('horizontal_lines')
+    question_boxes = get_question_boxes(edge_detected_img, horizontal_lines, scale)
+    timer.lap('question_boxes')
+    return vertical_lines, question_boxes
+
+def recognise(sheet, timer, gradient_backend='numpy', form_id=None, layout_cache_dir=layout.CACHE_DIR, threshold=None, reduce=1):
+    # (answers, (y_start, y_end, x1, x2) of every marked section, confidence margin per question, scale)
+    # of a whole grayscale sheet decoded at 1/reduce of its size. The scale is estimated from the page
+    # width; a padded page (a scanner border), whose box grid measures another one, is read again at that one
+    scale = geometry.sheet_scale(sheet.shape[1])
+    for attempt in range(2):
+        img, resampled = answer_area(sheet, scale, reduce)
+        if threshold is not None:
+            # black and white sheet for unevenly lit scans, e.g. 'local', see thresholding.py
+            img = thresholding.binarize(img, threshold, reference=100)
+            timer.lap('threshold')
+        if form_id is None:
+            vertical_lines, question_boxes = detect_layout(img, gradient_backend, scale, resampled)
         else:
-            print(f"Question {i + 1} was incorrect. Answer was {curr_answer}, correct answer was {correct_answers[i + 1]}")
-    print(f"Correct answers: {correct}/{len(answers)}")
-
-def process_test(file_name_input, file_name_output):
+            # reuse the box grid of the first sheet of this form, see layout.py
+            detect = lambda img: detect_layout(img, gradient_backend, scale, resampled)
+            vertical_lines, question_boxes, _ = layout.get_layout(img, detect, form_id, layout_cache_dir)
+        timer.lap('layout')
+        measured = grid_scale(vertical_lines, scale)
+        if measured == scale or attempt:
+            break
+        instrumentation.count('grade.rescaled_sheets')
+        scale = measured
+    answers, answer_boxes, margins = score_answer_choices(img, question_boxes, vertical_lines, scale=scale, resampled=resampled)
+    timer.lap('answer_choices')
+    return answers, answer_boxes, margins, scale
+
+def answers_from_image(image, gradient_backend='numpy', form_id=None, layout_cache_dir=layout.CACHE_DIR, threshold=None, reduce=1):
+    # answer strings ('A', 'BD', 'Cx', ...) of a sheet in memory: a uint8 array (grayscale,
+    # or BGR) or the encoded image in a bytes/memoryview buffer. Nothing is read from or
+    # written to disk; answers_from_pages for a multi-page TIFF buffer.
+    # reduce > 1 recognises the sheet at 1/reduce of its resolution, see loader.py
+    return answers_and_margins(image, gradient_backend, form_id, layout_cache_dir, threshold, reduce)[0]
+
+def answers_and_margins(image, gradient_backend='numpy', form_id=None, layout_cache_dir=layout.CACHE_DIR, threshold=None, reduce=1):
+    # (answer strings, confidence margin per question) of a sheet in memory, like answers_from_image.
+    # See score_answer_choices for the margins, cascade.py re-reads the questions with small ones
+    loader.single_page(image, 'grade.pages_and_margins')
+    reduce = loader.supported_reduce(image, reduce)
+    timer = instrumentation.laps('grade')
+    sheet = loader.decode_gray(image, reduce=reduce)
+    timer.lap('load')
+    answers, _, margins, _ = recognise(sheet, timer, gradient_backend, form_id, layout_cache_dir, threshold, reduce)
+    return format_answers(answers), margins
+
+def answers_from_pages(image, gradient_backend='numpy', form_id=None, layout_cache_dir=layout.CACHE_DIR, threshold=None, reduce=1):
+    # {page index: answer strings} of a scan in memory or a path, a multi-page TIFF page by page
+    return {index: answers for index, (answers, _) in
+            pages_and_margins(image, gradient_backend, form_id, layout_cache_dir, threshold, reduce).items()}
+
+def pages_and_margins(image, gradient_backend='numpy', form_id=None, layout_cache_dir=layout.CACHE_DIR, threshold=None, reduce=1):
+    # {page index: (answer strings, margins)}, like answers_and_margins per page
+    return {index: answers_and_margins(loader.page_gray(page), gradient_backend, form_id, layout_cache_dir, threshold, reduce)
+            for index, page in loader.iter_pages(image)}
+
+def process_test(file_name_input, file_name_output, gradient_backend='numpy', form_id=None, layout_cache_dir=layout.CACHE_DIR, annotate=True,
+                 threshold=None, reduce=1, cache_dir=None):
+    # answers of a single page scan, process_pages for a multi-page TIFF
+    if cache_dir is not None:
+        # answers of an identical scan graded before with the same settings, see result_cache.py
+        params = {'gradient_backend': gradient_backend, 'form_id': form_id, 'threshold': threshold, 'reduce': reduce}
+        if form_id is not None:
+            params['layout'] = layout.form_digest(form_id, layout_cache_dir) # the grid the answers are read with
+        return result_cache.cached_run(file_name_input, file_name_output, 'grade', VERSION, params,
+                                       lambda: process_test(file_name_input, file_name_output, gradient_backend, form_id,
+                                                            layout_cache_dir, annotate, threshold, reduce),
+                                       write_answers_to_file, cache_dir, use_stored=not annotate)
+    loader.single_page(file_name_input, 'grade.process_pages')
     print("Recogninzing " + file_name_input + "...")
-    img = cv2.imread(file_name_input)
-    img = img[660:]
-    edge_detected_img = sobel(img)
-    binary_img = threshold_image(edge_detected_img, 'mean')
-    vertical_lines = get_vertical_lines(binary_img)
-    horizontal_lines = get_horizontal_lines(binary_img)
-    horizontal_lines = get_questions(edge_detected_img, horizontal_lines)
-    question_boxes = get_question_boxes(edge_detected_img, horizontal_lines)
-    answers = get_answer_choices(img, question_boxes, vertical_lines)
+    reduce = loader.supported_reduce(file_name_input, reduce)
+    timer = instrumentation.laps('grade')
+    sheet = loader.load_gray(file_name_input, reduce=reduce)
+    timer.lap('load')
+    answers, answer_boxes, _, scale = recognise(sheet, timer, gradient_backend, form_id, layout_cache_dir, threshold, reduce)
     print_answers(answers)
     write_answers_to_file(answers, file_name_output)
+    if annotate:
+        # drawn and encoded on the background writer, see background.py. The colour
+        # image is decoded at the same reduction, so the boxes fit it as they are
+        background.submit(write_scored_image, file_name_input, answer_boxes, scored_image_path(file_name_output),
+                          geometry.length(HEADER_HEIGHT, scale), reduce)
+    timer.lap('output')
+    return answers
+
+def process_pages(file_name_input, file_name_output, gradient_backend='numpy', form_id=None, layout_cache_dir=layout.CACHE_DIR, annotate=True,
+                  threshold=None, reduce=1, cache_dir=None):
+    # multi-page scan (TIFF): {page index: answers}, one page decoded at a time and
+    # written to its own answer file, see loader.page_path
+    if cache_dir is not None:
+        params = {'gradient_backend': gradient_backend, 'form_id': form_id, 'threshold': threshold, 'reduce': reduce, 'pages': True}
+        if form_id is not None:
+            params['layout'] = layout.form_digest(form_id, layout_cache_dir)
+        return result_cache.cached_run(file_name_input, file_name_output, 'grade', VERSION, params,
+                                       lambda: process_pages(file_name_input, file_name_output, gradient_backend, form_id,
+                                                             layout_cache_dir, annotate, threshold, reduce),
+                                       write_answers_to_file, cache_dir, use_stored=not annotate)
+    results = {}
+    for index, page in loader.iter_pages(file_name_input):
+        print(f"Recogninzing page {index} of {file_name_input}...")
+        page_reduce = loader.supported_reduce(page, reduce)
+        timer = instrumentation.laps('grade')
+        sheet = loader.page_gray(page, reduce=page_reduce)
+        timer.lap('load')
+        answers, answer_boxes, _, scale = recognise(sheet, timer, gradient_backend, form_id, layout_cache_dir, threshold, page_reduce)
+        output = loader.page_path(file_name_output, index)
+        print_answers(answers)
+        write_answers_to_file(answers, output)
+        if annotate:
+            background.submit(draw_answers, loader.page_color(page, geometry.length(HEADER_HEIGHT, scale), reduce=page_reduce),
+                              answer_boxes, scored_image_path(output))
+        timer.lap('output')
+        results[index] = answers
+    return results
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
+    args = [arg for arg in sys.argv[1:] if arg != '--no-annotate']
+    if len(args) != 2:
         raise Exception("error: please give an input image name and output file name as a parameter, like this: \n"
-                     "python3 grade.py input.jpg output.txt")
-    process_test(sys.argv[1], sys.argv[2])
\ No newline at end of file
+                     "python3 grade.py input.jpg output.txt [--no-annotate]")
+    grade_scan = process_pages if loader.page_count(args[0]) > 1 else process_test
+    grade_scan(args[0], args[1], annotate=len(args) == len(sys.argv) - 1)
\ No newline at end of file
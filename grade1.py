@@ -1,8 +1,26 @@
 import sys, os
+import math
 import numpy as np
-from utils import pad_image
+import background
+import geometry
+import instrumentation
+import loader
+import morphology
+import result_cache
+import thresholding
+from integral import integral_image, rect_sum, window_sums
 from PIL import Image, ImageFilter, ImageDraw
 
+# in form pixels, see geometry.py
+X_OFFSET, Y_OFFSET = 100, 662 # the answer area, without the header and the side margins
+RECEPTIVE_FIELD = (38, 36)    # rows, columns of an answer box
+SCRIBBLE_OFFSET = 90          # written answers are this far left of the first box
+# below the form resolution the box lines blur into the boxes: at 100 dpi 658/680 test
+# answers are right against 676 at 200 dpi, so sheets are not decoded smaller than it
+MIN_SCALE = 1 - geometry.SNAP
+
+VERSION = 2 # of the recognised answers, bump when a change can alter them (see result_cache.py)
+
 # region functions
 def is_box_present(region, border_thickness, filled_threshold):
     top_border = region[:border_thickness, :]
@@ -17,40 +35,100 @@ def is_box_present(region, border_thickness, filled_threshold):
     else:
         return False
 
+# border test of the receptive field at every centre in one pass over a summed-area
+# table. Returns (present, table): index present with [y - ry//2, x - rx//2]. Rows
+# go down to the bottom of the image, where the field is cut off like the region
+# slice in is_box_present; columns only cover fields fully inside the image. The
+# fill sums are only needed where the walk finds a box and are looked up in the table
+def box_responses(image, receptive_field_shape, border_thickness, filled_threshold):
+    ry, rx = receptive_field_shape
+    height, width = 2 * (ry//2), 2 * (rx//2) # slicing y-ry//2:y+ry//2 gives even sizes
+    sat = integral_image(image, dtype=np.int32)
+    ny, nx = image.shape[0] - height + 1, image.shape[1] - width + 1
+    if nx <= 0:
+        return np.zeros((image.shape[0], 0), dtype=bool), sat
+    present = np.zeros((image.shape[0], nx), dtype=bool)
+
+    if ny > 0:
+        full = present[:ny]
+        rows = window_sums(sat, border_thickness, width) # top and bottom borders
+        full[...] = rows[:ny, :nx] >= filled_threshold
+        full &= rows[height-border_thickness:height-border_thickness+ny, :nx] >= filled_threshold
+        del rows
+        cols = window_sums(sat, height, border_thickness) # left and right borders
+        full &= cols[:ny, :nx] >= filled_threshold
+        full &= cols[:ny, width-border_thickness:width-border_thickness+nx] >= filled_threshold
+        del cols
+
+    # fields cut off by the bottom edge, at most height - 1 rows
+    y_start = np.arange(max(ny, 0), image.shape[0])[:, None]
+    y_end = np.full_like(y_start, image.shape[0])
+    x_start = np.arange(nx)[None, :]
+    clipped = rect_sum(sat, y_start, np.minimum(y_start + border_thickness, y_end), x_start, x_start + width) >= filled_threshold
+    clipped &= rect_sum(sat, np.maximum(y_end - border_thickness, y_start), y_end, x_start, x_start + width) >= filled_threshold
+    clipped &= rect_sum(sat, y_start, y_end, x_start, x_start + border_thickness) >= filled_threshold
+    clipped &= rect_sum(sat, y_start, y_end, x_start + width - border_thickness, x_start + width) >= filled_threshold
+    present[max(ny, 0):] = clipped
+    return present, sat
+
+def lookup_box(image, responses, y, x, receptive_field_shape, border_thickness, filled_threshold):
+    # (box present, region sum) for the receptive field centred at (y, x)
+    present, sat = responses
+    ry, rx = receptive_field_shape
+    i, j = y - ry//2, x - rx//2
+    if 0 <= i < present.shape[0] and 0 <= j < present.shape[1]:
+        if not present[i, j]:
+            return False, 0 # the fill is only looked at for boxes
+        height, width = 2 * (ry//2), 2 * (rx//2)
+        i_end = min(i + height, sat.shape[0] - 1) # cut off by the bottom edge
+        return True, sat[i_end, j+width] - sat[i, j+width] - sat[i_end, j] + sat[i, j]
+    # field clipped by the image edge, fall back to the direct computation
+    region = image[y-ry//2:y+ry//2, x-rx//2:x+rx//2]
+    return is_box_present(region, border_thickness, filled_threshold), region.sum()
+
+def next_box_x(present, y, x, receptive_field_shape, limit, step=4):
+    # the walk along a row looks at x, x+step, x+2*step, ... until it finds a box.
+    # Returns the first of those after x with a box present, or the first one past
+    # limit when there is none, without visiting the positions in between
+    ry, rx = receptive_field_shape
+    i, j = y - ry//2, x - rx//2
+    if i < 0:
+        # the region slice starting at a negative row is empty, no box on this row
+        return x + step * ((limit - x) // step + 1)
+    if i >= present.shape[0]:
+        return x + step # row not covered by the response map, step as before
+    hits = np.flatnonzero(present[i, j + step:limit - rx//2 + 1:step])
+    if len(hits):
+        return x + step * (hits[0] + 1)
+    return x + step * ((limit - x) // step + 1)
+
 # convert list of filled boxes to answers
 def convert_answer_to_text(lst):
     options = ['A','B','C','D','E']
     return ''.join([options[n[2]-1] for n in lst])
 
 # scribbled answers near the box
-def check_scribbled(image, box, receptive_field_shape):
+def scribble_ink(image, box, receptive_field_shape, offset=SCRIBBLE_OFFSET):
     y, x = receptive_field_shape
     px, py = box[1], box[0]
-    px -= 90 
+    px -= offset
     region = image[py-y//2:py+y//2,px-x//2:px+x//2]
-    return region.sum() > 50
+    return region.sum()
 
-# taken from another course assignment (E-535)
+def check_scribbled(image, box, receptive_field_shape, offset=SCRIBBLE_OFFSET, threshold=50):
+    return scribble_ink(image, box, receptive_field_shape, offset) > threshold
+
+# vectorized binary morphology, see morphology.py
 def dilation(image, structure):
-    result = np.zeros_like(image)
-    pad_img = pad_image(image) 
-    for i in range( image.shape[0]):
-        for j in range(image.shape[1]):
-            result[i, j] = np.max(pad_img[i:i+3, j:j+3] & structure)
-    return result
+    return morphology.dilation(image, structure).astype(image.dtype, copy=False)
 
 def erosion(image, structure):
-    result = np.zeros_like(image)
-    pad_img = pad_image(image) 
-    for i in range(image.shape[0]):
-        for j in range(image.shape[1]):
-            result[i, j] = np.min(pad_img[i:i+3, j:j+3] | ~structure)
-    return result
+    return morphology.erosion(image, structure).astype(image.dtype, copy=False)
 
 def opening(image, structure):
-    return dilation(erosion(image, structure), structure) # dialation of erosion
+    return morphology.opening(image, structure, in_place=True).astype(image.dtype, copy=False) # dialation of erosion
 
-def draw_rectangles(draw, boxes, receptive_field_coords, offsets, scribble_box = None):
+def draw_rectangles(draw, boxes, receptive_field_coords, offsets, scribble_box = None, scribble_offset=SCRIBBLE_OFFSET):
     ry, rx = receptive_field_coords
     y_off, x_off = offsets
     for box in boxes:
@@ -60,115 +138,278 @@ def draw_rectangles(draw, boxes, receptive_field_coords, offsets, scribble_box =
         draw.rectangle([upper_left, bottom_right], outline=(0,255,0))
 
     if scribble_box != None:
-        y, x = scribble_box[0], scribble_box[1]-90
+        y, x = scribble_box[0], scribble_box[1]-scribble_offset
         upper_left = (x-rx//2 + x_off, y-ry//2 + y_off)
         bottom_right = (x+rx//2 + x_off, y+ry//2 + y_off)
         draw.rectangle([upper_left, bottom_right], outline=(0,255,0))
-# endregion functions 
 
-def run(image_path, output_path):
-    image = original_image = Image.open(image_path)
-    print(f"Successfully loaded {image_path}")
-    image = image.convert('L')
+# runs on the background writer, see background.py
+def save_marked_image(original_image, marked, receptive_field_coords, offsets, marked_image_path, scribble_offset=SCRIBBLE_OFFSET):
     original_image = original_image.convert('RGB')
+    draw = ImageDraw.Draw(original_image)
+    for filled_boxes, scribble_box in marked:
+        draw_rectangles(draw, filled_boxes, receptive_field_coords, offsets, scribble_box, scribble_offset)
+    original_image.save(marked_image_path)
+# endregion functions 
 
-    # gaussian blur to smooth out the image
-    image = image.filter(ImageFilter.GaussianBlur(radius=1)) 
-    image = np.array(image) # to numpy
-    print("Applied Gaussian blur")
-
-    # thresholding
-    image = np.where(image > 150, 255, 0)
-    print("Applied Thresholding")
+def sheet_geometry(width):
+    # the form pixel constants in pixels of a sheet width pixels wide, see geometry.py
+    scale = geometry.sheet_scale(width, MIN_SCALE)
+    length = lambda pixels: geometry.length(pixels, scale, minimum=1)
+    return {
+        'scale': scale,
+        'offsets': (length(Y_OFFSET), length(X_OFFSET)),
+        'blur_radius': scale, # 1 form pixel
+        'receptive_field': (length(RECEPTIVE_FIELD[0]), length(RECEPTIVE_FIELD[1])),
+        'border_thickness': math.ceil(5 * scale), # the box lines do not get thinner than a pixel
+        'filled_threshold': geometry.area(29, scale),
+        'fill_threshold': geometry.area(500, scale),
+        'scribble_offset': length(SCRIBBLE_OFFSET),
+        'scribble_threshold': geometry.area(50, scale),
+        'box_step': length(50),   # from one box to the next one in a row
+        'row_step': length(40),   # from one question to the next
+        'retry_step': length(2),  # rows skipped when a row scan fails
+        'box_margin': length(2),  # the next question's walk starts this far left of the first box
+        'scan_step': length(4),   # of the walk along a row
+    }
 
-    x_offset = 100
-    y_offset = 662
-    # crop the relevant part of the image containing MCQs
-    image = image[y_offset:,x_offset:-x_offset]//255
+def blur(image, radius, margin):
+    # gaussian blur of a grayscale PIL image, as a numpy array without the margin
+    # added around the crop (the bottom edge has none)
+    image = image.filter(ImageFilter.GaussianBlur(radius=radius))
+    return np.array(image)[margin:, margin:-margin]
 
-    print("Applying Opening, this might take some time")
-    # opening
-    structure = np.array([[0, 1, 0],
-                    [1, 1, 1],
-                    [0, 1, 0]])
-    image = dilation(erosion(image, structure), structure) # dialation of erosion
-    
-    # invert image so the black edges (0) become 1 which simplifies the calculations
-    inverted_img = (1-image)
+def binarize(image, threshold):
+    # boolean image, True where the blurred sheet is lighter than the threshold level
+    return image > thresholding.level(image, threshold, reference=150)
 
-    ry, rx = (38, 36) # receptive field dimensions
+def scan_boxes(inverted_img, responses, form):
+    # (answer strings, (filled boxes, scribble box) per question, confidence margin per
+    # question): the walk along the rows of each column of boxes, see box_responses
+    ry, rx = form['receptive_field']
     col_starts = [int(inverted_img.shape[1]/3) * i for i in range(3)]
     col_width = int(inverted_img.shape[1]/3)
     question_count = 0
     results = ['' for _ in range(85)]
-    
-    draw = ImageDraw.Draw(original_image)
+    margins = [0.0 for _ in range(85)]
+    marked = [] # (filled boxes, scribble box) per question, drawn after the scan
 
-    print("Processing image")
+    border_thickness, filled_threshold = form['border_thickness'], form['filled_threshold']
+    box_step, row_step, retry_step, scan_step = form['box_step'], form['row_step'], form['retry_step'], form['scan_step']
+    present = responses[0]
+    scan_steps = skipped_rows = failed_rows = 0
     # each column of the MCQ sheet
     for ind, start in enumerate(col_starts):
         box_count = 0
         filled_boxes = []
+        fill_sums = [] # of every box found on the row
         current_x = int(ry / 2) + start
         current_y = int(rx / 2)
         boxes = []
+        row_start = True # a new row scan starts at current_x
+        # last centre index a row scan of this column can visit
+        scan_end = start + col_width - rx - rx//2
+        limit = start + col_width - rx - 1 # a row scan fails once current_x passes it
 
         # each box in the column
         while True:
-            region = inverted_img[current_y-ry//2:current_y+ry//2, current_x-rx//2:current_x+rx//2]
-            box_present = is_box_present(region, border_thickness=5, filled_threshold=29) 
+            if current_y - ry//2 >= inverted_img.shape[0]:
+                raise ValueError(f"Could not find all answer boxes in column {ind + 1}.")
+
+            row = current_y - ry//2
+            if row_start:
+                row_start = False
+                if (0 <= row < present.shape[0] and 0 <= current_x - rx//2 and scan_end <= present.shape[1]
+                        and np.count_nonzero(present[row, current_x - rx//2:scan_end]) < 5):
+                    # fewer than 5 boxes on the rest of this row, the scan would fail
+                    current_x = int(rx / 2) + start
+                    current_y += retry_step
+                    row_start = True
+                    skipped_rows += 1
+                    continue
+
+            scan_steps += 1
+            box_present, region_sum = lookup_box(inverted_img, responses, current_y, current_x, (ry, rx), border_thickness, filled_threshold)
             #print(current_y-ry//2, current_y+ry//2, current_x-rx//2, current_x+rx//2, box_present)
             if box_present: 
                 boxes.append((current_y,current_x))
                 box_count += 1
+                fill_sums.append(region_sum)
 
-                if region.sum() > 500:
+                if region_sum > form['fill_threshold']:
                     filled_boxes.append((current_y, current_x, box_count))
-                current_x += 50
+                current_x += box_step
             else:
-                current_x += 4
+                current_x = next_box_x(present, current_y, current_x, (ry, rx), limit, scan_step)
 
             # Failure case 
-            if current_x > start + col_width - rx - 1 and box_count < 5:
+            if current_x > limit and box_count < 5:
+                failed_rows += 1
+                row_start = True
                 current_x = int(rx / 2) + start
-                current_y += 2
+                current_y += retry_step
                 box_count = 0
                 filled_boxes = []
+                fill_sums = []
                 boxes = []
 
             # Success case
-            if box_count == 5 or current_x > start + col_width - rx - 1:
-                scribbled = "x" if check_scribbled(inverted_img, boxes[0], (ry,rx)) else ""
+            if box_count == 5 or current_x > limit:
+                ink = scribble_ink(inverted_img, boxes[0], (ry,rx), form['scribble_offset'])
+                scribbled = "x" if ink > form['scribble_threshold'] else ""
                 results[question_count] = convert_answer_to_text(filled_boxes) + scribbled
-                draw_rectangles(draw, filled_boxes, (ry, rx), (y_offset, x_offset), boxes[0] if scribbled == "x" else None)
+                # confidence: how far the closest box sum and the scribble area are from their thresholds, relative to them
+                margins[question_count] = float(min([abs(fill - form['fill_threshold']) / form['fill_threshold'] for fill in fill_sums] +
+                                                    [abs(ink - form['scribble_threshold']) / form['scribble_threshold']]))
+                marked.append((filled_boxes, boxes[0] if scribbled == "x" else None))
                 question_count += 1
                 box_count = 0
                 filled_boxes = []
-                current_x = boxes[0][1]-2
-                current_y += 40
+                fill_sums = []
+                current_x = boxes[0][1]-form['box_margin']
+                current_y += row_step
                 boxes = []
+                row_start = True
 
             # exit condition
             if (ind == 0 and question_count == 29) or (ind == 1 and question_count == 58) or (ind == 2 and question_count) == 85: break
                 
+    instrumentation.count('grade1.scan_steps', scan_steps)
+    instrumentation.count('grade1.skipped_rows', skipped_rows)
+    instrumentation.count('grade1.failed_rows', failed_rows)
+    return results, marked, margins
+
+def scan_answers(original_image, timer, threshold=150):
+    # (answer strings, (filled boxes, scribble box) per question, sheet_geometry, confidence margin
+    # per question) of a PIL sheet image
+    # crop the relevant part of the image containing MCQs before converting it. The
+    # margin keeps the blur at the crop edges the same as on the full image
+    margin = 4
+    width, height = original_image.size
+    form = sheet_geometry(width)
+    y_offset, x_offset = form['offsets']
+    image = original_image.crop((x_offset - margin, y_offset - margin, width - x_offset + margin, height))
+    image = image.convert('L')
+    timer.lap('load')
+
+    # gaussian blur to smooth out the image
+    image = blur(image, form['blur_radius'], margin)
+    print("Applied Gaussian blur")
+    timer.lap('blur')
+
+    # thresholding, white (1) and black (0) pixels. threshold is a number or one of thresholding.METHODS
+    image = binarize(image, threshold)
+    print("Applied Thresholding")
+    timer.lap('threshold')
+
+    print("Applying Opening")
+    # opening
+    structure = np.array([[0, 1, 0],
+                    [1, 1, 1],
+                    [0, 1, 0]])
+    image = opening(image, structure)
+    timer.lap('opening')
+    
+    # invert image so the black edges (0) become 1 which simplifies the calculations
+    inverted_img = ~image
+
+    ry, rx = form['receptive_field']
+    print("Processing image")
+    responses = box_responses(inverted_img, (ry, rx), form['border_thickness'], form['filled_threshold'])
+    timer.lap('box_responses')
+    results, marked, margins = scan_boxes(inverted_img, responses, form)
     print("Finished processing the image.")
+    timer.lap('scan')
+    return results, marked, form, margins
 
+def write_answers(results, output_path):
     with open(output_path, 'w') as f:
         for i, ans in enumerate(results, start=1):
             f.write(f"{i} {ans}\n")
 
-    marked_image_path = os.path.splitext(output_path)[0] + '_scored.jpg'
-    original_image.save(marked_image_path)
-    print(f"Successfully saved marked image at: {marked_image_path}")
+def grade_image(original_image, output_path, timer, annotate=True, threshold=150):
+    results, marked, form, _ = scan_answers(original_image, timer, threshold)
+    write_answers(results, output_path)
+
+    if annotate:
+        marked_image_path = os.path.splitext(output_path)[0] + '_scored.jpg'
+        background.submit(save_marked_image, original_image, marked, form['receptive_field'], form['offsets'], marked_image_path,
+                          form['scribble_offset'])
+        print(f"Saving marked image at: {marked_image_path}")
 
     print(f"Sucessfully saved output at: {output_path}")
+    timer.lap('output')
+    return results
+
+def answers_from_image(image, threshold=150, reduce=1):
+    # answer strings ('A', 'BD', 'Cx', ...) of a sheet in memory: a uint8 array (grayscale,
+    # or BGR) or the encoded image in a bytes/memoryview buffer. Nothing is read from or
+    # written to disk; answers_from_pages for a multi-page TIFF buffer.
+    # reduce > 1 recognises the sheet at 1/reduce of its resolution, see loader.py
+    return answers_and_margins(image, threshold, reduce)[0]
+
+def answers_and_margins(image, threshold=150, reduce=1):
+    # (answer strings, confidence margin per question) of a sheet in memory, like answers_from_image.
+    # See scan_answers for the margins, cascade.py re-reads the questions with small ones
+    loader.single_page(image, 'grade1.pages_and_margins')
+    image = loader.open_image(image)
+    return page_answers(loader.reduced(image, loader.supported_reduce(image, reduce, MIN_SCALE)), threshold)
+
+def answers_from_pages(image, threshold=150, reduce=1):
+    # {page index: answer strings} of a scan in memory or a path, a multi-page TIFF page by page
+    return {index: answers for index, (answers, _) in pages_and_margins(image, threshold, reduce).items()}
+
+def pages_and_margins(image, threshold=150, reduce=1):
+    # {page index: (answer strings, margins)}, like answers_and_margins per page
+    return {index: page_answers(loader.reduced(page, loader.supported_reduce(page, reduce, MIN_SCALE)), threshold)
+            for index, page in loader.iter_pages(image)}
+
+def page_answers(image, threshold=150):
+    # (answer strings, confidence margin per question) of a PIL sheet image
+    results, _, _, margins = scan_answers(image, instrumentation.laps('grade1'), threshold)
+    return results, margins
+
+def run(image_path, output_path, annotate=True, threshold=150, reduce=1, cache_dir=None):
+    # answers of a single page scan, run_pages for a multi-page TIFF
+    if cache_dir is not None:
+        # answers of an identical scan graded before with the same settings, see result_cache.py
+        return result_cache.cached_run(image_path, output_path, 'grade1', VERSION, {'threshold': threshold, 'reduce': reduce},
+                                       lambda: run(image_path, output_path, annotate, threshold, reduce),
+                                       write_answers, cache_dir, use_stored=not annotate)
+    loader.single_page(image_path, 'grade1.run_pages')
+    timer = instrumentation.laps('grade1')
+    original_image = Image.open(image_path)
+    original_image = loader.reduced(original_image, loader.supported_reduce(original_image, reduce, MIN_SCALE))
+    original_image.load() # decoded once, the colour copy for the marked image is made at the end
+    print(f"Successfully loaded {image_path}")
+    return grade_image(original_image, output_path, timer, annotate, threshold)
+
+def run_pages(image_path, output_path, annotate=True, threshold=150, reduce=1, cache_dir=None):
+    # multi-page scan (TIFF): {page index: answers}, one page decoded at a time and
+    # written to its own answer file, see loader.page_path
+    if cache_dir is not None:
+        return result_cache.cached_run(image_path, output_path, 'grade1', VERSION, {'threshold': threshold, 'reduce': reduce, 'pages': True},
+                                       lambda: run_pages(image_path, output_path, annotate, threshold, reduce),
+                                       write_answers, cache_dir, use_stored=not annotate)
+    results = {}
+    for index, page in loader.iter_pages(image_path):
+        timer = instrumentation.laps('grade1')
+        page = loader.reduced(page, loader.supported_reduce(page, reduce, MIN_SCALE))
+        page.load()
+        print(f"Successfully loaded page {index} of {image_path}")
+        if annotate:
+            page = page.copy() # the marked image is drawn after the next page is decoded into the same image
+        results[index] = grade_image(page, loader.page_path(output_path, index), timer, annotate, threshold)
+    return results
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python grade1.py <path/to/source_image.jpg> <path/to/output_file.txt>")
+    args = [arg for arg in sys.argv[1:] if arg != '--no-annotate']
+    if len(args) != 2:
+        print("Usage: python grade1.py <path/to/source_image.jpg> <path/to/output_file.txt> [--no-annotate]")
         sys.exit(1)
 
-    if not os.path.exists(sys.argv[1]):
-        raise FileExistsError(f"{sys.argv[1]} - path does not exist.")
+    if not os.path.exists(args[0]):
+        raise FileExistsError(f"{args[0]} - path does not exist.")
 
-    run(sys.argv[1], sys.argv[2])
+    grade_scan = run_pages if loader.page_count(args[0]) > 1 else run
+    grade_scan(args[0], args[1], annotate=len(args) == len(sys.argv) - 1)
@@ -1,106 +1,161 @@
 import numpy as np
 import os, sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from utils import read_answers, get_question_ordering
+import loader
 
-def run(source, answers_file, output_file):
-    print(f"Source Image: {source}")
-    print(f"Answers File: {answers_file}")
-    print(f"Output File: {output_file}")
+# region funtions
+def jumble_answers(answers, ordering):
+    jumbled_answers = [''] * len(answers)
 
-    # region funtions
-    def jumble_answers(answers, ordering):
-        jumbled_answers = [''] * len(answers)
+    for i, order in enumerate(ordering):
+        jumbled_answers[order] = answers[i]
+    
+    return jumbled_answers
+
+def encode_question(answers):
+    # 5-bit binary for 5 options (A-E)
+    binary_sequence = ['0'] * 5
 
-        for i, order in enumerate(ordering):
-            jumbled_answers[order] = answers[i]
-        
-        return jumbled_answers
+    for answer in answers:
+        index = ord(answer) - ord('A')  # letter to index (A=0, B=1, C=2, etc.)
+        binary_sequence[index] = '1'
     
-    def encode_question(answers):
-        # 5-bit binary for 5 options (A-E)
-        binary_sequence = ['0'] * 5
-
-        for answer in answers:
-            index = ord(answer) - ord('A')  # letter to index (A=0, B=1, C=2, etc.)
-            binary_sequence[index] = '1'
-        
-        return binary_sequence
-
-    def calculate_questions_per_row(image_width, num_questions, w=2, g=4, side_padding=20):
-        # w for one question encoding + gap
-        question_width = (w*5) + g
-
-        available_width = image_width - 2*side_padding - 3*w - g*w  
-
-        questions_per_row = available_width // question_width
-        return min(questions_per_row, num_questions), question_width
-
-    def embed_barcode(image_array, answers, h=10, w=2, g=4, side_padding=20, bottom_padding=10):
-        num_questions = len(answers)
-        questions_per_row, _ = calculate_questions_per_row(image_array.shape[1], num_questions, w, g, side_padding)
-
-        if questions_per_row == 0:
-            raise ValueError("Image too narrow to encode answers.")
-        
-        rows_needed = np.ceil(num_questions / questions_per_row).astype(int)
-        #if rows_needed > 3:
-        #    raise ValueError("Too many questions to fit in the allowed number of rows.")
-        
-        # barcode area
-        barcode_height = rows_needed * h + bottom_padding
-        barcode_array = np.full((barcode_height, image_array.shape[1]), 255, dtype=np.uint8)  # White background
-        
-        for row in range(rows_needed):
-            start_y = barcode_height - bottom_padding - (row + 1) * h  # Y position for the current row
-            
-            # add alignment bars 
-            for i in range(3):
-                x_position = side_padding + i * (w + g)
-                barcode_array[start_y:start_y+h, x_position:x_position+w] = 0  # black = 0
-            
-            x_offset = side_padding + (3 * (w + g))  # Starting X position for encoded answers after the alignment bars and gaps
-            
-            for q in range(questions_per_row):
-                ind = row * questions_per_row + q
-                if ind >= num_questions:
-                    break
-                answer = answers[ind]
-                #print(question_ordering[idx], answer)
-                encoded_answer = encode_question(answer)
-                for _, bit in enumerate(encoded_answer):
-                    if bit == '1':
-                        barcode_array[start_y:start_y+h, x_offset:x_offset + w] = 0  # Black bar for '1'
-                    x_offset += w
-                x_offset += g
-        
-        # Embed the barcode into the original image
-        embedding_start = image_array.shape[0] - barcode_height
-        image_array[embedding_start:, :] = barcode_array
-        
-        return image_array
-    # endregion functions
+    return binary_sequence
 
-    question_ordering = get_question_ordering()
+def encode_answers(answers):
+    # (num_questions, 5) bit matrix, one row of encode_question per question
+    bits = np.zeros((len(answers), 5), dtype=bool)
+    for q, answer in enumerate(answers):
+        bits[q] = [bit == '1' for bit in encode_question(answer)]
+    return bits
 
-    answers = read_answers(answers_file) 
-    answers = jumble_answers(answers, question_ordering)
+def calculate_questions_per_row(image_width, num_questions, w=2, g=4, side_padding=20):
+    # w for one question encoding + gap
+    question_width = (w*5) + g
+
+    available_width = image_width - 2*side_padding - 3*w - g*w  
+
+    questions_per_row = available_width // question_width
+    return min(questions_per_row, num_questions), question_width
 
-    image = Image.open(source).convert('L')
-    if image is not None: print(f"Successfully opened {source}, processing further . . .")
-    image = np.array(image)
+def render_barcode(bits, image_width, h=10, w=2, g=4, side_padding=20, bottom_padding=10):
+    # barcode area for the bit matrix, white (255) background and black (0) bars
+    num_questions = len(bits)
+    questions_per_row, question_width = calculate_questions_per_row(image_width, num_questions, w, g, side_padding)
+
+    if questions_per_row == 0:
+        raise ValueError("Image too narrow to encode answers.")
+    
+    rows_needed = np.ceil(num_questions / questions_per_row).astype(int)
+    #if rows_needed > 3:
+    #    raise ValueError("Too many questions to fit in the allowed number of rows.")
+
+    # one pixel row per barcode row, bottom barcode row first
+    profiles = np.full((rows_needed, image_width), 255, dtype=np.uint8)
+
+    # add alignment bars
+    alignment_cols = side_padding + np.arange(3)[:, None] * (w + g) + np.arange(w)
+    profiles[:, alignment_cols.ravel()] = 0  # black = 0
+
+    # column of every pixel of every bar: question start + option * w + pixel
+    x_offset = side_padding + (3 * (w + g))  # Starting X position for encoded answers after the alignment bars and gaps
+    cols = (x_offset + np.arange(questions_per_row)[:, None, None] * question_width
+            + np.arange(5)[None, :, None] * w + np.arange(w)[None, None, :])
+    padded_bits = np.zeros((rows_needed * questions_per_row, 5), dtype=bool)
+    padded_bits[:num_questions] = bits
+    bars = np.repeat(padded_bits.reshape(rows_needed, questions_per_row, 5, 1), w, axis=3)
+    profiles[:, cols.ravel()] = np.where(bars.reshape(rows_needed, -1), 0, 255)  # Black bar for '1'
+
+    # stretch every profile to h pixels, top barcode row first, then the bottom padding
+    barcode_array = np.full((rows_needed * h + bottom_padding, image_width), 255, dtype=np.uint8)  # White background
+    barcode_array[:rows_needed * h] = np.repeat(profiles[::-1], h, axis=0)
+    return barcode_array
+
+def embed_barcode(image_array, answers, h=10, w=2, g=4, side_padding=20, bottom_padding=10):
+    barcode_array = render_barcode(encode_answers(answers), image_array.shape[1], h, w, g, side_padding, bottom_padding)
+
+    # Embed the barcode into the original image
+    embedding_start = image_array.shape[0] - barcode_array.shape[0]
+    image_array[embedding_start:, :] = barcode_array
+    
+    return image_array
+# endregion functions
+
+def inject_image(image, answers):
+    # copy of a sheet in memory with the answers barcode at the bottom. image is a uint8
+    # array (grayscale, or BGR) or the encoded image in a bytes/memoryview buffer,
+    # answers holds the options of every question in order ('A', 'BD', ...).
+    # Returns the grayscale uint8 array, nothing is read from or written to disk
+    if isinstance(image, np.ndarray):
+        image = loader.as_gray(image).copy() # the caller's frame is left as it is
+    else:
+        image = np.array(loader.open_image(image).convert('L'))
+    answers = jumble_answers([list(answer) for answer in answers], get_question_ordering())
+    return embed_barcode(image, answers, h=20, w=5, g=10, side_padding=20, bottom_padding=10)
 
-    modified_image = embed_barcode(image, answers, h=20, w=5, g=10, side_padding=20, bottom_padding=10)
+def run(source, answers_file, output_file):
+    print(f"Source Image: {source}")
+    print(f"Answers File: {answers_file}")
+    print(f"Output File: {output_file}")
+
+    answers = read_answers(answers_file) 
+    with open(source, 'rb') as f:
+        image = f.read()
+    print(f"Successfully opened {source}, processing further . . .")
+
+    modified_image = inject_image(image, answers)
     image = Image.fromarray(modified_image)
 
     print("Successfully embedded the answers barcode into the provdided image, Saving . . .")
     image.save(output_file)
     print(f"Sucessfully saved output image at: {output_file}")
 
+def run_batch(source, answers_files, output_dir, workers=None):
+    # one template image, one output image per answers file. The template is
+    # decoded once; every writer thread keeps its own copy of it and only the
+    # barcode band is rewritten between outputs
+    print(f"Source Image: {source}")
+    print(f"Answers Files: {len(answers_files)}")
+    print(f"Output Directory: {output_dir}")
+
+    question_ordering = get_question_ordering()
+    template = np.array(Image.open(source).convert('L'))
+    print(f"Successfully opened {source}, processing further . . .")
+    os.makedirs(output_dir, exist_ok=True)
+    extension = os.path.splitext(source)[1] or '.png'
+    buffers = threading.local()
+
+    def inject_one(answers_file):
+        if not hasattr(buffers, 'image'):
+            buffers.image = template.copy()
+        answers = jumble_answers(read_answers(answers_file), question_ordering)
+        modified_image = embed_barcode(buffers.image, answers, h=20, w=5, g=10, side_padding=20, bottom_padding=10)
+        output_file = os.path.join(output_dir, os.path.splitext(os.path.basename(answers_file))[0] + extension)
+        Image.fromarray(modified_image).save(output_file)
+        return output_file
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for output_file in executor.map(inject_one, answers_files):
+            print(f"Successfully saved output image at: {output_file}")
+
 
 if __name__ == "__main__":
+    if len(sys.argv) >= 5 and sys.argv[1] == '--batch':
+        # python inject.py --batch source_image.jpg output_dir answers1.txt answers2.txt ...
+        if not os.path.exists(sys.argv[2]):
+            raise FileExistsError(f"{sys.argv[2]} - path does not exist.")
+        for answers_file in sys.argv[4:]:
+            if not os.path.exists(answers_file):
+                raise FileExistsError(f"{answers_file} - path does not exist.")
+        run_batch(sys.argv[2], sys.argv[4:], sys.argv[3])
+        sys.exit(0)
+
     if len(sys.argv) != 4:
         print("Usage: python inject.py <path/to/source_image.jpg> <path/to/answers.txt> <path/to/output_image.jpg>")
+        print("       python inject.py --batch <path/to/source_image.jpg> <path/to/output_dir> <path/to/answers.txt> ...")
         sys.exit(1)
 
     if not os.path.exists(sys.argv[1]):
@@ -0,0 +1,194 @@
+import atexit
+import json
+import os
+import re
+import sys
+import time
+try:
+    import fcntl
+except ImportError: # Windows: appends to a .prom file are not locked
+    fcntl = None
+
+# Opt-in stage timers and counters for the grading pipelines. Disabled by
+# default: span() and laps() then hand out a shared no-op object and count()
+# returns after one flag check, so the hooks can stay in the hot paths.
+#
+# Enable with enable(), or for plain CLI runs by pointing GRADE_METRICS at a
+# .jsonl or .prom file; one record per process is added there at exit (a line
+# of the .jsonl file, or to the histograms and counters of the .prom file).
+
+METRICS_ENV = 'GRADE_METRICS'
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+enabled = False
+spans = {}    # name -> total seconds
+counters = {} # name -> value
+
+# region functions
+class NullTimer:
+    # stands in for Span and Laps while instrumentation is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def lap(self, name):
+        pass
+
+NULL_TIMER = NullTimer()
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+class Laps:
+    # times consecutive steps of a linear function without re-indenting it:
+    # every lap(name) records the time since the previous lap under prefix.name
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        add_time(f"{self.prefix}.{name}", now - self.last)
+        self.last = now
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def span(name):
+    return Span(name) if enabled else NULL_TIMER
+
+def laps(prefix):
+    return Laps(prefix) if enabled else NULL_TIMER
+
+def add_time(name, seconds):
+    spans[name] = spans.get(name, 0.0) + seconds
+
+def count(name, value=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + int(value)
+
+def reset():
+    spans.clear()
+    counters.clear()
+
+def snapshot(**labels):
+    # the spans and counters recorded since the last reset, as one record
+    return dict(labels, spans=dict(spans), counters=dict(counters))
+
+def write_jsonl(records, path, mode='w'):
+    with open(path, mode) as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+def prometheus_totals(records):
+    # ({stage: [bucket counts..., +Inf count, sum]}, {counter: total}) over the records. Every
+    # value is a sum over records, so the totals of two sets of records add up
+    stages = {}
+    for record in records:
+        for stage, seconds in record['spans'].items():
+            totals = stages.setdefault(stage, [0] * (len(SECONDS_BUCKETS) + 2))
+            for i, bucket in enumerate(SECONDS_BUCKETS):
+                totals[i] += seconds <= bucket
+            totals[-2] += 1
+            totals[-1] += seconds
+    counter_totals = {}
+    for record in records:
+        for name, value in record['counters'].items():
+            counter_totals[name] = counter_totals.get(name, 0) + value
+    return stages, counter_totals
+
+def read_prometheus(path, prefix='grading'):
+    # the totals of a file written by prometheus_text
+    stages, counter_totals = {}, {}
+    buckets = [str(bucket) for bucket in SECONDS_BUCKETS] + ['+Inf']
+    with open(path, 'r') as f:
+        for line in f:
+            match = re.match(r'(\w+)\{(.*)\} (\S+)$', line.strip())
+            if match is None:
+                continue # comments
+            name, labels, value = match.group(1), dict(re.findall(r'(\w+)="([^"]*)"', match.group(2))), float(match.group(3))
+            if name == f"{prefix}_events_total":
+                counter_totals[labels['event']] = int(value) if value.is_integer() else value
+            elif name.startswith(f"{prefix}_stage_seconds_"):
+                totals = stages.setdefault(labels['stage'], [0] * (len(SECONDS_BUCKETS) + 2))
+                if name.endswith('_bucket') and labels.get('le') in buckets:
+                    totals[buckets.index(labels['le'])] = int(value)
+                elif name.endswith('_sum'):
+                    totals[-1] = value
+    return stages, counter_totals
+
+def add_totals(totals, more):
+    stages, counter_totals = totals
+    for stage, values in more[0].items():
+        stages[stage] = [a + b for a, b in zip(stages.get(stage, [0] * len(values)), values)]
+    for name, value in more[1].items():
+        counter_totals[name] = counter_totals.get(name, 0) + value
+    return stages, counter_totals
+
+def prometheus_text(records, prefix='grading', totals=None):
+    # stage durations as histograms over all records, counters summed. totals, as
+    # returned by read_prometheus, are added to those of the records
+    stages, counter_totals = prometheus_totals(records)
+    if totals is not None:
+        stages, counter_totals = add_totals(totals, (stages, counter_totals))
+    lines = []
+    if stages:
+        lines.append(f"# HELP {prefix}_stage_seconds Wall time of a pipeline stage per sheet.")
+        lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+    for stage in sorted(stages):
+        values = stages[stage]
+        for bucket, count in zip(SECONDS_BUCKETS, values):
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bucket}"}} {count}')
+        lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {values[-2]}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {values[-1]}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {values[-2]}')
+
+    if counter_totals:
+        lines.append(f"# HELP {prefix}_events_total Pipeline event counters.")
+        lines.append(f"# TYPE {prefix}_events_total counter")
+    for name in sorted(counter_totals):
+        lines.append(f'{prefix}_events_total{{event="{name}"}} {counter_totals[name]}')
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(records, path, mode='w'):
+    # .prom files get the Prometheus text format, anything else JSON lines. With mode 'a'
+    # the records are added to the histograms and counters already in a .prom file
+    if path.endswith('.prom'):
+        # parallel CLI runs append to the same file, the read and the write happen under a lock
+        with open(f"{path}.lock", 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = read_prometheus(path) if mode == 'a' and os.path.exists(path) else None
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(prometheus_text(records, totals=totals))
+            os.replace(tmp_path, path)
+    else:
+        write_jsonl(records, path, mode)
+
+def write_at_exit(path):
+    # one record for the whole process, appended so per-sheet CLI runs accumulate
+    record = snapshot(pid=os.getpid(), argv=' '.join(sys.argv))
+    if record['spans'] or record['counters']:
+        write_metrics([record], path, mode='a')
+# endregion functions
+
+if os.environ.get(METRICS_ENV):
+    enable()
+    atexit.register(write_at_exit, os.environ[METRICS_ENV])
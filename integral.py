@@ -0,0 +1,31 @@
+import numpy as np
+
+# Summed-area tables: after one cumulative sum pass the sum of any axis aligned
+# rectangle is 4 lookups, for one rectangle or for a whole grid of them at once.
+
+# region functions
+def integral_image(img, dtype=np.int64):
+    # (h+1, w+1) table with a leading row/column of zeros, so that
+    # sat[y, x] == img[:y, :x].sum()
+    sat = np.zeros((img.shape[0] + 1, img.shape[1] + 1), dtype=dtype)
+    np.cumsum(img, axis=0, dtype=dtype, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+def slice_bound(index, size):
+    index = np.asarray(index)
+    return np.clip(np.where(index < 0, index + size, index), 0, size)
+
+def rect_sum(sat, y_start, y_end, x_start, x_end):
+    # sum of img[y_start:y_end, x_start:x_end], accepts scalars or arrays.
+    # Bounds follow numpy slicing: negative ones count from the end, all are clipped
+    height, width = sat.shape[0] - 1, sat.shape[1] - 1
+    y_start, y_end = slice_bound(y_start, height), slice_bound(y_end, height)
+    x_start, x_end = slice_bound(x_start, width), slice_bound(x_end, width)
+    y_end, x_end = np.maximum(y_end, y_start), np.maximum(x_end, x_start)
+    return sat[y_end, x_end] - sat[y_start, x_end] - sat[y_end, x_start] + sat[y_start, x_start]
+
+def window_sums(sat, height, width):
+    # sums of every height x width window, indexed by the window's top left pixel
+    return sat[height:, width:] - sat[:-height, width:] - sat[height:, :-width] + sat[:-height, :-width]
+# endregion functions
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import re
+import numpy as np
+import instrumentation
+import thresholding
+
+# Every sheet of a session is the same printed form, so the box grid is detected
+# once on a reference sheet and saved as a template. Later sheets only estimate
+# how far (and how much scaled) they are from the template by cross-correlating
+# dark pixel projection profiles, which is much cheaper than detecting lines.
+
+CACHE_DIR = 'layout_cache'
+
+# region functions
+def dark_profiles(img, dark_threshold=100):
+    # number of dark pixels in every column and in every row
+    if len(img.shape) == 3:
+        img = np.mean(img, axis=-1)
+    dark = img < thresholding.level(img, dark_threshold, reference=100)
+    return dark.sum(axis=0).astype(float), dark.sum(axis=1).astype(float)
+
+def align_profile(template, profile, max_shift=60, scales=np.linspace(0.97, 1.03, 13)):
+    # find (scale, shift) so that profile[scale * u + shift] ~ template[u].
+    # returns scale, shift and the correlation coefficient at that offset
+    positions = np.arange(len(profile))
+    centered = profile - profile.mean()
+    best_scale, best_shift, best_score = 1.0, 0, -np.inf
+    for scale in scales:
+        scaled = np.interp(positions / scale, np.arange(len(template)), template, left=0, right=0)
+        scaled -= scaled.mean()
+        correlation = np.correlate(centered, scaled, mode='full') # index len-1 is shift 0
+        lags = correlation[len(scaled) - 1 - max_shift:len(scaled) + max_shift]
+        shift = int(np.argmax(lags)) - max_shift
+        if lags[shift + max_shift] > best_score:
+            best_scale, best_shift, best_score = scale, shift, lags[shift + max_shift]
+
+    scaled = np.interp(positions / best_scale, np.arange(len(template)), template, left=0, right=0)
+    a = scaled[max(0, -best_shift):len(scaled) - max(0, best_shift)]
+    b = profile[max(0, best_shift):len(profile) - max(0, -best_shift)]
+    confidence = np.corrcoef(a, b)[0, 1] if a.std() > 0 and b.std() > 0 else 0.0
+    return float(best_scale), best_shift, float(confidence)
+
+def template_path(form_id, shape, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f"{form_id}_{shape[1]}x{shape[0]}.json")
+
+def form_digest(form_id, cache_dir=CACHE_DIR):
+    # SHA-256 of the form's templates (one per sheet size), None before the first sheet
+    # of the form is detected. Answers read with a template depend on it, see result_cache.py
+    pattern = re.compile(re.escape(form_id) + r'_\d+x\d+\.json')
+    try:
+        names = sorted(name for name in os.listdir(cache_dir) if pattern.fullmatch(name))
+    except FileNotFoundError:
+        return None
+    if not names:
+        return None
+    digest = hashlib.sha256()
+    for name in names:
+        with open(os.path.join(cache_dir, name), 'rb') as f:
+            digest.update(name.encode() + b'\0' + f.read())
+    return digest.hexdigest()
+
+def save_template(path, vertical_lines, question_boxes, profiles):
+    template = {
+        'vertical_lines': [int(x) for x in vertical_lines],
+        'question_boxes': [[int(v) for v in box] for box in question_boxes],
+        'column_profile': profiles[0].astype(int).tolist(),
+        'row_profile': profiles[1].astype(int).tolist(),
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # write then rename, so parallel workers never read a half written template
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(template, f)
+    os.replace(tmp_path, path)
+    return template
+
+def load_template(path):
+    with open(path, 'r') as f:
+        template = json.load(f)
+    template['column_profile'] = np.array(template['column_profile'], dtype=float)
+    template['row_profile'] = np.array(template['row_profile'], dtype=float)
+    return template
+
+def apply_offsets(template, x_offset, y_offset):
+    # move the template grid onto the current sheet. Box x ranges are fixed
+    # fractions of the image width in grade.get_question_boxes so only y moves
+    x_scale, x_shift = x_offset
+    y_scale, y_shift = y_offset
+    vertical_lines = [int(round(x * x_scale + x_shift)) for x in template['vertical_lines']]
+    question_boxes = [(int(round(y_top * y_scale + y_shift)), int(round(y_bottom * y_scale + y_shift)), x_left, x_right)
+                      for y_top, y_bottom, x_left, x_right in template['question_boxes']]
+    return vertical_lines, question_boxes
+
+def get_layout(img, detect, form_id='default', cache_dir=CACHE_DIR, min_confidence=0.5):
+    # returns (vertical_lines, question_boxes, confidence). detect(img) is the full
+    # detection returning (vertical_lines, question_boxes); it runs for the first
+    # sheet of a form and whenever the alignment confidence is below min_confidence
+    path = template_path(form_id, img.shape, cache_dir)
+    profiles = dark_profiles(img)
+
+    if not os.path.exists(path):
+        instrumentation.count('layout.templates_created')
+        vertical_lines, question_boxes = detect(img)
+        save_template(path, vertical_lines, question_boxes, profiles)
+        return vertical_lines, question_boxes, 1.0
+
+    template = load_template(path)
+    x_scale, x_shift, x_confidence = align_profile(template['column_profile'], profiles[0])
+    y_scale, y_shift, y_confidence = align_profile(template['row_profile'], profiles[1])
+    confidence = min(x_confidence, y_confidence)
+    if confidence < min_confidence:
+        instrumentation.count('layout.redetections')
+        vertical_lines, question_boxes = detect(img)
+        return vertical_lines, question_boxes, confidence
+
+    instrumentation.count('layout.template_hits')
+    vertical_lines, question_boxes = apply_offsets(template, (x_scale, x_shift), (y_scale, y_shift))
+    return vertical_lines, question_boxes, confidence
+# endregion functions
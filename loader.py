@@ -0,0 +1,181 @@
+import io
+import os
+import numpy as np
+import geometry
+
+# One decode per sheet, straight to 8-bit grayscale. The pipelines only look at
+# the answer area below the header, so the crop is returned as a view of the
+# decoded image. The colour image is decoded separately and only when annotated
+# output is written, after the recognition intermediates have been freed.
+#
+# Multi-page TIFFs (one file per batch from the sheet feeders) are read page by
+# page with PIL: only the page being graded is decoded, and every page is
+# graded into its own answer file, <output>_page<index>.txt.
+#
+# Sheets already in memory (frames from a scanning service) are accepted as a
+# uint8 array, grayscale or BGR like cv2 decodes them, or as the encoded file in
+# a bytes/memoryview buffer. Arrays are used as they are and buffers are decoded
+# straight from memory, nothing goes through a temporary file.
+#
+# Every loader takes a reduce factor (1, 2, 4 or 8) for recognising a sheet at
+# a fraction of its resolution, see geometry.py. JPEGs are then decoded straight
+# at the smaller size (cv2 IMREAD_REDUCED_*, PIL draft), other formats and
+# arrays are shrunk by averaging after decoding.
+#
+# cv2 and PIL take a few hundred milliseconds to import, so they are imported by
+# the functions that use them: grade.py decodes with cv2 and only needs PIL for
+# TIFFs, grade1.py and extract.py decode with PIL and never need cv2 for a file.
+
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*') # little and big endian
+GRAY_FLAGS = {1: 'IMREAD_GRAYSCALE', 2: 'IMREAD_REDUCED_GRAYSCALE_2',
+              4: 'IMREAD_REDUCED_GRAYSCALE_4', 8: 'IMREAD_REDUCED_GRAYSCALE_8'} # cv2 imread flags
+COLOR_FLAGS = {1: 'IMREAD_COLOR', 2: 'IMREAD_REDUCED_COLOR_2',
+               4: 'IMREAD_REDUCED_COLOR_4', 8: 'IMREAD_REDUCED_COLOR_8'}
+
+# region functions
+def crop(img, y_offset=0, x_offset=0):
+    # view of img without the first y_offset rows and x_offset columns on either side
+    if x_offset:
+        return img[y_offset:, x_offset:-x_offset]
+    return img[y_offset:]
+
+def read(path, flags):
+    import cv2
+    img = cv2.imread(path, flags)
+    if img is None:
+        raise FileNotFoundError(f"Could not read image {path}.")
+    return img
+
+def check_reduce(reduce, flags=GRAY_FLAGS):
+    if reduce not in flags:
+        raise ValueError(f"Unknown reduce factor {reduce}, expected one of {tuple(flags)}.")
+    return flags[reduce]
+
+def read_flags(flags, reduce):
+    import cv2
+    return getattr(cv2, check_reduce(reduce, flags))
+
+def load_gray(path, y_offset=0, x_offset=0, reduce=1):
+    # uint8 (h, w) view of the cropped sheet, decoded at 1/reduce of its size
+    return crop(read(path, read_flags(GRAY_FLAGS, reduce)), y_offset, x_offset)
+
+def load_color(path, y_offset=0, x_offset=0, reduce=1):
+    # uint8 BGR (h, w, 3) view of the cropped sheet, for drawing results on
+    return crop(read(path, read_flags(COLOR_FLAGS, reduce)), y_offset, x_offset)
+
+def is_buffer(source):
+    return isinstance(source, (bytes, bytearray, memoryview))
+
+def as_gray(img):
+    # uint8 (h, w) image of a grayscale, BGR or BGRA array, grayscale ones are not copied
+    if img.dtype != np.uint8:
+        raise TypeError(f"Expected a uint8 image, got {img.dtype}.")
+    if img.ndim == 2:
+        return img
+    if img.ndim == 3 and img.shape[2] in (3, 4):
+        import cv2
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY if img.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+    raise ValueError(f"Expected a (h, w) or (h, w, 3) image, got shape {img.shape}.")
+
+def shrink(img, reduce):
+    # image array at 1/reduce of its size, every pixel the mean of the ones it covers
+    check_reduce(reduce)
+    if reduce == 1:
+        return img
+    import cv2
+    height, width = img.shape[:2]
+    return cv2.resize(img, (-(-width // reduce), -(-height // reduce)), interpolation=cv2.INTER_AREA)
+
+def decode_gray(source, y_offset=0, x_offset=0, reduce=1):
+    # like load_gray, for an image array or an encoded image buffer
+    if isinstance(source, np.ndarray):
+        img = shrink(as_gray(source), reduce)
+    else:
+        import cv2
+        img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), read_flags(GRAY_FLAGS, reduce))
+        if img is None:
+            raise ValueError("Could not decode the image buffer.")
+    return crop(img, y_offset, x_offset)
+
+def open_image(source):
+    # PIL image of a path, an image array (grayscale or BGR) or an encoded image buffer
+    from PIL import Image
+    if isinstance(source, np.ndarray):
+        if source.ndim == 3:
+            source = np.ascontiguousarray(source[:, :, 2::-1]) # BGR to RGB
+        return Image.fromarray(as_gray(source) if source.ndim == 2 else source)
+    if is_buffer(source):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
+
+def reduced(image, reduce):
+    # PIL image at 1/reduce of its size. A JPEG not loaded yet is decoded at that
+    # size (draft), anything else is shrunk after decoding
+    check_reduce(reduce)
+    if reduce == 1:
+        return image
+    width = image.width
+    size = (-(-image.width // reduce), -(-image.height // reduce))
+    image.draft(None, size) # may only get part of the way, e.g. 1/2 of a 1/4
+    if image.size != size:
+        image = image.reduce(reduce * image.width // width)
+    return image
+
+def supported_reduce(source, reduce, min_scale=geometry.MIN_SCALE):
+    # reduce, or the largest smaller reduction that keeps the sheet at min_scale or above
+    # (geometry.max_reduce). Only the image header of a file or buffer is read
+    if reduce == 1:
+        return 1
+    if isinstance(source, np.ndarray):
+        width = source.shape[1]
+    elif isinstance(source, str) or is_buffer(source):
+        with open_image(source) as image:
+            width = image.width
+    else: # a PIL image
+        width = source.width
+    return geometry.max_reduce(width, reduce, min_scale)
+
+def signature(source):
+    # first bytes of the file or buffer, b'' for arrays
+    if isinstance(source, np.ndarray):
+        return b''
+    if is_buffer(source):
+        return bytes(memoryview(source)[:4])
+    with open(source, 'rb') as f:
+        return f.read(4)
+
+def page_count(source):
+    # pages of a path or buffer, only the page headers of a TIFF are read. Other
+    # formats are taken to be single page without parsing them
+    if signature(source) not in TIFF_SIGNATURES:
+        return 1
+    with open_image(source) as image:
+        return getattr(image, 'n_frames', 1)
+
+def single_page(source, pages_function):
+    # the single page entry points return the answers of one sheet, a multi-page
+    # scan has to go through their pages_function (keyed by page index) instead
+    if not isinstance(source, np.ndarray) and (pages := page_count(source)) > 1:
+        name = source if isinstance(source, str) else 'The scan'
+        raise ValueError(f"{name} has {pages} pages, grade it with {pages_function}.")
+
+def iter_pages(source):
+    # (page index, PIL image) per page, each decoded only when it is converted
+    from PIL import ImageSequence
+    with open_image(source) as image:
+        for index, page in enumerate(ImageSequence.Iterator(image)):
+            yield index, page
+
+def page_gray(page, y_offset=0, x_offset=0, reduce=1):
+    # like load_gray, for a page of iter_pages
+    return crop(np.asarray(reduced(page, reduce).convert('L')), y_offset, x_offset)
+
+def page_color(page, y_offset=0, x_offset=0, reduce=1):
+    # like load_color (BGR), for a page of iter_pages. A copy, so it can be drawn on
+    return np.ascontiguousarray(crop(np.asarray(reduced(page, reduce).convert('RGB'))[:, :, ::-1], y_offset, x_offset))
+
+def page_path(path, index):
+    # output file of one page, out.txt -> out_page3.txt
+    stem, extension = os.path.splitext(path)
+    return f"{stem}_page{index}{extension}"
+# endregion functions
@@ -0,0 +1,59 @@
+import numpy as np
+
+# Binary morphology on 0/1 (or boolean) images. Pixels outside the image are
+# treated as background (0), same as padding with utils.pad_image.
+
+# region functions
+def structure_offsets(structure):
+    structure = np.asarray(structure).astype(bool)
+    if structure.ndim != 2 or structure.shape[0] % 2 == 0 or structure.shape[1] % 2 == 0:
+        raise ValueError("Structuring element must be a 2D array with odd dimensions.")
+    return structure, [tuple(offset) for offset in np.argwhere(structure)]
+
+def pad_into(image, scratch, pad_y, pad_x):
+    # copy the image into the centre of the zero padded scratch buffer
+    shape = (image.shape[0] + 2*pad_y, image.shape[1] + 2*pad_x)
+    if scratch is None:
+        scratch = np.zeros(shape, dtype=bool)
+    elif scratch.shape != shape or scratch.dtype != bool:
+        raise ValueError(f"Scratch buffer must be a boolean array of shape {shape}.")
+    else:
+        scratch.fill(False)
+    scratch[pad_y:pad_y + image.shape[0], pad_x:pad_x + image.shape[1]] = image
+    return scratch
+
+def apply(image, structure, reduce, initial, out=None, scratch=None):
+    structure, offsets = structure_offsets(structure)
+    pad_y, pad_x = structure.shape[0] // 2, structure.shape[1] // 2
+    height, width = image.shape
+
+    padded = pad_into(image, scratch, pad_y, pad_x)
+    if out is None:
+        out = np.empty((height, width), dtype=bool)
+    out.fill(initial)
+    # one shifted view of the padded image per pixel of the structuring element
+    for dy, dx in offsets:
+        reduce(out, padded[dy:dy + height, dx:dx + width], out=out)
+    return out
+
+def erosion(image, structure, out=None, scratch=None):
+    # pixel stays set only if every pixel under the structuring element is set
+    return apply(image, structure, np.logical_and, True, out, scratch)
+
+def dilation(image, structure, out=None, scratch=None):
+    # pixel is set if any pixel under the structuring element is set
+    return apply(image, structure, np.logical_or, False, out, scratch)
+
+def opening(image, structure, in_place=False):
+    # dilation of erosion. With in_place=True the erosion result and the padded
+    # scratch buffer are reused for the dilation, so only two buffers are allocated
+    if not in_place:
+        return dilation(erosion(image, structure), structure)
+
+    structure = np.asarray(structure).astype(bool)
+    pad_y, pad_x = structure.shape[0] // 2, structure.shape[1] // 2
+    scratch = np.zeros((image.shape[0] + 2*pad_y, image.shape[1] + 2*pad_x), dtype=bool)
+    out = np.empty(image.shape, dtype=bool)
+    erosion(image, structure, out=out, scratch=scratch)
+    return dilation(out, structure, out=out, scratch=scratch)
+# endregion functions
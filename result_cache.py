@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import time
+try:
+    import fcntl
+except ImportError: # Windows: no locking, the usage total can drift until the next eviction recounts it
+    fcntl = None
+import instrumentation
+import loader
+
+# Answers of sheets already recognised, so a session can be re-run (after changing
+# the answer key, after a crash) without recognising the unchanged scans again.
+# Entries are addressed by the SHA-256 of the scan's bytes together with the
+# pipeline, its VERSION and the parameters that change the answers (for a form's
+# cached box grid the digest of its templates, layout.form_digest): a rescanned
+# sheet, a new pipeline version, another threshold or another template is a miss,
+# a copied or renamed scan is a hit.
+#
+# Every entry is a small JSON file, <cache_dir>/ab/abcdef....json, written then
+# renamed like the layout templates, so worker processes never read a half
+# written entry. A hit updates the entry's modification time; once the entries
+# add up to more than MAX_BYTES the least recently used are deleted down to
+# EVICT_TO of it. The running total is kept in the usage file, updated under an
+# exclusive lock (flock) so parallel workers add up correctly.
+
+CACHE_DIR = 'result_cache'
+MAX_BYTES = 256 * 2**20
+EVICT_TO = 0.8      # of MAX_BYTES, so eviction does not run on every store
+USAGE_FILE = 'usage'
+STALE_TMP = 3600    # seconds, temporary files of crashed workers are deleted after this
+
+# region functions
+def file_digest(path, block_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+def entry_key(digest, pipeline, version, params):
+    # params: the keyword arguments the answers depend on, JSON serialisable
+    description = json.dumps([digest, pipeline, version, params], sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+def sheet_key(path, pipeline, version, params):
+    return entry_key(file_digest(path), pipeline, version, params)
+
+def entry_path(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, key[:2], f"{key}.json")
+
+def encode_result(result):
+    # {page index: answers} of a multi-page scan would come back with string keys from JSON
+    if isinstance(result, dict):
+        return {'pages': [[index, answers] for index, answers in result.items()]}
+    return {'answers': result}
+
+def decode_result(entry):
+    if 'pages' in entry:
+        return {index: answers for index, answers in entry['pages']}
+    return entry['answers']
+
+def lookup(key, cache_dir=CACHE_DIR):
+    # the stored result or None
+    path = entry_path(key, cache_dir)
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+        os.utime(path) # most recently used
+    except (OSError, ValueError): # missing, or evicted while reading
+        instrumentation.count('result_cache.misses')
+        return None
+    instrumentation.count('result_cache.hits')
+    return decode_result(entry)
+
+def add_usage(cache_dir, size, max_bytes):
+    # adds size to the running total under an exclusive lock, evicting when it is over max_bytes
+    with open(os.path.join(cache_dir, USAGE_FILE), 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX) # released when the file is closed
+        f.seek(0)
+        try:
+            total = int(f.read() or 0) + size
+        except ValueError:
+            total = max_bytes + 1 # unreadable, recount
+        if total > max_bytes:
+            total = evict(cache_dir, int(max_bytes * EVICT_TO))
+        f.seek(0)
+        f.truncate()
+        f.write(str(total))
+
+def store(key, result, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    path = entry_path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = json.dumps(encode_result(result))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    add_usage(cache_dir, len(data), max_bytes)
+
+def evict(cache_dir, target_bytes):
+    # deletes the least recently used entries until at most target_bytes are left,
+    # returns the size left. Called with the usage lock held
+    entries = []
+    now = time.time()
+    for directory in os.scandir(cache_dir):
+        if not directory.is_dir():
+            continue
+        for entry in os.scandir(directory.path):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith('.tmp'):
+                    if now - stat.st_mtime > STALE_TMP:
+                        os.remove(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= target_bytes:
+            break
+        try:
+            os.remove(path)
+            instrumentation.count('result_cache.evictions')
+        except FileNotFoundError:
+            pass
+        total -= size
+    return total
+
+def cached_run(source, output, pipeline, version, params, run, write, cache_dir=CACHE_DIR, use_stored=True):
+    # run() recognises the scan at source and writes its answer files. On a hit the
+    # answer files are written from the stored answers with write(answers, path)
+    # instead, one per page of a multi-page scan (see loader.page_path). use_stored=False
+    # recognises the sheet anyway and only stores the result, e.g. when an annotated
+    # image is wanted, which needs the boxes found by the recognition
+    key = sheet_key(source, pipeline, version, params)
+    result = lookup(key, cache_dir) if use_stored else None
+    if result is None:
+        result = run()
+        store(key, result, cache_dir)
+        return result
+    print(f"Found {source} in the result cache")
+    if isinstance(result, dict):
+        for index, answers in result.items():
+            write(answers, loader.page_path(output, index))
+    else:
+        write(result, output)
+    return result
+# endregion functions
@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+import scoring
+from answer_masks import encode_answers
+from utils import read_answer_strings
+
+# Graded answers of a whole cohort in one SQLite file instead of one text file
+# per sheet. Every question is stored as a one byte mask (see answer_masks.py),
+# so a sheet is 85 bytes, loading an exam is one query and np.frombuffer, and
+# scoring is a single array comparison.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheets (
+    id INTEGER PRIMARY KEY,
+    exam TEXT NOT NULL,
+    student TEXT NOT NULL,
+    sheet TEXT,
+    method TEXT,
+    answers BLOB NOT NULL,
+    graded_at REAL,
+    UNIQUE (exam, student)
+);
+CREATE INDEX IF NOT EXISTS sheets_by_sheet ON sheets (sheet);
+CREATE TABLE IF NOT EXISTS answer_keys (
+    exam TEXT PRIMARY KEY,
+    answers BLOB NOT NULL
+);
+"""
+
+# region functions
+def open_store(path):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+def add_sheets(connection, exam, records, method=None):
+    # records: (student, sheet, answer strings). A student graded again replaces the earlier row
+    now = time.time()
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO sheets (exam, student, sheet, method, answers, graded_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(exam, student, sheet, method, encode_answers(answers).tobytes(), now) for student, sheet, answers in records])
+
+def import_text_files(connection, exam, paths, method=None):
+    # answer files in the "N ABC" format, the student id is the file name without extension
+    records = [(os.path.splitext(os.path.basename(path))[0], path, read_answer_strings(path)) for path in paths]
+    add_sheets(connection, exam, records, method)
+    return len(records)
+
+def set_answer_key(connection, exam, answers):
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO answer_keys (exam, answers) VALUES (?, ?)",
+                           (exam, encode_answers(answers).tobytes()))
+
+def load_answer_key(connection, exam):
+    row = connection.execute("SELECT answers FROM answer_keys WHERE exam = ?", (exam,)).fetchone()
+    if row is None:
+        raise KeyError(f"No answer key stored for exam '{exam}'.")
+    return np.frombuffer(row[0], dtype=np.uint8)
+
+def load_masks(connection, exam, num_questions=None):
+    # (students, (num_sheets, num_questions) uint8 masks) of an exam, ordered by student.
+    # Shorter sheets are padded with empty answers
+    rows = connection.execute("SELECT student, answers FROM sheets WHERE exam = ? ORDER BY student", (exam,)).fetchall()
+    if num_questions is None:
+        num_questions = max((len(answers) for _, answers in rows), default=0)
+    students = [student for student, _ in rows]
+    if all(len(answers) == num_questions for _, answers in rows):
+        masks = np.frombuffer(b''.join(answers for _, answers in rows), dtype=np.uint8)
+        return students, masks.reshape(len(rows), num_questions)
+    masks = np.zeros((len(rows), num_questions), dtype=np.uint8)
+    for i, (_, answers) in enumerate(rows):
+        answers = np.frombuffer(answers, dtype=np.uint8)[:num_questions]
+        masks[i, :len(answers)] = answers
+    return students, masks
+
+def score(connection, exam):
+    # {student: number of questions answered exactly like the key, written answer mark included}
+    key = load_answer_key(connection, exam)
+    students, masks = load_masks(connection, exam, len(key))
+    return dict(zip(students, scoring.score_masks(masks, key)['sheet_correct'].tolist()))
+
+def report(connection, exam):
+    # scoring.cohort_report of every sheet of the exam
+    key = load_answer_key(connection, exam)
+    students, masks = load_masks(connection, exam, len(key))
+    return scoring.cohort_report(students, masks, key)
+# endregion functions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store graded answers of a cohort in SQLite and score them against an answer key.")
+    parser.add_argument('database', help="SQLite file, created if missing")
+    parser.add_argument('--exam', required=True, help="exam id the sheets and the key belong to")
+    commands = parser.add_subparsers(dest='command', required=True)
+    importer = commands.add_parser('import', help="add answer files (N ABC per line), the file name is the student id")
+    importer.add_argument('files', nargs='+')
+    importer.add_argument('-m', '--method', help="recogniser that produced the files")
+    key = commands.add_parser('key', help="set the answer key of the exam from an answer file")
+    key.add_argument('file')
+    scorer = commands.add_parser('score', help="print the number of correct answers per student")
+    scorer.add_argument('--report', help="also save the full report (per sheet and per question) as JSON")
+    args = parser.parse_args()
+
+    connection = open_store(args.database)
+    if args.command == 'import':
+        count = import_text_files(connection, args.exam, args.files, args.method)
+        print(f"Imported {count} sheets into {args.database}")
+    elif args.command == 'key':
+        set_answer_key(connection, args.exam, read_answer_strings(args.file))
+        print(f"Successfully saved the answer key of {args.exam}")
+    else:
+        num_questions = len(load_answer_key(connection, args.exam))
+        for student, correct in score(connection, args.exam).items():
+            print(f"{student}: {correct}/{num_questions}")
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(report(connection, args.exam), f, indent=2)
+            print(f"Successfully saved report at: {args.report}")
+    connection.close()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import numpy as np
+from answer_masks import OPTIONS, OPTION_BITS, WRITTEN_BIT, encode_answers, decode_answer
+from utils import read_answer_strings
+
+# Scores a whole cohort at once. Answers and the key are (n_sheets, n_questions)
+# uint8 masks in the answer_masks.py layout (A-E as bits, A the most significant
+# like inject.encode_question, 'x' above them), so every statistic is a numpy
+# expression over the cohort instead of a string comparison per question.
+#
+# A question is correct when the sheet matches the key exactly, written answer
+# mark included, like grade.check_answers always did. Partial credit only looks
+# at the options: (right picks - wrong picks) / options in the key, at least 0.
+# A question without options in the key gives full credit when left blank.
+
+OPTION_MASK = (1 << len(OPTIONS)) - 1
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+ANSWER_STRINGS = [decode_answer(mask) for mask in range(256)]
+
+# region functions
+def encode_cohort(answer_lists, num_questions=None):
+    # list of answer string lists -> (n_sheets, num_questions) masks, short sheets padded with blanks
+    if num_questions is None:
+        num_questions = max((len(answers) for answers in answer_lists), default=0)
+    masks = np.zeros((len(answer_lists), num_questions), dtype=np.uint8)
+    for i, answers in enumerate(answer_lists):
+        answers = encode_answers(answers[:num_questions])
+        masks[i, :len(answers)] = answers
+    return masks
+
+def load_key(path):
+    return encode_answers(read_answer_strings(path))
+
+def score_masks(masks, key):
+    # per sheet and per question arrays for a cohort, see cohort_report for the JSON form
+    masks = np.atleast_2d(np.asarray(masks, dtype=np.uint8))
+    key = np.asarray(key, dtype=np.uint8)
+    if masks.shape[1] != len(key):
+        raise ValueError(f"Sheets have {masks.shape[1]} questions, the key has {len(key)}.")
+
+    correct = masks == key
+    options = masks & OPTION_MASK
+    key_options = key & OPTION_MASK
+    right = POPCOUNT[options & key_options].astype(np.int16)
+    wrong = POPCOUNT[options & ~key_options & OPTION_MASK].astype(np.int16)
+    key_count = POPCOUNT[key_options].astype(np.float64)
+    partial = np.where(key_count > 0, np.maximum(right - wrong, 0) / np.maximum(key_count, 1), options == 0)
+
+    # how often each option was marked, (n_questions, 5) with A first
+    bits = np.array([OPTION_BITS[option] for option in OPTIONS], dtype=np.uint8)
+    option_counts = ((masks[:, :, None] & bits) > 0).sum(axis=0)
+
+    # point-biserial correlation of each question with the score on the other questions
+    total = correct.sum(axis=1)
+    item = correct.astype(np.float64)
+    rest = total[:, None] - item
+    item -= item.mean(axis=0)
+    rest -= rest.mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        discrimination = (item * rest).sum(axis=0) / np.sqrt((item**2).sum(axis=0) * (rest**2).sum(axis=0))
+
+    return {
+        'correct': correct,                         # (n_sheets, n_questions) bool
+        'partial': partial,                         # (n_sheets, n_questions) credit in [0, 1]
+        'sheet_correct': total,                     # (n_sheets,)
+        'sheet_partial': partial.sum(axis=1),       # (n_sheets,)
+        'question_correct': correct.mean(axis=0),   # (n_questions,) share of sheets right
+        'question_partial': partial.mean(axis=0),   # (n_questions,)
+        'question_blank': (options == 0).mean(axis=0),
+        'question_written': ((masks & WRITTEN_BIT) > 0).mean(axis=0),
+        'option_counts': option_counts,             # (n_questions, 5)
+        'discrimination': discrimination,           # (n_questions,) nan when undefined
+    }
+
+def optional_float(value):
+    return None if np.isnan(value) else float(value)
+
+def cohort_report(sheets, masks, key):
+    # JSON friendly report: summary, one entry per sheet and one per question
+    key = np.asarray(key, dtype=np.uint8)
+    scores = score_masks(masks, key)
+    num_questions = len(key)
+    totals = scores['sheet_correct']
+    report = {
+        'num_sheets': len(sheets),
+        'num_questions': num_questions,
+        'summary': {
+            'mean_correct': float(totals.mean()) if len(totals) else None,
+            'median_correct': float(np.median(totals)) if len(totals) else None,
+            'std_correct': float(totals.std()) if len(totals) else None,
+            'min_correct': int(totals.min()) if len(totals) else None,
+            'max_correct': int(totals.max()) if len(totals) else None,
+        },
+        'sheets': [],
+        'questions': [],
+    }
+    # python lists once, indexing numpy scalars per question is what makes large reports slow
+    masks = np.atleast_2d(masks).tolist()
+    key = [ANSWER_STRINGS[mask] for mask in key.tolist()]
+    correct = scores['correct'].tolist()
+    sheet_partial = scores['sheet_partial'].tolist()
+    for i, sheet in enumerate(sheets):
+        total = int(totals[i])
+        report['sheets'].append({
+            'sheet': sheet,
+            'correct': total,
+            'partial': sheet_partial[i],
+            'percent': 100.0 * total / num_questions if num_questions else None,
+            'incorrect': [{'question': q + 1, 'answer': ANSWER_STRINGS[mask], 'key': key[q]}
+                          for q, (mask, right) in enumerate(zip(masks[i], correct[i])) if not right],
+        })
+    for q in range(num_questions):
+        report['questions'].append({
+            'question': q + 1,
+            'key': key[q],
+            'correct': float(scores['question_correct'][q]),
+            'partial': float(scores['question_partial'][q]),
+            'blank': float(scores['question_blank'][q]),
+            'written': float(scores['question_written'][q]),
+            'options': dict(zip(OPTIONS, scores['option_counts'][q].tolist())),
+            'discrimination': optional_float(scores['discrimination'][q]),
+        })
+    return report
+# endregion functions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score answer files against an answer key and write a JSON report.")
+    parser.add_argument('key', help="answer key file, N ABC per line")
+    parser.add_argument('answers', nargs='+', help="graded answer files, N ABC per line")
+    parser.add_argument('-o', '--output', help="report file (default: print the report)")
+    args = parser.parse_args()
+
+    key = load_key(args.key)
+    sheets = [os.path.splitext(os.path.basename(path))[0] for path in args.answers]
+    masks = encode_cohort([read_answer_strings(path) for path in args.answers], len(key))
+    report = cohort_report(sheets, masks, key)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Successfully saved report at: {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
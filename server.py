@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import batch
+import loader
+
+# Resident grading daemon. A pool of worker processes imports the pipelines once
+# at start up, so a request only pays for the recognition itself. asyncio handles
+# the connections; requests arriving within batch_delay of each other are sent to
+# a worker together to save a round trip through the process pool per sheet.
+#
+#   POST /grade[?method=grade1]    body: the scanned image (jpg, png, ...), or
+#                                  JSON {"path": "...", "method": "..."} with
+#                                  Content-Type: application/json
+#   GET  /health
+#
+# Answers come back as JSON: {"answers": ["A", "BD", "Cx", ...], "method": "grade"},
+# for a multi-page TIFF "answers" holds one such list per page index.
+
+MAX_BODY_SIZE = 64 * 2**20
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 422: 'Unprocessable Entity', 500: 'Internal Server Error'}
+
+# region functions
+def init_worker(methods):
+    for method in methods:
+        batch.init_worker(method)
+
+def warm_up():
+    return os.getpid()
+
+def grade_requests(requests):
+    # runs in a worker process: [(method, path, image bytes)] -> [(answers, error)],
+    # exactly one of path and image bytes is set. Sheets are graded in memory
+    # (answers_from_image, answers_from_pages for a multi-page TIFF), no temporary files
+    results = []
+    for method, path, data in requests:
+        try:
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            pipeline = batch.load_pipeline(method)
+            with contextlib.redirect_stdout(io.StringIO()): # the pipelines print every step
+                if loader.page_count(data) > 1:
+                    results.append((pipeline.answers_from_pages(data), None))
+                else:
+                    results.append((pipeline.answers_from_image(data), None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+class GradingServer:
+    def __init__(self, workers=None, method='grade', batch_size=8, batch_delay=0.005):
+        self.workers = workers or os.cpu_count()
+        self.method = method
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.executor = None
+        self.pending = None # (request, future) waiting to be batched
+        self.in_flight = 0
+        self.batches = set() # running batch tasks, referenced so they are not garbage collected
+
+    async def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=(batch.PIPELINES,))
+        loop = asyncio.get_running_loop()
+        # start every worker now, not on the first requests
+        await asyncio.gather(*[loop.run_in_executor(self.executor, warm_up) for _ in range(self.workers)])
+        self.pending = asyncio.Queue()
+        self.batcher = asyncio.create_task(self.collect_batches())
+
+    def close(self):
+        self.batcher.cancel()
+        self.executor.shutdown(cancel_futures=True)
+
+    async def grade(self, method, path=None, data=None):
+        # returns (answers, error)
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put(((method, path, data), future))
+        return await future
+
+    async def collect_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.pending.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(items) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # don't wait for the batch, the next one can go to another worker
+            task = asyncio.create_task(self.run_batch(items))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+
+    async def run_batch(self, items):
+        self.in_flight += len(items)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, grade_requests, [request for request, _ in items])
+        except Exception as e: # e.g. a worker process died
+            results = [(None, f"{type(e).__name__}: {e}")] * len(items)
+        finally:
+            self.in_flight -= len(items)
+        for (_, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def handle(self, method, target, headers, body):
+        # returns (status, response dict)
+        url = urlsplit(target)
+        if url.path == '/health':
+            return 200, {'status': 'ok', 'workers': self.workers, 'queued': self.pending.qsize(), 'in_flight': self.in_flight}
+        if url.path != '/grade':
+            return 404, {'error': f"Unknown path {url.path}, use /grade or /health."}
+        if method != 'POST':
+            return 405, {'error': "Use POST /grade."}
+
+        query = parse_qs(url.query)
+        pipeline = query.get('method', [self.method])[0]
+        path = data = None
+        if headers.get('content-type', '').startswith('application/json'):
+            try:
+                request = json.loads(body)
+                path = request['path']
+            except (ValueError, KeyError, TypeError):
+                return 400, {'error': "Expected a JSON object with a 'path'."}
+            pipeline = request.get('method', pipeline)
+            if not os.path.isfile(path):
+                return 400, {'error': f"{path} - path does not exist."}
+        elif body:
+            data = body
+        else:
+            return 400, {'error': "Send the image as the request body or a JSON path."}
+        if pipeline not in batch.PIPELINES:
+            return 400, {'error': f"Unknown pipeline '{pipeline}', expected one of {batch.PIPELINES}."}
+
+        start = time.perf_counter()
+        answers, error = await self.grade(pipeline, path, data)
+        if error is not None:
+            return 422, {'error': error, 'method': pipeline}
+        return 200, {'answers': answers, 'method': pipeline, 'seconds': round(time.perf_counter() - start, 4)}
+
+    async def serve_connection(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive, one request at a time per connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, 400, {'error': "Malformed request line."}, keep_alive=False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get('content-length', 0) or 0)
+                except ValueError:
+                    await self.respond(writer, 400, {'error': "Invalid Content-Length."}, keep_alive=False)
+                    break
+                if length > MAX_BODY_SIZE:
+                    await self.respond(writer, 413, {'error': f"Body larger than {MAX_BODY_SIZE} bytes."}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                try:
+                    status, response = await self.handle(method, target, headers, body)
+                except Exception as e:
+                    status, response = 500, {'error': f"{type(e).__name__}: {e}"}
+                await self.respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, response, keep_alive=True):
+        body = json.dumps(response).encode()
+        writer.write((f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                      f"Content-Type: application/json\r\n"
+                      f"Content-Length: {len(body)}\r\n"
+                      f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + body)
+        await writer.drain()
+
+async def serve(host='127.0.0.1', port=8765, unix_socket=None, **options):
+    server = GradingServer(**options)
+    await server.start()
+    try:
+        if unix_socket is not None:
+            listener = await asyncio.start_unix_server(server.serve_connection, path=unix_socket)
+            print(f"Grading server with {server.workers} workers listening on {unix_socket}")
+        else:
+            listener = await asyncio.start_server(server.serve_connection, host, port)
+            print(f"Grading server with {server.workers} workers listening on http://{host}:{port}")
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+# endregion functions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the graders over local HTTP, with warm worker processes.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help="listen on this Unix socket path instead of TCP")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="worker processes (default: number of CPUs)")
+    parser.add_argument('-m', '--method', choices=batch.PIPELINES, default='grade', help="default recogniser (default: grade)")
+    parser.add_argument('--batch-size', type=int, default=8, help="most requests sent to a worker at once")
+    parser.add_argument('--batch-delay', type=float, default=0.005, help="seconds to wait for more requests to batch")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, workers=args.workers, method=args.method,
+                          batch_size=args.batch_size, batch_delay=args.batch_delay))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,102 @@
+import os
+import warnings
+import numpy as np
+import pytest
+import grade
+import loader
+from integral import rect_sum
+from conftest import TEST_IMAGES
+
+# the per-box loop of the original grade.get_answer_choices, on a BGR image
+# (the thresholds were tuned on those, every dark pixel counted once per channel)
+def answer_choices_loop(img, boxes, vertical_lines):
+    answer_choices = []
+    answer_boxes = []
+    num = 1
+    for box in boxes:
+        y_start, y_end, x_start, x_end = box
+        curr_answers = []
+        black_pixels_list = []
+        sections = []
+        for i in range(0, len(vertical_lines) - 1, 2):
+            if vertical_lines[i] < x_start or vertical_lines[i + 1] > x_end:
+                continue
+            x1 = vertical_lines[i]
+            x2 = vertical_lines[i + 1]
+            section = img[y_start:y_end, x1:x2]
+            black_pixels = np.sum(section < 100)
+            black_pixels_list.append(black_pixels)
+            sections.append((y_start, y_end, x1, x2))
+        if black_pixels_list:
+            average_black_pixels = np.mean(black_pixels_list)
+            answer_num = 1
+            for i in range(len(black_pixels_list)):
+                if black_pixels_list[i] > average_black_pixels:
+                    curr_answers.append(answer_num)
+                    answer_boxes.append(sections[i])
+                answer_num += 1
+        if num < 30:
+            curr_lines = [vertical_lines[0]]
+        elif num < 60:
+            curr_lines = [vertical_lines[9], vertical_lines[10]]
+        else:
+            curr_lines = [vertical_lines[19], vertical_lines[20]]
+        if len(curr_lines) == 1:
+            section = img[y_start:y_end, 0:curr_lines[0]]
+        else:
+            section = img[y_start:y_end, curr_lines[0]:curr_lines[1]-5]
+        if np.sum(section < 100) > 880:
+            curr_answers.append('x')
+        answer_choices.append(curr_answers)
+        num += 1
+    return answer_choices, answer_boxes
+
+def check_matches_loop(gray, boxes, vertical_lines):
+    bgr = np.repeat(gray[:, :, None], 3, axis=2)
+    expected = answer_choices_loop(bgr, boxes, vertical_lines)
+    for img in (gray, bgr):
+        answers, answer_boxes, margins = grade.score_answer_choices(img, boxes, vertical_lines)
+        assert (answers, answer_boxes) == expected
+        assert len(margins) == len(boxes)
+
+def random_sheet(seed):
+    # dark pencil marks and noise, 30 vertical lines in three columns of answer sections,
+    # boxes that cover some of the sections and some that go off the image
+    rng = np.random.default_rng(seed)
+    gray = np.where(rng.random((400, 600)) < 0.3, rng.integers(0, 256, (400, 600)), 230).astype(np.uint8)
+    gray[rng.random(gray.shape) < 0.02] = 20
+    lines = np.sort(rng.choice(np.arange(40, 580), 30, replace=False))
+    boxes = []
+    for q in range(85):
+        y = int(rng.integers(-5, 395))
+        column = q // 30
+        x_start = int(lines[10 * column + rng.integers(0, 3)]) - int(rng.integers(0, 3))
+        boxes.append((y, y + int(rng.integers(0, 20)), x_start, x_start + int(rng.integers(0, 200))))
+    return gray, boxes, [int(x) for x in lines]
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_sheets_match_loop(seed):
+    check_matches_loop(*random_sheet(seed))
+
+@pytest.mark.parametrize('sheet', ['a-27.jpg', 'b-13.jpg', 'c-33.jpg'])
+def test_sample_sheets_match_loop(sheet):
+    img, _ = grade.answer_area(loader.load_gray(os.path.join(TEST_IMAGES, sheet)), 1)
+    vertical_lines, question_boxes = grade.detect_layout(img)
+    check_matches_loop(np.ascontiguousarray(img), question_boxes, vertical_lines)
+
+def test_dark_pixel_table():
+    gray, _, _ = random_sheet(7)
+    sat = grade.dark_pixel_table(gray)
+    bgr = grade.dark_pixel_table(np.repeat(gray[:, :, None], 3, axis=2))
+    for y0, y1, x0, x1 in [(0, 400, 0, 600), (10, 37, 100, 170), (-20, -1, 3, 9)]:
+        assert rect_sum(sat, y0, y1, x0, x1) == np.sum(gray[y0:y1, x0:x1] < 100)
+        assert rect_sum(bgr, y0, y1, x0, x1) == 3 * np.sum(gray[y0:y1, x0:x1] < 100)
+
+def test_box_without_sections():
+    # no section between the box's sides: nothing to average, no division warnings
+    gray = np.full((100, 300), 255, dtype=np.uint8)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        answers, _, margins = grade.score_answer_choices(gray, [(10, 40, 0, 100), (50, 80, 150, 160)], [20, 40, 60, 80, 200, 210])
+    assert answers == [[], []]
+    assert np.isfinite(margins).all()
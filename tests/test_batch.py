@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+import batch
+from conftest import ROOT
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return path
+
+def test_unique_stems_keep_their_name(tmp_path):
+    sheets = [touch(str(tmp_path / 'room1' / 'a-3.jpg')), touch(str(tmp_path / 'room2' / 'b-13.jpg'))]
+    assert batch.answer_names(sheets) == {sheets[0]: 'a-3', sheets[1]: 'b-13'}
+
+def test_same_stem_in_different_directories(tmp_path):
+    sheets = [touch(str(tmp_path / 'room1' / 'a-3.jpg')), touch(str(tmp_path / 'room2' / 'a-3.jpg')),
+              touch(str(tmp_path / 'room2' / 'c-18.jpg'))]
+    names = batch.answer_names(sheets)
+    assert names == {sheets[0]: 'room1_a-3', sheets[1]: 'room2_a-3', sheets[2]: 'c-18'}
+
+def test_same_stem_at_different_depths(tmp_path):
+    sheets = [touch(str(tmp_path / 'a-3.jpg')), touch(str(tmp_path / 'day2' / 'room1' / 'a-3.jpg'))]
+    assert batch.answer_names(sheets) == {sheets[0]: 'a-3', sheets[1]: 'day2_room1_a-3'}
+
+def test_same_stem_with_different_extensions(tmp_path):
+    sheets = [touch(str(tmp_path / 'room1' / 'a-3.jpg')), touch(str(tmp_path / 'room1' / 'a-3.PNG')),
+              touch(str(tmp_path / 'room2' / 'a-3.jpg'))]
+    names = batch.answer_names(sheets)
+    assert names == {sheets[0]: 'room1_a-3_jpg', sheets[1]: 'room1_a-3_png', sheets[2]: 'room2_a-3'}
+
+def test_answer_files_do_not_collide(tmp_path):
+    sheets = [touch(str(tmp_path / room / name)) for room in ('room1', 'room2', 'room3/sub')
+              for name in ('a-3.jpg', 'a-3.tif', 'b-13.jpg')]
+    names = batch.answer_names(sheets)
+    outputs = [batch.answers_path(sheet, str(tmp_path / 'out'), names[sheet]) for sheet in sheets]
+    assert len(set(outputs)) == len(sheets)
+
+def test_run_keeps_one_answer_file_per_duplicate_stem(tmp_path):
+    # answer files newer than the scans are read back instead of grading, so no worker is started
+    sheets = [touch(str(tmp_path / room / 'a-3.jpg')) for room in ('room1', 'room2')]
+    output_dir = tmp_path / 'out'
+    output_dir.mkdir()
+    for room, answers in (('room1', '1 A\n2 B'), ('room2', '1 C\n2 D')):
+        (output_dir / f'{room}_a-3.txt').write_text(answers + '\n')
+    records, failed = batch.run([str(tmp_path / 'room1'), str(tmp_path / 'room2')], str(output_dir))
+    assert failed == []
+    assert records == {sheets[0]: ['A', 'B'], sheets[1]: ['C', 'D']}
+
+def test_parser_rejects_annotated_cascade(tmp_path):
+    for script in ('batch.py', 'watch.py'):
+        result = subprocess.run([sys.executable, os.path.join(ROOT, script), str(tmp_path), '-o', str(tmp_path / 'out'),
+                                 '-m', 'cascade', '--annotate'], capture_output=True, text=True)
+        assert result.returncode == 2
+        assert '--annotate' in result.stderr
+        assert not (tmp_path / 'out').exists()
@@ -0,0 +1,27 @@
+import subprocess
+import sys
+import benchmark
+from conftest import ROOT
+
+def imported(module):
+    # heavy modules loaded by importing module in a fresh interpreter
+    code = f"import sys, {module}; print(' '.join(name for name in ('cv2', 'PIL', 'matplotlib') if name in sys.modules))"
+    return subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True, text=True).stdout.split()
+
+def test_pipelines_import_only_what_they_use():
+    assert imported('grade') == ['cv2']
+    assert imported('grade1') == ['PIL']
+    assert imported('extract') == ['PIL']
+
+def test_check_startup(monkeypatch, capsys):
+    times = {'grade': 0.3, 'grade1': 0.9, 'extract': 0.2}
+    monkeypatch.setattr(benchmark, 'startup_time', lambda module: times[module])
+    startup, slow = benchmark.check_startup(list(times), budget=0.5)
+    assert startup == times
+    assert slow == ['grade1']
+    assert 'budget 500 ms' in capsys.readouterr().out
+    assert benchmark.check_startup(list(times))[1] == ['grade1'] # STARTUP_BUDGET
+
+def test_startup_time():
+    # interpreter start up is not counted, a module without imports costs next to nothing
+    assert 0 <= benchmark.startup_time('geometry', repeat=1) < benchmark.STARTUP_BUDGET
@@ -0,0 +1,86 @@
+import pytest
+import cascade
+
+# readings as (answer strings, estimated error rates)
+FIRST = (['A', 'B', 'C', 'D'], [0.01, 0.3, 0.02, 0.6])
+SECOND = (['A', 'C', 'C', 'E'], [0.01, 0.1, 0.01, 0.8])
+
+def test_error_rates():
+    assert cascade.error_rates('grade', [0.0, 0.005, 0.01, 0.2]) == [0.45, 0.45, 0.26, 0.0]
+    assert cascade.error_rates('grade1', [0.05, 0.3]) == [0.95, 0.004]
+    for method, table in cascade.ERROR_RATES.items():
+        margins, rates = zip(*table)
+        assert list(margins) == sorted(margins)
+        assert list(rates) == sorted(rates, reverse=True) # a larger margin is never less sure
+
+def test_combine_takes_the_likelier_answer():
+    # question 4 stays with the first reading, the second is even less sure about it
+    assert cascade.combine(FIRST, SECOND, 0.2) == (['A', 'C', 'C', 'D'], [1], [3])
+    assert cascade.combine(FIRST, SECOND, 0.9) == (['A', 'B', 'C', 'D'], [], [])
+
+def test_combine_whole_sheet():
+    assert cascade.combine(FIRST, SECOND, 0.2, whole_sheet=True) == (['A', 'C', 'C', 'E'], [0, 1, 2, 3], [3])
+    assert cascade.combine(FIRST, SECOND, 0.9, whole_sheet=True) == (['A', 'B', 'C', 'D'], [], [])
+
+def test_combine_mismatched_questions():
+    # a box row missed by the first recogniser: its answers cannot be matched up
+    first = (['A', 'B', 'C'], [0.0, 0.0, 0.5])
+    assert cascade.combine(first, SECOND, 0.2) == (['A', 'C', 'C', 'E'], [0, 1, 2, 3], [3])
+
+def reader(pages, calls):
+    # read(method) for cascade_pages, pages[method] is {page index: (answers, margins)} or None to fail
+    def read(method):
+        calls.append(method)
+        if pages[method] is None:
+            raise ValueError("Could not find the box grid.")
+        return pages[method]
+    return read
+
+def test_sure_sheet_read_once():
+    calls = []
+    sure = {0: (['A', 'B'], [0.3, 0.25])}
+    assert cascade.cascade_pages(reader({'grade1': sure}, calls), 'grade1', 'grade', 0.2, False) == {0: (['A', 'B'], [], [])}
+    assert calls == ['grade1']
+
+def test_default_reads_once():
+    calls = []
+    unsure = {0: (['A', 'B'], [0.0, 0.0])}
+    assert cascade.cascade_pages(reader({'grade1': unsure}, calls), 'grade1', 'grade', None, False) == {0: (['A', 'B'], [], [])}
+    assert calls == ['grade1']
+
+def test_pages_combined_one_by_one():
+    calls = []
+    pages = {'grade1': {0: (['A', 'B'], [0.3, 0.3]), 1: (['C', 'D'], [0.12, 0.3])},
+             'grade': {0: (['E', 'E'], [0.2, 0.2]), 1: (['E', 'E'], [0.2, 0.2])}}
+    combined = cascade.cascade_pages(reader(pages, calls), 'grade1', 'grade', 0.2, False)
+    assert combined == {0: (['A', 'B'], [], []), 1: (['E', 'D'], [0], [])}
+    assert calls == ['grade1', 'grade']
+
+def test_first_failure_falls_back():
+    calls = []
+    pages = {'grade1': None, 'grade': {0: (['A', 'B'], [0.0, 0.2])}}
+    assert cascade.cascade_pages(reader(pages, calls), 'grade1', 'grade', 0.2, False) == {0: (['A', 'B'], [0, 1], [0])}
+    assert cascade.cascade_pages(reader(pages, calls), 'grade1', 'grade', None, False) == {0: (['A', 'B'], [0, 1], [])}
+
+def test_second_failure_keeps_first_reading():
+    calls = []
+    pages = {'grade': {0: (['A', 'B'], [0.2, 0.0])}, 'grade1': None}
+    assert cascade.cascade_pages(reader(pages, calls), 'grade', 'grade1', 0.2, False) == {0: (['A', 'B'], [], [1])}
+    assert calls == ['grade', 'grade1']
+
+def test_both_fail():
+    with pytest.raises(ValueError):
+        cascade.cascade_pages(reader({'grade': None, 'grade1': None}, []), 'grade', 'grade1', 0.2, False)
+
+def test_blank_form(tmp_path, capsys):
+    # grade1 cannot find the boxes of the unfilled form, grade's reading is kept
+    from conftest import TEST_IMAGES
+    path = str(tmp_path / 'out.txt')
+    answers = cascade.run(f"{TEST_IMAGES}/blank_form.jpg", path, first='grade', second='grade1', max_error=0.2)
+    assert len(answers) == 85
+    assert "Questions" in capsys.readouterr().out
+    assert open(path).read().count('\n') == 85
+
+def test_grey_level_refused():
+    with pytest.raises(ValueError):
+        cascade.grade_cascade(b'', threshold=120)
@@ -0,0 +1,62 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+import extract
+import inject
+from utils import read_answer_strings
+from conftest import TEST_IMAGES
+
+# the row-by-row scan of the original extract.find_alignment_bars
+def find_alignment_bars_loop(image, start_row):
+    for row in range(start_row, 0, -1):
+        line = image[row, :image.shape[1]//2]
+        transitions = np.where(np.diff(line == 0))[0]
+        if len(transitions) >= 6:
+            b1_width = transitions[1] - transitions[0]
+            b2_width = transitions[3] - transitions[2]
+            b3_width = transitions[5] - transitions[4]
+            if np.any(abs(np.diff([b1_width, b2_width, b3_width])) > 1.5): continue
+            detected_w = int(round(np.mean([b1_width, b2_width, b3_width])))
+            g1 = transitions[2] - transitions[1]
+            g2 = transitions[4] - transitions[3]
+            detected_g = int(np.mean([g1, g2]))
+            return detected_w, detected_g, row, transitions[5] + detected_g
+
+def random_band(seed):
+    # binary band with noise and, on a few rows, bars of slightly uneven widths
+    rng = np.random.default_rng(seed)
+    band = np.where(rng.random((120, 400)) < 0.01, 0, 255).astype(np.uint8)
+    for row in rng.choice(120, 6, replace=False):
+        x = int(rng.integers(0, 40))
+        for _ in range(4):
+            width = int(rng.integers(2, 6))
+            band[row, x:x + width] = 0
+            x += width + int(rng.integers(1, 8))
+    return band
+
+@pytest.mark.parametrize('block_rows', [1, 7, 256])
+@pytest.mark.parametrize('seed', range(6))
+def test_random_bands_match_loop(seed, block_rows):
+    band = random_band(seed)
+    for start_row in [119, 80, 33, 1, 0]:
+        found = extract.find_alignment_bars(band, start_row, block_rows)
+        expected = find_alignment_bars_loop(band, start_row)
+        assert found == (None if expected is None else tuple(int(v) for v in expected)), start_row
+
+def test_no_bars():
+    assert extract.find_alignment_bars(np.full((50, 100), 255, dtype=np.uint8), 49) is None
+
+@pytest.mark.parametrize('sheet', ['a-27', 'c-33'])
+def test_sample_sheets(sheet):
+    # a graded sheet with its answers injected: every barcode row is found like the loop found it
+    answers = read_answer_strings(os.path.join(TEST_IMAGES, f"{sheet}_groundtruth.txt"))
+    with open(os.path.join(TEST_IMAGES, f"{sheet}.jpg"), 'rb') as f:
+        injected = inject.inject_image(f.read(), answers)
+    band = extract.load_barcode_band(Image.fromarray(injected), 300)
+    row = band.shape[0] - 1
+    for _ in range(3):
+        expected = find_alignment_bars_loop(band, row)
+        assert extract.find_alignment_bars(band, row) == tuple(int(v) for v in expected)
+        row = expected[2] - 25
+    assert extract.answers_from_image(injected) == answers
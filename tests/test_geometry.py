@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from PIL import Image
+import geometry
+import loader
+
+@pytest.mark.parametrize('width, scale', [(1700, 1), (1760, 1), (1650, 1), (850, 0.5), (2125, 1.25), (3400, 2), (1275, 0.75)])
+def test_sheet_scale(width, scale):
+    assert geometry.sheet_scale(width) == pytest.approx(scale)
+
+def test_sheet_scale_too_small():
+    with pytest.raises(ValueError):
+        geometry.sheet_scale(800)
+    with pytest.raises(ValueError):
+        geometry.sheet_scale(850, min_scale=0.95)
+
+@pytest.mark.parametrize('width, reduce, min_scale, expected', [
+    (1700, 1, geometry.MIN_SCALE, 1),
+    (1700, 8, geometry.MIN_SCALE, 2),   # 200 dpi decodes at 1/2 at most
+    (1700, 8, 0.95, 1),
+    (2550, 8, geometry.MIN_SCALE, 2),   # 300 dpi: 1/4 would be 75 dpi
+    (3400, 8, geometry.MIN_SCALE, 4),
+    (3400, 2, geometry.MIN_SCALE, 2),
+    (3400, 8, 0.95, 2),
+    (600, 4, geometry.MIN_SCALE, 1),    # too small at any size, left to sheet_scale
+])
+def test_max_reduce(width, reduce, min_scale, expected):
+    assert geometry.max_reduce(width, reduce, min_scale) == expected
+
+def test_lengths():
+    assert geometry.length(10, 0.5) == 5
+    assert geometry.length(3, 0.1, minimum=1) == 1
+    assert geometry.area(500, 0.5) == 125
+    assert geometry.sheet_dpi(850, reduce=2) == 200
+
+@pytest.mark.parametrize('reduce', [1, 2, 4, 8])
+def test_reduced_jpeg(tmp_path, reduce):
+    # a 300 dpi letter page, decoded straight at the smaller size
+    path = str(tmp_path / 'sheet.jpg')
+    rng = np.random.default_rng(7)
+    Image.fromarray(rng.integers(0, 256, (3300, 2550), dtype=np.uint8)).save(path)
+    with Image.open(path) as image:
+        assert loader.reduced(image, reduce).size == (-(-2550 // reduce), -(-3300 // reduce))
+    assert loader.supported_reduce(path, reduce) == min(reduce, 2)
+
+def test_reduced_other_formats(tmp_path):
+    path = str(tmp_path / 'sheet.png')
+    Image.fromarray(np.zeros((330, 255), dtype=np.uint8)).save(path)
+    with Image.open(path) as image:
+        assert loader.reduced(image, 4).size == (64, 83)
+    with pytest.raises(ValueError):
+        loader.reduced(Image.open(path), 3)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import gradient
+
+# the per-pixel Sobel of the original grade.py
+def sobel_loop(img):
+    if len(img.shape) == 3:
+        img = np.mean(img, axis=-1)
+    sobel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
+    sobel_y = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
+    gradient_x = np.zeros_like(img, dtype=float)
+    gradient_y = np.zeros_like(img, dtype=float)
+    for i in range(1, img.shape[0]-1):
+        for j in range(1, img.shape[1]-1):
+            gradient_x[i, j] = np.sum(sobel_x * img[i-1:i+2, j-1:j+2])
+            gradient_y[i, j] = np.sum(sobel_y * img[i-1:i+2, j-1:j+2])
+    gradient_magnitude = np.sqrt(gradient_x**2 + gradient_y**2)
+    gradient_magnitude *= 255.0 / gradient_magnitude.max()
+    return gradient_magnitude
+
+@pytest.fixture(params=['gray', 'bgr'])
+def image(request):
+    rng = np.random.default_rng(1)
+    shape = (23, 31) if request.param == 'gray' else (23, 31, 3)
+    return rng.integers(0, 256, shape, dtype=np.uint8)
+
+@pytest.mark.parametrize('backend', ['numpy', 'cv2'])
+def test_matches_loop(image, backend):
+    if backend == 'cv2':
+        pytest.importorskip('cv2')
+    np.testing.assert_allclose(gradient.gradient_magnitude(image, backend), sobel_loop(image), rtol=1e-12)
+
+def test_float_image():
+    img = np.random.default_rng(2).random((12, 9)) * 255
+    np.testing.assert_allclose(gradient.gradient_magnitude(img), sobel_loop(img), rtol=1e-12)
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        gradient.gradient_magnitude(np.zeros((3, 3), np.uint8), 'nope')
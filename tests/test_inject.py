@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+import inject
+from utils import read_answers, get_question_ordering
+from conftest import TEST_IMAGES
+
+# the bar-by-bar loop of the original inject.embed_barcode
+def embed_barcode_loop(image_array, answers, h=10, w=2, g=4, side_padding=20, bottom_padding=10):
+    num_questions = len(answers)
+    questions_per_row, _ = inject.calculate_questions_per_row(image_array.shape[1], num_questions, w, g, side_padding)
+    rows_needed = np.ceil(num_questions / questions_per_row).astype(int)
+    barcode_height = rows_needed * h + bottom_padding
+    barcode_array = np.full((barcode_height, image_array.shape[1]), 255, dtype=np.uint8)
+    for row in range(rows_needed):
+        start_y = barcode_height - bottom_padding - (row + 1) * h
+        for i in range(3):
+            x_position = side_padding + i * (w + g)
+            barcode_array[start_y:start_y+h, x_position:x_position+w] = 0
+        x_offset = side_padding + (3 * (w + g))
+        for q in range(questions_per_row):
+            ind = row * questions_per_row + q
+            if ind >= num_questions:
+                break
+            for bit in inject.encode_question(answers[ind]):
+                if bit == '1':
+                    barcode_array[start_y:start_y+h, x_offset:x_offset + w] = 0
+                x_offset += w
+            x_offset += g
+    embedding_start = image_array.shape[0] - barcode_height
+    image_array[embedding_start:, :] = barcode_array
+    return image_array
+
+def random_answers(rng, count):
+    return [[option for option in 'ABCDE' if rng.random() < 0.3] for _ in range(count)]
+
+@pytest.mark.parametrize('width, count, h, w, g', [(1700, 85, 20, 5, 10), (400, 85, 10, 2, 4), (300, 7, 3, 1, 2), (250, 40, 20, 5, 10)])
+def test_embed_matches_loop(width, count, h, w, g):
+    rng = np.random.default_rng(width + count)
+    image = rng.integers(0, 256, (300, width), dtype=np.uint8)
+    answers = random_answers(rng, count)
+    expected = embed_barcode_loop(image.copy(), answers, h, w, g)
+    np.testing.assert_array_equal(inject.embed_barcode(image.copy(), answers, h, w, g), expected)
+
+def test_too_narrow():
+    with pytest.raises(ValueError):
+        inject.embed_barcode(np.zeros((50, 60), dtype=np.uint8), [['A']] * 3)
+
+@pytest.mark.parametrize('sheet', ['a-27', 'c-18'])
+def test_sample_sheets_match_loop(sheet):
+    path = os.path.join(TEST_IMAGES, f"{sheet}.jpg")
+    answers = read_answers(os.path.join(TEST_IMAGES, f"{sheet}_groundtruth.txt"))
+    image = np.array(Image.open(path).convert('L'))
+    expected = embed_barcode_loop(image, inject.jumble_answers(answers, get_question_ordering()), h=20, w=5, g=10)
+    with open(path, 'rb') as f:
+        np.testing.assert_array_equal(inject.inject_image(f.read(), [''.join(answer) for answer in answers]), expected)
@@ -0,0 +1,126 @@
+import json
+import pytest
+import instrumentation
+
+# binary fractions, so sums come out the same in any order
+RECORDS = [
+    {'spans': {'grade.load': 0.25, 'grade.boxes': 0.0078125}, 'counters': {'grade.sheets': 1, 'grade.rows_skipped': 3}},
+    {'spans': {'grade.load': 1.5, 'grade.boxes': 0.0625}, 'counters': {'grade.sheets': 1}},
+]
+MORE = [
+    {'spans': {'grade.load': 0.5, 'grade1.blur': 12.0}, 'counters': {'grade.sheets': 1, 'cascade.second_failures': 1}},
+]
+
+@pytest.fixture
+def metrics():
+    instrumentation.reset()
+    instrumentation.enable()
+    yield
+    instrumentation.disable()
+    instrumentation.reset()
+
+def test_prometheus_round_trip(tmp_path):
+    path = str(tmp_path / 'metrics.prom')
+    instrumentation.write_metrics(RECORDS, path)
+    stages, counters = instrumentation.read_prometheus(path)
+    assert (stages, counters) == instrumentation.prometheus_totals(RECORDS)
+    assert stages['grade.load'][-2:] == [2, 1.75]
+    assert counters == {'grade.sheets': 2, 'grade.rows_skipped': 3}
+
+def test_append_adds_to_existing_file(tmp_path):
+    path = str(tmp_path / 'metrics.prom')
+    instrumentation.write_metrics(RECORDS, path)
+    instrumentation.write_metrics(MORE, path, mode='a')
+    assert instrumentation.read_prometheus(path) == instrumentation.prometheus_totals(RECORDS + MORE)
+
+def test_append_new_stages_and_counters(tmp_path):
+    path = str(tmp_path / 'metrics.prom')
+    instrumentation.write_metrics(RECORDS, path)
+    instrumentation.write_metrics(MORE, path, mode='a')
+    stages, counters = instrumentation.read_prometheus(path)
+    # only in the appended record, past the last bucket
+    assert stages['grade1.blur'] == [0] * len(instrumentation.SECONDS_BUCKETS) + [1, 12.0]
+    assert counters['cascade.second_failures'] == 1
+    # in both
+    assert stages['grade.load'][-2:] == [3, 2.25]
+    assert counters['grade.sheets'] == 3
+    assert counters['grade.rows_skipped'] == 3
+
+def test_append_to_missing_file(tmp_path):
+    path = str(tmp_path / 'metrics.prom')
+    instrumentation.write_metrics(MORE, path, mode='a')
+    assert instrumentation.read_prometheus(path) == instrumentation.prometheus_totals(MORE)
+
+def test_write_replaces_without_append(tmp_path):
+    path = str(tmp_path / 'metrics.prom')
+    instrumentation.write_metrics(RECORDS, path)
+    instrumentation.write_metrics(MORE, path)
+    assert instrumentation.read_prometheus(path) == instrumentation.prometheus_totals(MORE)
+
+def test_read_skips_malformed_lines(tmp_path):
+    path = tmp_path / 'metrics.prom'
+    path.write_text(instrumentation.prometheus_text(RECORDS) + '\n'.join([
+        '',
+        '# a comment {stage="grade.load"} 1',
+        'not a metric line',
+        'grading_events_total{event="grade.sheets"}',          # no value
+        'grading_stage_seconds_bucket{stage="grade.load",le="0.3"} 7', # not one of the buckets
+        'other_events_total{event="grade.sheets"} 5',          # another prefix
+        'grading_events_total{event="grade.ratio"} 0.5',
+    ]) + '\n')
+    stages, counters = instrumentation.read_prometheus(str(path))
+    expected_stages, expected_counters = instrumentation.prometheus_totals(RECORDS)
+    assert stages == expected_stages
+    assert counters == dict(expected_counters, **{'grade.ratio': 0.5})
+
+def test_add_totals():
+    totals = instrumentation.prometheus_totals(RECORDS)
+    more = instrumentation.prometheus_totals(MORE)
+    assert instrumentation.add_totals(totals, more) == instrumentation.prometheus_totals(RECORDS + MORE)
+
+def test_laps_and_spans_add_up(metrics, monkeypatch):
+    clock = iter([0.0, 0.25, 0.75, 1.0, 1.0, 1.5, 2.0, 2.0625])
+    monkeypatch.setattr(instrumentation.time, 'perf_counter', lambda: next(clock))
+    timer = instrumentation.laps('grade1')
+    timer.lap('load')   # 0.25
+    timer.lap('blur')   # 0.5
+    timer.lap('blur')   # 0.25, added to the first blur
+    with instrumentation.span('grade1.scan'): # 0.5
+        pass
+    with instrumentation.span('grade1.scan'): # 0.0625
+        pass
+    instrumentation.count('grade1.rows_skipped', 4)
+    instrumentation.count('grade1.rows_skipped')
+    record = instrumentation.snapshot(sheet='a-3.jpg')
+    assert record == {'sheet': 'a-3.jpg', 'spans': {'grade1.load': 0.25, 'grade1.blur': 0.75, 'grade1.scan': 0.5625},
+                      'counters': {'grade1.rows_skipped': 5}}
+
+def test_exit_records_merge(metrics, tmp_path):
+    # two CLI runs appending their record at exit
+    path = str(tmp_path / 'metrics.prom')
+    for seconds in (0.25, 4.0):
+        instrumentation.reset()
+        instrumentation.add_time('grade1.blur', seconds)
+        instrumentation.count('grade1.sheets')
+        instrumentation.write_at_exit(path)
+    stages, counters = instrumentation.read_prometheus(path)
+    buckets = instrumentation.SECONDS_BUCKETS
+    assert stages['grade1.blur'] == [int(0.25 <= b) + int(4.0 <= b) for b in buckets] + [2, 4.25]
+    assert counters == {'grade1.sheets': 2}
+
+def test_exit_records_append_jsonl(metrics, tmp_path):
+    path = str(tmp_path / 'metrics.jsonl')
+    for _ in range(2):
+        instrumentation.reset()
+        instrumentation.count('grade.sheets')
+        instrumentation.write_at_exit(path)
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert [record['counters'] for record in records] == [{'grade.sheets': 1}] * 2
+
+def test_disabled_records_nothing():
+    instrumentation.reset()
+    assert instrumentation.laps('grade') is instrumentation.NULL_TIMER
+    assert instrumentation.span('grade.load') is instrumentation.NULL_TIMER
+    instrumentation.count('grade.sheets')
+    assert instrumentation.snapshot() == {'spans': {}, 'counters': {}}
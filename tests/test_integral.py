@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import grade1
+from integral import integral_image, rect_sum, window_sums
+
+@pytest.fixture
+def img():
+    return np.random.default_rng(4).integers(0, 256, (17, 23))
+
+def test_integral_image(img):
+    sat = integral_image(img)
+    assert sat.shape == (18, 24)
+    for y in range(0, 18, 3):
+        for x in range(0, 24, 5):
+            assert sat[y, x] == img[:y, :x].sum()
+
+@pytest.mark.parametrize('bounds', [(2, 9, 3, 20), (0, 17, 0, 23), (5, 5, 1, 4), (-4, -1, -10, 30), (10, 3, 0, 5), (-40, 40, 2, 3)])
+def test_rect_sum_matches_slicing(img, bounds):
+    y0, y1, x0, x1 = bounds
+    assert rect_sum(integral_image(img), y0, y1, x0, x1) == img[y0:y1, x0:x1].sum()
+
+def test_rect_sum_arrays(img):
+    sat = integral_image(img)
+    y0 = np.arange(0, 15)[:, None]
+    x0 = np.arange(0, 20)[None, :]
+    sums = rect_sum(sat, y0, y0 + 4, x0, x0 + 3)
+    assert sums.shape == (15, 20)
+    for y in range(15):
+        for x in range(20):
+            assert sums[y, x] == img[y:y+4, x:x+3].sum()
+
+def test_window_sums(img):
+    sums = window_sums(integral_image(img), 4, 6)
+    assert sums.shape == (14, 18)
+    for y in range(14):
+        for x in range(18):
+            assert sums[y, x] == img[y:y+4, x:x+6].sum()
+
+def test_box_responses_match_is_box_present():
+    # a couple of drawn box outlines on noise, some cut off by the bottom edge
+    image = (np.random.default_rng(5).random((60, 80)) < 0.15).astype(np.uint8)
+    for y, x in [(5, 10), (30, 40), (52, 5)]:
+        image[y:y+12, x:x+16][[0, -1], :] = 1
+        image[y:y+12, x:x+16][:, [0, -1]] = 1
+    receptive_field, border, filled = (13, 17), 2, 14
+    ry, rx = receptive_field
+    responses = grade1.box_responses(image, receptive_field, border, filled)
+    present, _ = responses
+    assert present.any()
+    for i in range(present.shape[0]):
+        for j in range(present.shape[1]):
+            region = image[i:i + 2*(ry//2), j:j + 2*(rx//2)]
+            assert present[i, j] == grade1.is_box_present(region, border, filled), (i, j)
+            found, total = grade1.lookup_box(image, responses, i + ry//2, j + rx//2, receptive_field, border, filled)
+            assert found == present[i, j]
+            if found:
+                assert total == region.sum()
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import layout
+
+def sheet(dx=0, dy=0):
+    # white page with a few dark lines, moved by (dx, dy)
+    img = np.full((300, 240), 255, dtype=np.uint8)
+    for x in [30, 70, 75, 150, 200]:
+        img[20+dy:280+dy, x+dx:x+dx+3] = 0
+    for y in [40, 90, 95, 180, 250]:
+        img[y+dy:y+dy+2, 20+dx:220+dx] = 0
+    return img
+
+@pytest.mark.parametrize('shift', [-13, 0, 8])
+def test_align_profile_finds_shift(shift):
+    template = np.zeros(400)
+    template[[50, 120, 125, 260, 330]] = 10
+    profile = np.roll(template, shift)
+    scale, found, confidence = layout.align_profile(template, profile)
+    assert (scale, found) == (1.0, shift)
+    assert confidence > 0.99
+
+def test_template_round_trip(tmp_path):
+    path = str(tmp_path / 'form_240x300.json')
+    profiles = layout.dark_profiles(sheet())
+    layout.save_template(path, [30, 70], [(40, 90, 0, 80)], profiles)
+    template = layout.load_template(path)
+    assert template['vertical_lines'] == [30, 70]
+    assert template['question_boxes'] == [[40, 90, 0, 80]]
+    np.testing.assert_array_equal(template['column_profile'], profiles[0])
+    np.testing.assert_array_equal(template['row_profile'], profiles[1])
+
+def test_get_layout_reuses_template(tmp_path):
+    calls = []
+    def detect(img):
+        calls.append(img)
+        return [30, 70, 150], [(40, 90, 0, 80), (180, 250, 80, 160)]
+
+    cache_dir = str(tmp_path)
+    lines, boxes, confidence = layout.get_layout(sheet(), detect, 'form', cache_dir)
+    assert (lines, boxes, confidence) == ([30, 70, 150], [(40, 90, 0, 80), (180, 250, 80, 160)], 1.0)
+
+    # the same form moved on the scanner: no detection, the template grid moves along
+    lines, boxes, confidence = layout.get_layout(sheet(dx=4, dy=-6), detect, 'form', cache_dir)
+    assert len(calls) == 1
+    assert confidence > 0.9
+    assert lines == [34, 74, 154]
+    assert boxes == [(34, 84, 0, 80), (174, 244, 80, 160)]
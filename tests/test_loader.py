@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+import grade
+import loader
+from conftest import TEST_IMAGES
+
+SHEETS = ['a-27.jpg', 'c-18.jpg']
+
+@pytest.fixture(scope='module')
+def pages():
+    return [np.asarray(Image.open(os.path.join(TEST_IMAGES, name)).convert('L')) for name in SHEETS]
+
+@pytest.fixture
+def tiff(tmp_path, pages):
+    # a batch from a sheet feeder, one page per sheet
+    path = str(tmp_path / 'batch.tif')
+    images = [Image.fromarray(page) for page in pages]
+    images[0].save(path, save_all=True, append_images=images[1:], compression='tiff_deflate')
+    return path
+
+def test_page_count(tiff):
+    assert loader.page_count(tiff) == 2
+    with open(tiff, 'rb') as f:
+        assert loader.page_count(f.read()) == 2
+    assert loader.page_count(os.path.join(TEST_IMAGES, SHEETS[0])) == 1
+
+def test_iter_pages(tiff, pages):
+    indices = []
+    for index, page in loader.iter_pages(tiff):
+        indices.append(index)
+        np.testing.assert_array_equal(loader.page_gray(page), pages[index])
+    assert indices == [0, 1]
+
+def test_page_gray_crops_and_reduces(tiff, pages):
+    for index, page in loader.iter_pages(tiff):
+        img = loader.page_gray(page, 100, 20, reduce=2)
+        height, width = pages[index].shape
+        assert img.shape == (-(-height // 2) - 100, -(-width // 2) - 40)
+
+def test_page_path():
+    assert loader.page_path('out/a-27.txt', 3) == os.path.join('out', 'a-27_page3.txt')
+    assert loader.page_path('answers', 0) == 'answers_page0'
+
+def test_single_page_entry_points_refuse_pages(tiff):
+    with pytest.raises(ValueError, match='2 pages'):
+        grade.answers_from_image(tiff)
+    with open(tiff, 'rb') as f:
+        with pytest.raises(ValueError):
+            grade.answers_from_image(f.read())
+    loader.single_page(os.path.join(TEST_IMAGES, SHEETS[0]), 'grade.answers_from_pages') # one page is fine
+
+def test_answers_from_pages(tiff, pages):
+    answers = grade.answers_from_pages(tiff)
+    assert sorted(answers) == [0, 1]
+    for index, page in enumerate(pages):
+        assert answers[index] == grade.answers_from_image(page)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import morphology
+from utils import pad_image
+
+# the per-pixel loops of the original grade1.py, 3x3 structuring elements only
+def erosion_loop(image, structure):
+    result = np.zeros_like(image)
+    pad_img = pad_image(image)
+    for i in range(image.shape[0]):
+        for j in range(image.shape[1]):
+            result[i, j] = np.min(pad_img[i:i+3, j:j+3] | ~structure)
+    return result
+
+def dilation_loop(image, structure):
+    result = np.zeros_like(image)
+    pad_img = pad_image(image)
+    for i in range(image.shape[0]):
+        for j in range(image.shape[1]):
+            result[i, j] = np.max(pad_img[i:i+3, j:j+3] & structure)
+    return result
+
+STRUCTURES = {
+    'cross': np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=bool),
+    'square': np.ones((3, 3), dtype=bool),
+    'row': np.array([[0, 0, 0], [1, 1, 1], [0, 0, 0]], dtype=bool),
+}
+
+@pytest.fixture
+def image():
+    # sparse enough that erosion leaves something behind
+    return np.random.default_rng(3).random((29, 37)) < 0.6
+
+@pytest.mark.parametrize('name', STRUCTURES)
+def test_erosion_matches_loop(image, name):
+    structure = STRUCTURES[name]
+    np.testing.assert_array_equal(morphology.erosion(image, structure), erosion_loop(image, structure))
+
+@pytest.mark.parametrize('name', STRUCTURES)
+def test_dilation_matches_loop(image, name):
+    structure = STRUCTURES[name]
+    np.testing.assert_array_equal(morphology.dilation(image, structure), dilation_loop(image, structure))
+
+@pytest.mark.parametrize('in_place', [False, True])
+@pytest.mark.parametrize('name', STRUCTURES)
+def test_opening_matches_loop(image, name, in_place):
+    structure = STRUCTURES[name]
+    expected = dilation_loop(erosion_loop(image, structure), structure)
+    np.testing.assert_array_equal(morphology.opening(image, structure, in_place=in_place), expected)
+
+def test_buffers_reused(image):
+    structure = STRUCTURES['cross']
+    out = np.empty(image.shape, dtype=bool)
+    scratch = np.zeros((image.shape[0] + 2, image.shape[1] + 2), dtype=bool)
+    assert morphology.dilation(image, structure, out=out, scratch=scratch) is out
+    np.testing.assert_array_equal(out, dilation_loop(image, structure))
+
+def test_even_structure():
+    with pytest.raises(ValueError):
+        morphology.erosion(np.zeros((4, 4), dtype=bool), np.ones((2, 2), dtype=bool))
+
+def test_wrong_scratch(image):
+    with pytest.raises(ValueError):
+        morphology.erosion(image, STRUCTURES['cross'], scratch=np.zeros(image.shape, dtype=bool))
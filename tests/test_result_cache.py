@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import layout
+import result_cache
+
+def test_store_and_lookup(tmp_path):
+    cache_dir = str(tmp_path)
+    key = result_cache.entry_key('digest', 'grade', 2, {'threshold': None})
+    assert result_cache.lookup(key, cache_dir) is None
+    result_cache.store(key, ['A', 'BD', 'Cx'], cache_dir)
+    assert result_cache.lookup(key, cache_dir) == ['A', 'BD', 'Cx']
+    # pages of a multi-page scan keep their integer keys
+    result_cache.store(key, {0: ['A'], 3: ['E']}, cache_dir)
+    assert result_cache.lookup(key, cache_dir) == {0: ['A'], 3: ['E']}
+
+def test_key_covers_settings():
+    key = result_cache.entry_key('digest', 'grade', 2, {'threshold': None, 'reduce': 1})
+    assert key == result_cache.entry_key('digest', 'grade', 2, {'reduce': 1, 'threshold': None})
+    assert key != result_cache.entry_key('digest', 'grade', 3, {'threshold': None, 'reduce': 1})
+    assert key != result_cache.entry_key('digest', 'grade1', 2, {'threshold': None, 'reduce': 1})
+    assert key != result_cache.entry_key('digest', 'grade', 2, {'threshold': 'otsu', 'reduce': 1})
+    assert key != result_cache.entry_key('other', 'grade', 2, {'threshold': None, 'reduce': 1})
+
+def test_evict_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path)
+    keys = [result_cache.entry_key(str(i), 'grade', 2, {}) for i in range(5)]
+    for i, key in enumerate(keys):
+        result_cache.store(key, ['A'] * 10, cache_dir)
+        os.utime(result_cache.entry_path(key, cache_dir), (1000 + i, 1000 + i))
+    result_cache.lookup(keys[0], cache_dir) # used again, now the most recent
+    size = os.path.getsize(result_cache.entry_path(keys[0], cache_dir))
+
+    assert result_cache.evict(cache_dir, 2 * size) == 2 * size
+    assert [result_cache.lookup(key, cache_dir) is not None for key in keys] == [True, False, False, False, True]
+
+def test_store_keeps_usage_under_max(tmp_path):
+    cache_dir = str(tmp_path)
+    for i in range(20):
+        result_cache.store(result_cache.entry_key(str(i), 'grade', 2, {}), ['A'] * 10, cache_dir, max_bytes=500)
+    with open(os.path.join(cache_dir, result_cache.USAGE_FILE)) as f:
+        usage = int(f.read())
+    entries = [entry.path for directory in os.scandir(cache_dir) if directory.is_dir() for entry in os.scandir(directory.path)]
+    assert usage == sum(os.path.getsize(path) for path in entries) <= 500
+
+def test_cached_run(tmp_path):
+    source = tmp_path / 'sheet.jpg'
+    source.write_bytes(b'scan')
+    cache_dir = str(tmp_path / 'cache')
+    runs, written = [], []
+    def run():
+        runs.append(1)
+        return ['A', 'B']
+    def write(answers, path):
+        written.append((answers, path))
+
+    for copy in ['sheet.jpg', 'copy.jpg']:
+        (tmp_path / copy).write_bytes(b'scan') # a renamed scan is the same sheet
+        result = result_cache.cached_run(str(tmp_path / copy), 'out.txt', 'grade', 2, {}, run, write, cache_dir)
+        assert result == ['A', 'B']
+    assert len(runs) == 1
+    assert written == [(['A', 'B'], 'out.txt')]
+
+    result_cache.cached_run(str(source), 'out.txt', 'grade', 2, {}, run, write, cache_dir, use_stored=False)
+    assert len(runs) == 2
+
+def test_cached_run_pages(tmp_path):
+    source = tmp_path / 'batch.tif'
+    source.write_bytes(b'pages')
+    cache_dir, written = str(tmp_path / 'cache'), []
+    for _ in range(2):
+        result_cache.cached_run(str(source), 'out.txt', 'grade', 2, {'pages': True}, lambda: {0: ['A'], 1: ['B']},
+                                lambda answers, path: written.append((answers, path)), cache_dir)
+    assert written == [(['A'], 'out_page0.txt'), (['B'], 'out_page1.txt')]
+
+def test_form_digest_follows_templates(tmp_path):
+    # answers read with a cached box grid are keyed on the grid
+    cache_dir = str(tmp_path)
+    assert layout.form_digest('form', cache_dir) is None
+    profiles = np.zeros(240), np.zeros(300)
+    layout.save_template(layout.template_path('form', (300, 240), cache_dir), [30], [], profiles)
+    layout.save_template(layout.template_path('other', (300, 240), cache_dir), [30], [], profiles)
+    digest = layout.form_digest('form', cache_dir)
+    assert digest is not None
+    layout.save_template(layout.template_path('other', (300, 240), cache_dir), [31], [], profiles)
+    assert layout.form_digest('form', cache_dir) == digest
+    layout.save_template(layout.template_path('form', (300, 240), cache_dir), [31], [], profiles)
+    assert layout.form_digest('form', cache_dir) != digest
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import results_store
+from answer_masks import encode_answer, decode_answer, encode_answers, decode_answers
+
+def test_answer_mask_layout():
+    assert encode_answer('BDx') == 0b101010
+    assert encode_answer('A') == 0b10000
+    assert encode_answer('') == 0
+    assert decode_answer(0b101010) == 'BDx'
+
+def test_every_mask_round_trips():
+    for mask in range(64):
+        assert encode_answer(decode_answer(mask)) == mask
+
+def test_unknown_option():
+    with pytest.raises(ValueError):
+        encode_answer('AF')
+
+def test_encode_answers():
+    answers = ['A', 'BC', '', 'Ex']
+    masks = encode_answers(answers)
+    assert masks.dtype == np.uint8
+    assert decode_answers(masks) == answers
+
+def write_answers(path, answers):
+    with open(path, 'w') as f:
+        f.write('\n'.join(f"{q} {answer}" for q, answer in enumerate(answers, 1)) + '\n')
+
+def test_import_and_score(tmp_path):
+    key = ['A', 'B', 'CD', 'E']
+    for student, answers in [('s1', ['A', 'B', 'CD', 'E']), ('s2', ['A', 'C', 'C', 'Ex']), ('s3', ['B', 'B'])]:
+        write_answers(tmp_path / f"{student}.txt", answers)
+    write_answers(tmp_path / 'key.txt', key)
+
+    connection = results_store.open_store(str(tmp_path / 'cohort.db'))
+    paths = [str(tmp_path / f"{student}.txt") for student in ['s2', 's1', 's3']]
+    assert results_store.import_text_files(connection, 'exam', paths, 'grade') == 3
+    results_store.set_answer_key(connection, 'exam', results_store.read_answer_strings(str(tmp_path / 'key.txt')))
+
+    students, masks = results_store.load_masks(connection, 'exam')
+    assert students == ['s1', 's2', 's3']
+    assert decode_answers(masks[2]) == ['B', 'B', '', ''] # shorter sheet padded with blanks
+    assert results_store.score(connection, 'exam') == {'s1': 4, 's2': 1, 's3': 1}
+
+    report = results_store.report(connection, 'exam')
+    assert report['num_sheets'] == 3
+    assert report['sheets'][1]['incorrect'][0] == {'question': 2, 'answer': 'C', 'key': 'B'}
+
+    # grading a student again replaces the row
+    results_store.add_sheets(connection, 'exam', [('s3', 'again', key)])
+    assert results_store.score(connection, 'exam')['s3'] == 4
+    connection.close()
+
+def test_missing_key(tmp_path):
+    connection = results_store.open_store(str(tmp_path / 'cohort.db'))
+    with pytest.raises(KeyError):
+        results_store.load_answer_key(connection, 'exam')
+    connection.close()
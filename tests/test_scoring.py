@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+import grade
+import scoring
+from answer_masks import encode_answers
+
+KEY = ['A', 'BD', 'C', '', 'Ex']
+
+def test_score_masks():
+    masks = scoring.encode_cohort([KEY, ['A', 'B', 'CD', 'A', 'E'], ['B']])
+    scores = scoring.score_masks(masks, encode_answers(KEY))
+    np.testing.assert_array_equal(scores['sheet_correct'], [5, 1, 1]) # a blank is right where the key has none
+    # B of BD: half; C and a wrong D: nothing; a mark where the key has none: nothing; E without x: right option
+    np.testing.assert_allclose(scores['partial'][1], [1, 0.5, 0, 0, 1])
+    np.testing.assert_allclose(scores['partial'][2], [0, 0, 0, 1, 0]) # padded with blanks
+    np.testing.assert_allclose(scores['question_correct'], [2/3, 1/3, 1/3, 2/3, 1/3])
+    np.testing.assert_allclose(scores['question_written'], [0, 0, 0, 0, 1/3])
+    np.testing.assert_array_equal(scores['option_counts'][0], [2, 1, 0, 0, 0])
+
+def test_score_masks_matches_string_comparison():
+    rng = np.random.default_rng(6)
+    key = encode_answers(['ABCDE'[i] for i in rng.integers(0, 5, 40)])
+    masks = rng.integers(0, 64, (25, 40)).astype(np.uint8)
+    masks = np.where(rng.random(masks.shape) < 0.5, key, masks) # about half right
+    scores = scoring.score_masks(masks, key)
+    expected = [sum(int(a) == int(b) for a, b in zip(sheet, key)) for sheet in masks]
+    np.testing.assert_array_equal(scores['sheet_correct'], expected)
+
+def test_key_length_mismatch():
+    with pytest.raises(ValueError):
+        scoring.score_masks(np.zeros((2, 3), np.uint8), np.zeros(4, np.uint8))
+
+def test_cohort_report():
+    masks = scoring.encode_cohort([KEY, ['A', 'B']], len(KEY))
+    report = scoring.cohort_report(['s1', 's2'], masks, encode_answers(KEY))
+    assert report['summary']['max_correct'] == 5
+    assert report['sheets'][1]['correct'] == 2 # A and the blank question 4
+    assert report['sheets'][1]['incorrect'][0] == {'question': 2, 'answer': 'B', 'key': 'BD'}
+    assert [question['key'] for question in report['questions']] == KEY
+
+def test_check_answers(tmp_path, capsys):
+    path = tmp_path / 'key.txt'
+    path.write_text(''.join(f"{q} {answer}\n" for q, answer in enumerate(KEY + ['A'], 1)))
+    # recognised answers are option numbers, the sheet covers fewer questions than the key
+    result = grade.check_answers([[1], [2, 4], [3], [], [5]], str(path))
+    assert result['correct'] == 4
+    assert 'Correct answers: 4/5' in capsys.readouterr().out
+    with pytest.raises(ValueError):
+        grade.check_answers([[1]] * 7, str(path))
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import grade
+import thresholding
+
+# the retry loop of the original grade.get_vertical_lines, with its filter_lines
+def vertical_lines_loop(img):
+    vertical_sum = np.sum(img, axis=0)
+    vertical_lines = []
+    threshold = 0.85
+    while len(vertical_lines) != 30:
+        vertical_threshold = threshold * np.max(vertical_sum)
+        vertical_lines = np.where(vertical_sum > vertical_threshold)[0]
+        vertical_lines = np.unique(vertical_lines)
+        vertical_lines = [vertical_lines[0]] + [vertical_lines[i] for i in range(1, len(vertical_lines)) if vertical_lines[i] - vertical_lines[i-1] > 10]
+        filtered_lines = [vertical_lines[0]]
+        for i in range(1, len(vertical_lines)):
+            if vertical_lines[i] - vertical_lines[i-1] > 15:
+                filtered_lines.append(vertical_lines[i])
+        vertical_lines = filtered_lines
+        threshold -= 0.01
+    return vertical_lines
+
+def otsu_loop(img):
+    # largest between class variance over every split of the grey levels
+    best, best_split = -1, 0
+    for split in range(255):
+        dark, bright = img[img <= split], img[img > split]
+        if not len(dark) or not len(bright):
+            continue
+        between = len(dark) * len(bright) * (dark.mean() - bright.mean()) ** 2
+        if between > best:
+            best, best_split = between, split
+    return best_split + 0.5
+
+def line_image(weakest, seed):
+    # 30 box sides of different strength, some doubled within the merge gap, some
+    # followed by a weaker edge within the filter gap, over faint noise
+    rng = np.random.default_rng(seed)
+    width = 30 * 40 + 20
+    column_sums = rng.uniform(0, 0.1, width)
+    for i, x in enumerate(range(10, width - 20, 40)):
+        column_sums[x] = rng.uniform(weakest, 1) if i else 1.0
+        if i % 4 == 1:
+            column_sums[x + 3] = column_sums[x] * 0.9
+        if i % 5 == 2:
+            column_sums[x + 13] = column_sums[x] * 0.95
+    return (column_sums[None, :] * 1000).astype(np.int64).repeat(3, axis=0)
+
+@pytest.mark.parametrize('weakest, seed', [(0.8, 1), (0.6, 2), (0.3, 3), (0.15, 4)])
+def test_vertical_lines_match_loop(weakest, seed):
+    img = line_image(weakest, seed)
+    assert grade.get_vertical_lines(img) == vertical_lines_loop(img)
+    assert len(grade.get_vertical_lines(img)) == 30
+
+def test_vertical_lines_missing():
+    with pytest.raises(ValueError):
+        grade.get_vertical_lines(line_image(0.8, 1)[:, :600])
+
+def test_line_levels():
+    levels = grade.line_levels()
+    assert len(levels) == 86
+    assert levels[0] == 0.85
+    assert abs(levels[-1]) < 1e-9
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_otsu_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    img = np.concatenate([rng.normal(60, 20, 3000), rng.normal(190, 30, 5000)])
+    img = np.clip(img, 0, 255).astype(np.uint8).reshape(80, 100)
+    assert thresholding.otsu_level(img) == otsu_loop(img)
+
+def test_otsu_float_image():
+    img = np.concatenate([np.full(50, 0.1), np.full(70, 0.8)]).reshape(12, 10)
+    level = thresholding.otsu_level(img)
+    assert 0.1 < level < 0.8
+    assert thresholding.binarize(img, 'otsu').sum() == 70 * 255
+
+def test_level():
+    img = np.array([[0, 100], [200, 255]], dtype=np.uint8)
+    assert thresholding.level(img, 'mean') == np.mean(img)
+    assert thresholding.level(img, 120) == 120
+    with pytest.raises(ValueError):
+        thresholding.level(img, 'median')
+
+def test_local_level_follows_paper():
+    # paper getting darker to the right, the level follows it
+    img = np.tile(np.linspace(250, 120, 512).astype(np.uint8), (256, 1))
+    local = thresholding.level(img, 'local', reference=150)
+    assert local.shape == img.shape
+    assert local[:, :100].mean() > local[:, -100:].mean()
+    assert (thresholding.binarize(img, 'local', reference=150) == 255).all()
+
+def test_setting():
+    assert thresholding.setting('otsu') == 'otsu'
+    assert thresholding.setting('120') == 120
+    assert thresholding.setting('0.5') == 0.5
+    with pytest.raises(ValueError):
+        thresholding.setting('bright')
@@ -0,0 +1,91 @@
+import numpy as np
+
+# Thresholds shared by grade.py, grade1.py, extract.py and layout.py. level()
+# turns a threshold setting into the level to compare the image with:
+#
+#   a number   fixed level, the pipelines' defaults (grade 100, grade1 150, extract 100)
+#   'mean'     mean of the image, what grade.threshold_image uses on the Sobel output
+#   'otsu'     level that best separates the histogram into dark and bright pixels
+#   'local'    a level per pixel for unevenly lit scans: the pipeline's fixed level,
+#              scaled by how bright the paper is around the pixel
+#
+# Every method comes from histograms (one of the image, or one per tile for
+# 'local'), so each costs about one pass over the image. Pixels are compared with
+# the level directly (img > level is bright, img < level is dark); for the
+# histogram based levels the two are exact complements.
+
+METHODS = ('mean', 'otsu', 'local')
+LOCAL_TILE = 128         # pixels, light changes slowly across a scan
+LOCAL_PERCENTILE = 90    # most of every tile is paper
+LOCAL_MIN_PAPER = 0.35   # of the brightest tiles, darker tiles are taken to be print
+
+# region functions
+def grey_histogram(img):
+    # counts of the 256 grey levels of a uint8 image, cv2 is several times faster than np.bincount.
+    # Imported here, the fixed levels grade1.py and extract.py use by default do not need it
+    import cv2
+    return cv2.calcHist([img], [0], None, [256], [0, 256]).ravel()
+
+def otsu_level(img):
+    # split of the histogram with the largest between class variance
+    if img.dtype == np.uint8:
+        counts, values = grey_histogram(img), np.arange(256, dtype=np.float64)
+    else:
+        counts, edges = np.histogram(img, bins=256)
+        values = (edges[:-1] + edges[1:]) / 2
+    dark_count = np.cumsum(counts, dtype=np.float64)
+    bright_count = dark_count[-1] - dark_count
+    dark_sum = np.cumsum(counts * values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        between = (dark_sum[-1] * dark_count - dark_count[-1] * dark_sum) ** 2 / (dark_count * bright_count)
+    between[~np.isfinite(between)] = -1 # splits with an empty class
+    split = int(np.argmax(between))
+    if img.dtype == np.uint8:
+        return split + 0.5 # between two grey levels, so > and < agree
+    return float(edges[split + 1])
+
+def paper_level(img, tile=LOCAL_TILE, percentile=LOCAL_PERCENTILE):
+    # brightness of the paper around every pixel: a high percentile of every tile's
+    # histogram, interpolated between the tile centres
+    if img.ndim != 2 or img.dtype != np.uint8:
+        raise ValueError("Local thresholds need a single channel uint8 image.")
+    height, width = img.shape
+    counts = np.array([[grey_histogram(img[top:top + tile, left:left + tile]) for left in range(0, width, tile)]
+                       for top in range(0, height, tile)])
+    cumulative = np.cumsum(counts, axis=2)
+    paper = np.argmax(cumulative >= cumulative[:, :, -1:] * (percentile / 100), axis=2).astype(np.float32)
+    # a tile covered by print (a filled area, a black bar) is no estimate of the paper
+    paper = np.maximum(paper, np.float32(np.percentile(paper, percentile) * LOCAL_MIN_PAPER))
+    import cv2
+    return cv2.resize(paper, (width, height), interpolation=cv2.INTER_LINEAR)
+
+def local_level(img, reference):
+    # reference is the level tuned for white paper (255), scaled by the paper brightness around each pixel
+    return paper_level(img) * np.float32(reference / 255)
+
+def level(img, threshold, reference=128):
+    # scalar, or an array of the image's shape for 'local'. reference is the pipeline's
+    # fixed level, which 'local' adapts to the lighting
+    if threshold == 'mean':
+        return np.mean(img)
+    if threshold == 'otsu':
+        return otsu_level(img)
+    if threshold == 'local':
+        return local_level(img, reference)
+    if isinstance(threshold, str):
+        raise ValueError(f"Unknown threshold '{threshold}', expected a number or one of {METHODS}.")
+    return threshold
+
+def binarize(img, threshold, reference=128):
+    # 0 (dark) / 255 (bright) uint8 image
+    return (img > level(img, threshold, reference)) * np.uint8(255)
+
+def setting(value):
+    # command line value: a method name or a number
+    if value in METHODS:
+        return value
+    try:
+        return float(value) if '.' in value else int(value)
+    except ValueError:
+        raise ValueError(f"Unknown threshold '{value}', expected a number or one of {METHODS}.") from None
+# endregion functions
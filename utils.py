@@ -9,6 +9,18 @@ def read_answers(file_path):
                     answers.append(list(parts[1]))
         return answers
 
+def read_answer_strings(file_path):
+    # answers indexed by question number - 1, blank questions are kept as ''.
+    # accepts both "1 AB" and "1: AB" lines
+    answers = {}
+    with open(file_path, 'r') as file:
+        for line in file:
+            parts = line.strip().split(maxsplit=1)
+            if not parts:
+                continue
+            answers[int(parts[0].rstrip(':'))] = parts[1].strip() if len(parts) == 2 else ''
+    return [answers.get(i, '') for i in range(1, max(answers, default=0) + 1)]
+
 def get_question_ordering():
     np.random.seed(42) # ensures consistent jumbling order
     question_ordering = np.arange(85)
@@ -0,0 +1,225 @@
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import batch
+
+# Watch-folder mode: grade scans as the scanners drop them into a directory.
+#
+# A file is graded once its size and modification time have not changed for
+# --settle seconds, so half written scans are never picked up. New files are
+# noticed through inotify on Linux (no extra package, called through libc) and
+# by rescanning the directories every --interval seconds everywhere else.
+# At most --queue-size sheets are handed to the worker pool at a time.
+#
+# Every finished sheet is appended to the results file (JSON lines) with the
+# size and modification time it was graded at. On restart the file is read
+# back and those sheets are skipped, so no sheet is graded twice.
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+# region functions
+class Inotify:
+    # wakes the watch loop up when a file in one of the directories is written or moved in
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for directory in directories:
+            if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+
+    def fileno(self):
+        return self.fd
+
+    def drain(self):
+        # the events themselves are not needed, the directories are rescanned
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+def open_inotify(directories):
+    # None when inotify is not available, the loop then only polls
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        return Inotify(directories)
+    except (OSError, AttributeError):
+        return None
+
+def init_worker(*args):
+    # Ctrl-C stops the watch loop, which lets the workers finish their sheets
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    batch.init_worker(*args)
+
+def sheet_key(sheet):
+    # identifies one version of a scan, None if it disappeared
+    try:
+        stat = os.stat(sheet)
+    except FileNotFoundError:
+        return None
+    return os.path.abspath(sheet), stat.st_size, stat.st_mtime_ns
+
+def load_graded(results_path):
+    # keys of the sheets already in the results file
+    graded = set()
+    if not os.path.exists(results_path):
+        return graded
+    with open(results_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                graded.add((record['sheet'], record['size'], record['mtime_ns']))
+            except (ValueError, KeyError):
+                continue # a line cut short by a crash
+    return graded
+
+def append_result(results, key, method, output, answers, error):
+    sheet, size, mtime_ns = key
+    record = {'sheet': sheet, 'size': size, 'mtime_ns': mtime_ns, 'method': method,
+              'output': output, 'answers': answers, 'error': error, 'graded_at': time.time()}
+    results.write(json.dumps(record) + '\n')
+    results.flush()
+    os.fsync(results.fileno())
+
+def record_results(results, futures, running, graded, method):
+    # appends the results of finished (or still running, waited for) futures, taking them off running
+    for future in futures:
+        key = running[future]
+        try:
+            _, output, answers, error, _ = future.result()
+        except Exception as e: # e.g. a worker process died
+            output, answers, error = None, None, f"{type(e).__name__}: {e}"
+        append_result(results, key, method, output, answers, error)
+        del running[future] # only once its result is on disk
+        graded.add(key)
+        print(f"Failed {key[0]}: {error}" if error else f"Graded {key[0]} -> {output}")
+
+def watch(directories, output_dir, results_path, method='grade', workers=None, interval=2.0, settle=1.0,
+          queue_size=None, once=False, form_id=None, annotate=False, cache_dir=None):
+    for directory in directories:
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"{directory} - directory does not exist.")
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+    queue_size = queue_size or 2 * workers
+    options = {'annotate': annotate}
+    if method == 'grade' and form_id is not None:
+        options['form_id'] = form_id
+    if cache_dir is not None:
+        options['cache_dir'] = cache_dir
+
+    # with several directories a scan's answer file is named by its path below their
+    # common directory, so scans with the same name in two of them do not overwrite
+    # each other's answers (see batch.answer_names)
+    root = os.path.commonpath([os.path.abspath(directory) for directory in directories]) if len(directories) > 1 else None
+
+    graded = load_graded(results_path)
+    candidates = {} # sheet -> (key, time the key was first seen), waiting to settle
+    running = {}    # future -> key
+    notifier = open_inotify(directories)
+    # finished futures write to this pipe, so one select() waits for both files and results
+    wake_read, wake_write = os.pipe()
+    os.set_blocking(wake_read, False)
+    print(f"Watching {', '.join(directories)} with {'inotify' if notifier else 'polling'}, "
+          f"{len(graded)} sheets already graded")
+
+    stopping = False
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(method, False, annotate)) as executor, \
+             open(results_path, 'a') as results:
+            try:
+                while True:
+                    try:
+                        record_results(results, [future for future in running if future.done()], running, graded, method)
+
+                        if not stopping:
+                            now = time.monotonic()
+                            busy = set(running.values())
+                            seen = {}
+                            for sheet in batch.find_sheets(directories):
+                                key = sheet_key(sheet)
+                                if key is None or key[1] == 0 or key in graded or key in busy:
+                                    continue
+                                previous = candidates.get(sheet)
+                                # the settle clock restarts whenever the file is still being written
+                                seen[sheet] = previous if previous is not None and previous[0] == key else (key, now)
+                            candidates = seen
+                            for sheet, (key, since) in list(candidates.items()):
+                                if len(running) >= queue_size:
+                                    break
+                                if now - since >= settle:
+                                    del candidates[sheet]
+                                    output = batch.answers_path(sheet, output_dir, root and batch.relative_name(sheet, root))
+                                    future = executor.submit(batch.grade_sheet, (method, sheet, output, options))
+                                    running[future] = key
+                                    future.add_done_callback(lambda _: os.write(wake_write, b'.'))
+
+                        if (once or stopping) and not candidates and not running:
+                            break
+
+                        # sleep until a file event, a finished sheet or the next settle check
+                        timeout = min(interval, settle) if candidates else interval
+                        waiting = [wake_read] + ([notifier] if notifier else [])
+                        ready, _, _ = select.select(waiting, [], [], timeout)
+                        if notifier in ready:
+                            notifier.drain()
+                        if wake_read in ready:
+                            try:
+                                while os.read(wake_read, 4096):
+                                    pass
+                            except BlockingIOError:
+                                pass
+                    except KeyboardInterrupt: # wherever in the loop it arrives
+                        if stopping:
+                            raise # a second Ctrl-C stops waiting for the loop
+                        print(f"Stopping, waiting for {len(running)} sheets in progress")
+                        stopping = True
+                        candidates.clear()
+            finally:
+                # the workers finish their sheets before the pool shuts down anyway,
+                # so wait for them here and record their results
+                record_results(results, list(running), running, graded, method)
+    finally:
+        if notifier:
+            notifier.close()
+        os.close(wake_read)
+        os.close(wake_write)
+# endregion functions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade scans as they arrive in a directory.")
+    parser.add_argument('directories', nargs='+', help="directories the scanners write to")
+    parser.add_argument('-o', '--output-dir', required=True, help="directory for the per-sheet answer files")
+    parser.add_argument('-r', '--results', default=None, help="results file, JSON lines (default: <output-dir>/results.jsonl)")
+    parser.add_argument('-m', '--method', choices=batch.PIPELINES, default='grade', help="recogniser to use (default: grade)")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="worker processes (default: number of CPUs)")
+    parser.add_argument('-q', '--queue-size', type=int, default=None, help="sheets handed to the workers at a time (default: 2 per worker)")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between directory scans (default: 2)")
+    parser.add_argument('--settle', type=float, default=1.0, help="seconds a file must stay unchanged before it is graded (default: 1)")
+    parser.add_argument('--once', action='store_true', help="grade what is there and exit instead of watching")
+    parser.add_argument('--form-id', help="reuse the box grid detected on the first sheet of this form (grade only)")
+    parser.add_argument('--annotate', action='store_true', help="also write a <sheet>_scored.jpg with the recognised answers marked")
+    parser.add_argument('--cache', help="result cache directory: a scan dropped in again unchanged is not recognised again")
+    args = parser.parse_args()
+    if args.method == 'cascade' and args.annotate:
+        parser.error("-m cascade does not write annotated sheets, use -m grade or -m grade1 with --annotate")
+
+    results_path = args.results or os.path.join(args.output_dir, 'results.jsonl')
+    watch(args.directories, args.output_dir, results_path, args.method, args.workers, args.interval, args.settle,
+          args.queue_size, args.once, args.form_id, args.annotate, args.cache)